@@ -43,7 +43,7 @@ def sort_campi_by_distance(filters):
 
 
 
-@cacheable(consider_only=["semester", "_full"])
+@cacheable(consider_only=["semester", "_full"], soft_ttl=3600)
 def get_campi(filters):
     repository = CampusRepository()
     full = filters.pop("_full", None)
@@ -3,7 +3,7 @@ from app.repositories import SemesterRepository
 
 __author__ = 'fernando'
 
-@cacheable(consider_only=[])
+@cacheable(consider_only=[], soft_ttl=3600)
 def get_semesters(filters):
     repository = SemesterRepository()
     if filters:
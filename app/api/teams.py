@@ -3,9 +3,11 @@ import logging as _logging
 from google.appengine.ext import ndb
 from app.cache import gc_collect, clear_lru_cache
 from app.decorators.cacheable import cacheable
+from app.decorators.keyed import keyed
 from app.decorators.searchable import searchable
 from app.json_serializer import JSONEncoder, encoder
 from app.repositories import DisciplinesRepository, TeamsRepository
+from unidecode import unidecode
 
 __author__ = 'fernando'
 
@@ -13,11 +15,12 @@ __author__ = 'fernando'
 logging = _logging.getLogger("matrufsc2_api")
 logging.setLevel(_logging.WARN)
 
-@searchable(
-    lambda item: item['id'],
+# The stores are read from the indexes where the records were saved before (while the stores are not built)
+@keyed(
     prefix="matrufsc2-discipline-",
-    min_word_length=40,
-    consider_only=["campus"]
+    consider_only=["campus"],
+    fallback=searchable(lambda item: item['id'], prefix="matrufsc2-discipline-", min_word_length=40,
+                        consider_only=["campus"])
 )
 def get_disciplines_teams(filters):
     gc_collect() # Just to avoid too much use of memory
@@ -35,7 +38,11 @@ def get_disciplines_teams(filters):
     return new_disciplines
 
 
-@searchable(lambda item: item["id"], prefix="matrufsc2-team-", consider_only=["campus"], min_word_length=40)
+@keyed(
+    prefix="matrufsc2-team-",
+    consider_only=["campus"],
+    fallback=searchable(lambda item: item["id"], prefix="matrufsc2-team-", consider_only=["campus"], min_word_length=40)
+)
 def get_all_teams(filters):
     if "campus" not in filters:
         return []
@@ -43,14 +50,14 @@ def get_all_teams(filters):
     repository = TeamsRepository()
     results = []
     more = True
-    page = 1
     logging.debug("Fetching list of teams based on teams of each discipline")
     count = 0
+    cursor = None
     while more:
         disciplines_teams = get_disciplines_teams({
             "campus": filters["campus"],
             "q": "",
-            "page": page,
+            "cursor": cursor,
             "limit": 500
         })
         while disciplines_teams["results"]:
@@ -68,15 +75,97 @@ def get_all_teams(filters):
             gc_collect() # Just to avoid too much use of memory
             count += 1
             logging.warn("%d disciplines already processed", count)
-        more = disciplines_teams["more"]
-        page += 1
+        cursor = disciplines_teams["next_cursor"]
+        more = cursor is not None
         del disciplines_teams
         gc_collect() # Just to avoid too much use of memory
-    logging.debug("Fetched %d teams (found on %d pages of disciplines)..", len(results), page)
+    logging.debug("Fetched %d teams (found on %d disciplines)..", len(results), count)
     gc_collect() # Just to avoid too much use of memory
     return results
 
 
+def iter_disciplines_teams(campus, limit=500):
+    """
+    Iterate over the teams of each discipline of the campus (as saved by get_disciplines_teams), by pages
+
+    :param campus: The key of the campus
+    :type campus: str
+    :param limit: The number of disciplines of each page
+    :type limit: int
+    :return: The pages of disciplines (dicts with the id of the discipline and the ids of its teams)
+    :rtype: generator
+    """
+    cursor = None
+    while True:
+        disciplines_teams = get_disciplines_teams({
+            "campus": campus,
+            "q": "",
+            "cursor": cursor,
+            "limit": limit
+        })
+        if disciplines_teams["results"]:
+            yield disciplines_teams["results"]
+        cursor = disciplines_teams["next_cursor"]
+        if cursor is None:
+            break
+
+
+def get_teams_search_items(campus, disciplines_teams):
+    """
+    Get the items indexed by search_teams for the teams of the disciplines, that are read (at once) from the store
+    of teams (see get_all_teams)
+
+    :param campus: The key of the campus
+    :type campus: str
+    :param disciplines_teams: The disciplines (dicts with the id of the discipline and the ids of its teams)
+    :type disciplines_teams: list
+    :return: The items (with the id and the code of the team, its discipline, its teachers and its rooms)
+    :rtype: list
+    """
+    disciplines = {}
+    for discipline in disciplines_teams:
+        for team_id in discipline["teams"]:
+            disciplines[str(team_id).replace("matrufsc2-team-", "")] = "".join([
+                "matrufsc2-discipline-",
+                str(discipline["id"]).replace("matrufsc2-discipline-", "")
+            ])
+    if not disciplines:
+        return []
+    result = get_all_teams({"q": " ".join(disciplines), "campus": campus})
+    items = []
+    for team in result["results"]:
+        items.append({
+            "id": team["id"],
+            "discipline": disciplines[team["id"]],
+            "code": team["code"],
+            "teachers": [teacher["name"] for teacher in team["teachers"] if teacher.get("name")],
+            "rooms": sorted(set(schedule["room"] for schedule in team["schedules"] if schedule.get("room")))
+        })
+    return items
+
+
+@searchable(
+    # The queries are transliterated to ASCII, so the names are too (as they may have accents). The code of the team is
+    # the first word, as it is considered the code by the ranking of the results
+    lambda item: unidecode(u" ".join([item["code"]] + item["teachers"] + item["rooms"])).decode("ascii"),
+    prefix="matrufsc2-team-",
+    consider_only=["campus"]
+)
+def search_teams(filters):
+    """
+    Search the teams by the names of their teachers, by their rooms (as "CTC-102") and by their codes, returning the
+    ids of the teams found with the keys of their disciplines
+    """
+    if "campus" not in filters:
+        return []
+    items = []
+    for disciplines_teams in iter_disciplines_teams(filters["campus"]):
+        items.extend(get_teams_search_items(filters["campus"], disciplines_teams))
+        gc_collect()  # Just to avoid too much use of memory
+    logging.debug("Indexing %d teams by teachers and rooms", len(items))
+    return items
+
+
 def get_teams(filters):
     """
     Return a list of dict that matches the discipline filter =)
@@ -96,18 +185,18 @@ def get_teams(filters):
         return teams
     if disciplines["results"][1:]:
         raise Exception("Something strange found")
-    for team_key in disciplines["results"][0]["teams"]:
-        search_query = str(team_key).replace("matrufsc2-team-", "")
-        logging.debug("Fetching team '%s'..", team_key)
-        result = get_all_teams({"q": search_query, "campus": filters["campus"]})
-        if len(result["results"]) > 1:
-            raise Exception("Number of teams unexpected found for team key '%s'"%search_query)
-        elif not result["results"]:
-            logging.error("No team found for team key '%s'"%search_query)
-        if result["results"]:
-            r = dict(result["results"][0])
-            r["id"] = "".join(["matrufsc2-team-", r["id"]])
-            teams.append(r)
+    teams_ids = [str(team_key).replace("matrufsc2-team-", "") for team_key in disciplines["results"][0]["teams"]]
+    logging.debug("Fetching %d teams..", len(teams_ids))
+    # All the teams are fetched at once
+    result = get_all_teams({"q": " ".join(teams_ids), "campus": filters["campus"]})
+    found = dict((team["id"], team) for team in result["results"])
+    for team_id in teams_ids:
+        if team_id not in found:
+            logging.error("No team found for team key '%s'"%team_id)
+            continue
+        r = dict(found[team_id])
+        r["id"] = "".join(["matrufsc2-team-", r["id"]])
+        teams.append(r)
     return teams
 
 
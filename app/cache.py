@@ -1,4 +1,5 @@
 import hashlib
+import json
 
 try:
     import cPickle as pickle
@@ -6,16 +7,69 @@ except:
     import pickle
 import logging as _logging
 import zlib
+import marshal
+import struct
 import time
 import gc
+import heapq
+import threading
+import thread
+import sys
+import math
+import uuid
+import re
 import cloudstorage as gcs
 from google.appengine.ext import ndb
-from google.appengine.api import app_identity
+from google.appengine.api import app_identity, taskqueue
+from google.appengine.api import memcache as memcache_api
+from app.decorators.threaded import threaded
+from app.metrics import MetricsRegistry
 
 __author__ = 'fernando'
 
 CACHE_TIMEOUT = 86400*7
 
+# Keys known to be absent of all the tiers are remembered for a short time, so repeated lookups does not hit GCS
+NEGATIVE_CACHE_KEY = "negative-cache/%s"
+NEGATIVE_CACHE_TIMEOUT = 30
+NEGATIVE_LRU_CACHE_TIMEOUT = 10
+# Values that does not fit on memcache (even compressed) are split in chunks with this size
+MEMCACHE_CHUNK_SIZE = 900000
+MEMCACHE_CHUNK_KEY = "%s/chunk/%s/%d"
+# Each namespace of the cache has a generation (saved on memcache and GCS) that is part of its keys, so a namespace
+# is invalidated (in all the instances) by just moving to the next generation. Each instance checks the generation at
+# most each GENERATION_LRU_TIMEOUT seconds
+GENERATION_KEY = "cache/generations/%s"
+GENERATION_LRU_TIMEOUT = 15
+# Only one refresh of each key is enqueued in this interval (in seconds)
+REFRESH_LOCK_KEY = "refresh-lock/%s"
+REFRESH_LOCK_TIMEOUT = 300
+REFRESH_URL = "/secret/refresh_cache/"
+# Maximum time (in seconds) that a thread waits for a fetch made by another thread
+IN_FLIGHT_TIMEOUT = 60
+# Values of the negative cache on memcache: a recent write stores KEY_PRESENT, so a concurrent miss cannot
+# (using memcache add) mark the key as absent
+KEY_ABSENT = 1
+KEY_PRESENT = 0
+
+# Header of the blobs saved by the cache: a magic string followed by the ids of the codec and of the compressor used
+BLOB_MAGIC = "\xffC"
+BLOB_HEADER = struct.Struct("!2scc")
+# Codec used to serialize the values (None to use marshal when the value is plain data, and pickle otherwise)
+DEFAULT_CODEC = None
+DEFAULT_COMPRESSOR = "zlib"
+DEFAULT_COMPRESS_LEVEL = 6
+# Only values with at least this size (serialized) are compressed
+COMPRESS_MIN_SIZE = 65536
+# Types that marshal keeps as they are (see is_plain_data)
+PLAIN_SCALAR_TYPES = frozenset([type(None), bool, int, long, float, complex, str, unicode])
+PLAIN_CONTAINER_TYPES = frozenset([list, tuple, set, frozenset])
+
+# Parts of the keys ignored when grouping the metrics by namespace (hashes, versions and chunks)
+METRICS_IGNORED_PART = re.compile(r"^(?:[0-9a-f]{32,}|v\d+|chunk|\d+)$")
+METRICS_HASH = re.compile(r"[0-9a-f]{32,}")
+METRICS_NAMESPACE_PARTS = 4
+
 TEXTCHARS = ''.join(map(chr, [7,8,9,10,12,13,27] + range(0x20, 0x100)))
 
 logging = _logging.getLogger("matrufsc2_cache")
@@ -37,8 +91,206 @@ class CacheItem(object):
     __slots__ = ["value", "expire_on"]
 
 
+class RefreshableItem(object):
+    """
+    A value with a soft expiration, after which it is still used but refreshed in background, and a hard expiration,
+    after which it is not used anymore
+    """
+    __slots__ = ["value", "refresh_on", "expire_on"]
+
+    def __init__(self, value, soft_ttl=None, hard_ttl=None):
+        now = time.time()
+        self.value = value
+        self.refresh_on = None if soft_ttl is None else now + soft_ttl
+        self.expire_on = None if hard_ttl is None else now + hard_ttl
+
+    def is_expired(self):
+        return self.expire_on is not None and self.expire_on < time.time()
+
+    def needs_refresh(self):
+        return self.refresh_on is not None and self.refresh_on < time.time()
+
+
+class AbsentItem(object):
+    """
+    Marks, in the LRU cache, a key that is known to not exist in any tier of the cache
+    """
+    __slots__ = []
+
+
+ABSENT = AbsentItem()
+
+
+class Codec(object):
+    __slots__ = ["id", "name", "dumps", "loads"]
+
+    def __init__(self, codec_id, name, dumps, loads):
+        self.id = codec_id
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+class Compressor(object):
+    __slots__ = ["id", "name", "compress", "decompress"]
+
+    def __init__(self, compressor_id, name, compress, decompress):
+        self.id = compressor_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+codecs = {}
+compressors = {}
+
+
+def register_codec(codec_id, name, dumps, loads):
+    """
+    Register a codec to serialize the values saved in the cache
+
+    :param codec_id: The (one character) id of the codec, saved in the header of the blobs
+    :type codec_id: str
+    :param name: The name of the codec
+    :type name: str
+    :param dumps: The function that serializes a value (it should raise ValueError if the value is not supported)
+    :param loads: The function that deserializes a value
+    """
+    codec = Codec(codec_id, name, dumps, loads)
+    codecs[codec_id] = codecs[name] = codec
+
+
+def register_compressor(compressor_id, name, compress, decompress):
+    """
+    Register a compressor for the blobs saved in the cache
+
+    :param compressor_id: The (one character) id of the compressor, saved in the header of the blobs
+    :type compressor_id: str
+    :param name: The name of the compressor
+    :type name: str
+    :param compress: The function that compresses the data (receiving the data and the compression level)
+    :param decompress: The function that decompresses the data
+    """
+    compressor = Compressor(compressor_id, name, compress, decompress)
+    compressors[compressor_id] = compressors[name] = compressor
+
+
+register_codec("p", "pickle", lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads)
+# marshal only supports the builtin types (see is_plain_data) and is faster than pickle with them
+register_codec("m", "marshal", lambda value: marshal.dumps(value, 2), marshal.loads)
+register_compressor("n", "none", lambda data, level: data, str)
+register_compressor("z", "zlib", zlib.compress, zlib.decompress)
+
+
+def is_plain_data(value):
+    """
+    Check if the value is made only of the exact builtin types (without subclasses), that are the ones that marshal
+    keeps as they are (it silently converts other objects, as arrays and buffers, to strings)
+
+    :param value: The value to check
+    :return: If the value (with all the values inside of it) is plain data
+    :rtype: bool
+    """
+    pending = [value]
+    # A dict, as the set of this module is the one of the memcache API
+    seen = {}
+    while pending:
+        value = pending.pop()
+        value_type = type(value)
+        if value_type in PLAIN_SCALAR_TYPES:
+            continue
+        if id(value) in seen:
+            # marshal does not support references (as the ones of the cycles)
+            return False
+        seen[id(value)] = True
+        if value_type in PLAIN_CONTAINER_TYPES:
+            pending.extend(value)
+        elif value_type is dict:
+            pending.extend(value.iterkeys())
+            pending.extend(value.itervalues())
+        else:
+            return False
+    return True
+
+
+def encode_value(value, codec=None, compressor=None, level=None):
+    """
+    Encode a value in a blob with a header describing the codec and the compressor used
+
+    :param value: The value to encode
+    :param codec: The name of the codec to use (the default is marshal for plain data, and pickle otherwise)
+    :type codec: str
+    :param compressor: The name of the compressor to use (used only when the value has at least COMPRESS_MIN_SIZE bytes)
+    :type compressor: str
+    :param level: The compression level
+    :type level: int
+    :return: The blob and the size of the value serialized (before compression)
+    :rtype: tuple
+    """
+    if codec is None:
+        codec = DEFAULT_CODEC
+    if codec is None:
+        codec = codecs["marshal" if is_plain_data(value) else "pickle"]
+        data = codec.dumps(value)
+    else:
+        codec = codecs[codec]
+        data = codec.dumps(value)
+    size = len(data)
+    if size >= COMPRESS_MIN_SIZE:
+        compressor = compressors[compressor or DEFAULT_COMPRESSOR]
+        data = compressor.compress(data, DEFAULT_COMPRESS_LEVEL if level is None else level)
+    else:
+        compressor = compressors["none"]
+    return "".join([BLOB_HEADER.pack(BLOB_MAGIC, codec.id, compressor.id), data]), size
+
+
+def is_blob(value):
+    return isinstance(value, str) and value[:len(BLOB_MAGIC)] == BLOB_MAGIC
+
+
+def decode_value(blob):
+    """
+    Decode a blob created by encode_value
+
+    :param blob: The blob to decode
+    :type blob: str
+    :return: The value and the size of the value serialized (before compression)
+    :rtype: tuple
+    """
+    if not is_blob(blob):
+        # Blobs saved before the header existed are always pickled
+        return pickle.loads(blob), len(blob)
+    magic, codec_id, compressor_id = BLOB_HEADER.unpack_from(blob)
+    data = compressors[compressor_id].decompress(buffer(blob, BLOB_HEADER.size))
+    return codecs[codec_id].loads(data), len(data)
+
+
+class ChunkedItem(object):
+    """
+    Manifest of a value saved on memcache in chunks. The generation is part of the keys of the chunks, so chunks of
+    different writes are never mixed.
+    """
+    __slots__ = ["generation", "chunks"]
+
+    def get_chunks_keys(self, key):
+        return [MEMCACHE_CHUNK_KEY % (key, self.generation, chunk) for chunk in xrange(self.chunks)]
+
+
+class InFlightFetch(object):
+    """
+    A fetch of a key that is being made right now, shared by all the callers that need the same key at the same time
+    """
+    __slots__ = ["thread_id", "future", "event"]
+
+    def __init__(self):
+        self.thread_id = thread.get_ident()
+        self.future = None
+        self.event = threading.Event()
+
+
 class LRUItem(object):
-    __slots__ = ["value", "key", "updated_on", "accessed_on"]
+    __slots__ = ["value", "key", "updated_on", "accessed_on", "size", "namespace", "prev", "next", "ns_prev",
+                 "ns_next"]
 
     def __repr__(self):
         if hasattr(self, "value"):
@@ -52,14 +304,66 @@ class LRUItem(object):
         else:
             return super(LRUItem, self).__str__()
 
+
+class LRUNamespace(object):
+    """
+    A group of keys (identified by a common prefix) of the LRU cache that has its own byte budget, so the items of
+    the namespace cannot evict the items outside of it.
+    """
+    __slots__ = ["prefix", "max_size", "size", "root"]
+
+    def __init__(self, prefix, max_size):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.size = 0
+        self.root = LRUItem()
+        self.root.ns_prev = self.root.ns_next = self.root
+
+
+def estimate_size(value):
+    """
+    Estimate the cost (in bytes) of the specified value, using the size of its pickled representation
+
+    :param value: The value to estimate the size
+    :return: The estimated size of the value
+    :rtype: int
+    """
+    if isinstance(value, str):
+        return len(value)
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except:
+        return sys.getsizeof(value)
+
+
 class LRUCache(dict):
-    __slots__ = ["capacity", "expiration", "run_gc"]
+    """
+    In-process LRU cache with expiration.
+
+    The items are kept in a circular doubly-linked list ordered by recency (the most recently used item is right
+    after the root node and the least recently used one is right before it) and in a heap ordered by the time they
+    expire, so get, set and evictions never need to scan all the items of the cache.
+
+    Besides the limit on the number of items, the cache may be limited by the total size (in bytes) of the items and
+    each namespace (a prefix of the keys) may have its own byte budget, with its own recency list.
+    """
+    __slots__ = ["capacity", "expiration", "run_gc", "root", "expiration_heap", "lock", "max_size", "size",
+                 "namespaces"]
 
     def __init__(self, *args, **kwargs):
-        super(LRUCache, self).__init__(*args, **kwargs)
+        super(LRUCache, self).__init__()
         self.capacity = 1000
         self.expiration = 86400
         self.run_gc = 0
+        self.root = LRUItem()
+        self.root.prev = self.root.next = self.root
+        self.expiration_heap = []
+        self.lock = threading.RLock()
+        self.max_size = None
+        self.size = 0
+        self.namespaces = []
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
 
     def set_capacity(self, capacity):
         self.capacity = capacity
@@ -73,10 +377,93 @@ class LRUCache(dict):
     def get_expiration(self):
         return self.expiration
 
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+
+    def get_max_size(self):
+        return self.max_size
+
+    def get_size(self):
+        return self.size
+
+    def set_namespace_max_size(self, prefix, max_size):
+        """
+        Define a byte budget for the keys starting with the specified prefix. Note that only the items saved after
+        the namespace is defined are accounted into it.
+
+        :param prefix: The prefix of the keys of the namespace
+        :type prefix: str
+        :param max_size: The maximum size (in bytes) of the items of the namespace
+        :type max_size: int
+        """
+        with self.lock:
+            for namespace in self.namespaces:
+                if namespace.prefix == prefix:
+                    namespace.max_size = max_size
+                    break
+            else:
+                self.namespaces.append(LRUNamespace(prefix, max_size))
+                # The most specific prefixes are checked first
+                self.namespaces.sort(key=lambda namespace: len(namespace.prefix), reverse=True)
+            self.check()
+
+    def get_namespace(self, key):
+        if isinstance(key, basestring):
+            for namespace in self.namespaces:
+                if key.startswith(namespace.prefix):
+                    return namespace
+        return None
+
+    def link(self, item):
+        root = self.root
+        item.prev = root
+        item.next = root.next
+        root.next.prev = item
+        root.next = item
+        namespace = item.namespace
+        if namespace is not None:
+            root = namespace.root
+            item.ns_prev = root
+            item.ns_next = root.ns_next
+            root.ns_next.ns_prev = item
+            root.ns_next = item
+
+    def unlink(self, item):
+        item.prev.next = item.next
+        item.next.prev = item.prev
+        item.prev = item.next = None
+        if item.namespace is not None:
+            item.ns_prev.ns_next = item.ns_next
+            item.ns_next.ns_prev = item.ns_prev
+            item.ns_prev = item.ns_next = None
+
+    def lookup(self, item, count_miss=True):
+        """
+        Get the value of the key, raising KeyError if it is not in the cache
+
+        :param item: The key
+        :param count_miss: If a miss should be accounted on the metrics (disable it when the caller checks again)
+        :type count_miss: bool
+        :return: The value
+        """
+        start = time.time()
+        try:
+            with self.lock:
+                now = self.check()
+                val = super(LRUCache, self).__getitem__(item)
+                self.unlink(val)
+                self.link(val)
+                val.accessed_on = now
+                value, size = val.value, val.size
+        except KeyError:
+            if count_miss:
+                cache_metrics.record_miss("lru", get_metrics_namespace(item), time.time() - start)
+            raise
+        cache_metrics.record_hit("lru", get_metrics_namespace(item), time.time() - start, size)
+        return value
+
     def __getitem__(self, item):
-        val = super(LRUCache, self).__getitem__(item)
-        val.accessed_on = self.check()
-        return val.value
+        return self.lookup(item)
 
     def get(self, k, d=None):
         try:
@@ -85,48 +472,147 @@ class LRUCache(dict):
             return d
 
     def pop(self, k, d=None):
-        val = self.get(k, d)
-        try:
+        with self.lock:
+            if k not in self:
+                return d
+            val = super(LRUCache, self).__getitem__(k)
             del self[k]
-        except KeyError:
-            pass
-        return val
+            if time.time() > val.updated_on:
+                return d
+            return val.value
 
     def check(self):
-        self.run_gc = (self.run_gc+1)%self.capacity
+        self.run_gc = (self.run_gc+1) % self.capacity
         now = time.time()
-        dif = len(self)-self.capacity
-        if dif > 0 or self.run_gc == 0:
-            # Run and remove expired items first
-            expired_items = [item for item in self.itervalues() if now > item.updated_on]
-            for expired_item in expired_items:
-                del self[expired_item.key]
-                dif -= 1
-            gc_collect()
-            while dif > 0 and self:
-                expired_item = min(self.itervalues(), key=lambda item: item.accessed_on)
-                del self[expired_item.key]
-                dif -= 1
-                del expired_item
+        evicted = 0
+        heap = self.expiration_heap
+        # Remove expired items first
+        while heap and heap[0][0] < now:
+            expire_on, key = heapq.heappop(heap)
+            val = super(LRUCache, self).get(key)
+            if val is not None and val.updated_on == expire_on:
+                del self[key]
+                evicted += 1
+        # Then remove the least recently used items of each namespace over its budget
+        for namespace in self.namespaces:
+            root = namespace.root
+            while namespace.max_size is not None and namespace.size > namespace.max_size and root.ns_prev is not root:
+                cache_metrics.record_eviction("lru", get_metrics_namespace(root.ns_prev.key))
+                del self[root.ns_prev.key]
+                evicted += 1
+        # And finally remove the least recently used items of the whole cache
+        while len(self) > self.capacity or (self.max_size is not None and self.size > self.max_size and self):
+            cache_metrics.record_eviction("lru", get_metrics_namespace(self.root.prev.key))
+            del self[self.root.prev.key]
+            evicted += 1
+        if len(heap) > 2 * len(self) + 64:
+            # Overwritten and deleted items leave stale entries on the heap, so rebuild it from time to time
+            self.expiration_heap = heap = [(val.updated_on, val.key) for val in self.itervalues()]
+            heapq.heapify(heap)
+        if evicted and self.run_gc == 0:
             gc_collect()
         return now
 
+    def set(self, key, value, size=None, ttl=None):
+        """
+        Save the value in the cache
+
+        :param key: The key of the value
+        :param value: The value to save
+        :param size: The size (in bytes) of the value, if already known (it is estimated when a byte budget is used)
+        :type size: int
+        :param ttl: The time (in seconds) the value is kept in the cache, if different of the default expiration
+        :type ttl: int
+        """
+        if size is None:
+            # The value is serialized (to estimate its size) before the lock is acquired, so the other threads are not
+            # blocked by it
+            if self.max_size is not None or self.get_namespace(key) is not None:
+                size = estimate_size(value)
+            else:
+                size = 0
+        with self.lock:
+            if key in self:
+                del self[key]
+            namespace = self.get_namespace(key)
+            if (self.max_size is not None and size > self.max_size) or \
+                    (namespace is not None and namespace.max_size is not None and size > namespace.max_size):
+                logging.warn("Ignoring item with %d bytes because it does not fit on the LRU cache :~", size)
+                return
+            val = LRUItem()
+            val.key = key
+            val.value = value
+            val.accessed_on = time.time()
+            val.updated_on = val.accessed_on + (self.expiration if ttl is None else ttl)
+            val.namespace = namespace
+            val.size = size
+            super(LRUCache, self).__setitem__(key, val)
+            self.link(val)
+            self.size += size
+            if val.namespace is not None:
+                val.namespace.size += size
+            heapq.heappush(self.expiration_heap, (val.updated_on, key))
+            cache_metrics.record_write("lru", get_metrics_namespace(key), size)
+            self.check()
+
     def __setitem__(self, key, value):
-        val = LRUItem()
-        val.key = key
-        val.value = value
-        val.accessed_on = self.check()
-        val.updated_on = val.accessed_on + self.expiration
-        result = super(LRUCache, self).__setitem__(key, val)
-        return result
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            val = super(LRUCache, self).pop(key)
+            self.unlink(val)
+            self.size -= val.size
+            if val.namespace is not None:
+                val.namespace.size -= val.size
+
+    def clear_prefix(self, prefix):
+        with self.lock:
+            for key in [key for key in self.iterkeys() if isinstance(key, basestring) and key.startswith(prefix)]:
+                del self[key]
+
+    def clear(self):
+        with self.lock:
+            super(LRUCache, self).clear()
+            self.root.prev = self.root.next = self.root
+            self.expiration_heap = []
+            self.size = 0
+            for namespace in self.namespaces:
+                namespace.size = 0
+                namespace.root.ns_prev = namespace.root.ns_next = namespace.root
 
 
+def get_metrics_namespace(key):
+    """
+    Get the namespace of the key used to group the metrics of the cache (the key without its hashes and versions,
+    limited to its first METRICS_NAMESPACE_PARTS parts)
+
+    :param key: The key
+    :return: The namespace of the key
+    :rtype: str
+    """
+    if not isinstance(key, basestring):
+        return "other"
+    parts = [part for part in key.split("/") if not METRICS_IGNORED_PART.match(part)]
+    return METRICS_HASH.sub("*", "/".join(parts[:METRICS_NAMESPACE_PARTS])) or "*"
+
+
+cache_metrics = MetricsRegistry("cache")
+
 lru_cache = LRUCache()
-lru_cache.set_capacity(250)  # 250 items
+lru_cache.set_capacity(10000)  # 10000 items
+# The sizes are of the serialized values, and the values take 5 to 12 times more memory once decoded, so these budgets
+# (up to ~70 MB of objects) leave room for the requests on a F1 instance (with 128 MB)
+lru_cache.set_max_size(6 * 1024 * 1024)  # 6 MB of serialized data
+lru_cache.set_namespace_max_size("cache/searchIndex/", 4 * 1024 * 1024)  # Search indexes can use up to 4 MB
+lru_cache.set_namespace_max_size("cache/keyedStore/", 1024 * 1024)  # Keyed stores can use up to 1 MB
 lru_cache.set_expiration(3600)  # For 3600 seconds
 
 ndb_context = ndb.get_context()
 
+in_flight = {}
+in_flight_lock = threading.Lock()
+
 
 def gc_collect():
     collected = gc.collect()
@@ -158,62 +644,247 @@ def get_gcs_filename(filename):
 def get_from_cache(key, persistent=True, memcache=True, log=True):
     logging.debug("Fetching key '%s' from cache", key)
     try:
-        raise ndb.Return(lru_cache[key])
+        # A miss is accounted by get_many_from_cache, that checks the LRU cache again
+        result = lru_cache.lookup(key, count_miss=False)
+        raise ndb.Return(None if result is ABSENT else result)
     except KeyError:
         pass
-    start = time.time()
-    if memcache:
-        result = yield ndb_context.memcache_get(key, use_cache=False)
-        if result is not None:
-            size = "small"
-            if isinstance(result, basestring) and result.translate(None, TEXTCHARS):
-                # If result is a string it MAYBE pickled :v
-                try:
-                    # Try small item first to be more fast :D
-                    result = pickle.loads(zlib.decompress(result, 15, 2097152))
-                    size = "large"
-                except:
-                    logging.warn("Error when decompressing content, ignoring..")
-                    pass
-            if log:
-                logging.debug("Found (%s) item on memcache in %f seconds..Returning", size, time.time()-start)
-                logging.debug("Saving item on LRU Cache..")
-            lru_cache[key] = result
-            raise ndb.Return(result)
-    if persistent:
-        start = time.time()
-        filename = yield get_gcs_filename(key)
+    # Concurrent callers (tasklets or threads) of the same key share the same fetch (and deserialization)
+    flight_key = (key, persistent, memcache)
+    with in_flight_lock:
+        flight = in_flight.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = in_flight[flight_key] = InFlightFetch()
+    if leader:
+        def finish(fut):
+            with in_flight_lock:
+                in_flight.pop(flight_key, None)
+            flight.event.set()
+
+        flight.future = fetch_from_cache(key, persistent, memcache, log)
+        flight.future.add_immediate_callback(finish, flight.future)
+        result = yield flight.future
+    elif flight.thread_id == thread.get_ident():
+        if log:
+            logging.debug("Waiting for fetch of the key '%s' made by another tasklet", key)
+        result = yield flight.future
+    elif flight.event.wait(IN_FLIGHT_TIMEOUT):
+        if log:
+            logging.debug("Waited for fetch of the key '%s' made by another thread", key)
+        result = flight.future.get_result()
+    else:
+        logging.warn("Timeout when waiting for fetch of the key '%s' made by another thread", key)
+        result = yield fetch_from_cache(key, persistent, memcache, log)
+    raise ndb.Return(result)
+
+
+@ndb.tasklet
+def fetch_from_cache(key, persistent=True, memcache=True, log=True):
+    results = yield get_many_from_cache([key], persistent=persistent, memcache=memcache, log=log)
+    raise ndb.Return(results[0])
+
+
+def decode_memcache_value(value):
+    """
+    Decode a value saved on memcache by encode_memcache_value
+
+    :param value: The value found on memcache
+    :return: The decoded value and the size of its serialized representation (or None if it is unknown)
+    :rtype: tuple
+    """
+    if is_blob(value):
+        return decode_value(value)
+    # Values saved before the blobs had a header
+    if isinstance(value, basestring) and value.translate(None, TEXTCHARS):
+        # If result is a string it MAYBE pickled :v
+        try:
+            pickled_value = zlib.decompress(value, 15, 2097152)
+            return pickle.loads(pickled_value), len(pickled_value)
+        except:
+            logging.warn("Error when decompressing content, ignoring..")
+    return value, None
+
+
+def encode_memcache_value(key, blob, log=True):
+    """
+    Encode a blob to be saved on memcache: blobs that fit on memcache are saved as they are and larger blobs are split
+    in chunks, referenced by a manifest saved in the key
+
+    :param key: The key of the value
+    :param blob: The blob of the value (created by encode_value)
+    :type blob: str
+    :return: A dict with the items to save on memcache
+    :rtype: dict
+    """
+    size = len(blob)
+    if size < 1e6:
+        if log:
+            logging.debug("Saving item on memcached (it has %d bytes)..", size)
+        return {key: blob}
+    manifest = ChunkedItem()
+    manifest.generation = uuid.uuid4().hex
+    manifest.chunks = int(math.ceil(float(size) / MEMCACHE_CHUNK_SIZE))
+    if log:
+        logging.debug("Saving (chunked) item on memcached (it has %d bytes in %d chunks)..", size, manifest.chunks)
+    result = dict(
+        (chunk_key, blob[chunk * MEMCACHE_CHUNK_SIZE:(chunk + 1) * MEMCACHE_CHUNK_SIZE])
+        for chunk, chunk_key in enumerate(manifest.get_chunks_keys(key))
+    )
+    result[key] = manifest
+    return result
+
+
+def read_from_gcs(filename):
+    try:
+        gcs_file = gcs.open(filename, 'r')
+    except gcs.NotFoundError:
+        return None
+    try:
+        return gcs_file.read()
+    finally:
+        gcs_file.close()
+
+
+def write_to_gcs(filename, blob):
+    gcs_file = gcs.open(filename, 'w')
+    gcs_file.write(blob)
+    gcs_file.close()
+
+
+def run_in_parallel(fn, args_list):
+    """
+    Run the function with each of the arguments in parallel threads (or directly, if there is only one call to do)
+
+    :param fn: The function to call
+    :param args_list: A list with the arguments of each call
+    :type args_list: list
+    :return: A list of objects with a get_result method, in the same order of the arguments
+    :rtype: list
+    """
+    if len(args_list) == 1:
+        future = ndb.Future()
         try:
-            gcs_file = gcs.open(filename, 'r')
-            value = gcs_file.read()
-            result = pickle.loads(value)
-            gcs_file.close()
-            if log:
-                logging.debug("Found item on GCS in %f seconds..Returning", time.time()-start)
-                logging.debug("Saving item on LRU Cache")
-            lru_cache[key] = result
+            future.set_result(fn(*args_list[0]))
+        except Exception, e:
+            future.set_exception(e, sys.exc_info()[2])
+        return [future]
+    return [threaded(fn)(*args) for args in args_list]
+
+
+@ndb.tasklet
+def get_many_from_cache(keys, persistent=True, memcache=True, log=True):
+    """
+    Fetch many keys from the cache at once: the LRU cache is checked first, then the remaining keys are fetched from
+    memcache in a single batch and the keys still missing are read from GCS in parallel. The values found on the
+    slower tiers are saved on the faster ones.
+
+    :param keys: The keys to fetch
+    :type keys: list
+    :return: A list with the value of each key (or None, if not found), in the same order of the keys
+    :rtype: list
+    """
+    results = {}
+    missing = []
+    for key in keys:
+        try:
+            result = lru_cache[key]
+            results[key] = None if result is ABSENT else result
+        except KeyError:
+            if key not in missing:
+                missing.append(key)
+    if memcache and missing:
+        start = time.time()
+        # All the gets are sent in the same batch (a single get_multi) by the context
+        found = yield [ndb_context.memcache_get(key, use_cache=False) for key in missing] + \
+            [ndb_context.memcache_get(NEGATIVE_CACHE_KEY % key, use_cache=False) for key in missing]
+        values, absents = found[:len(missing)], found[len(missing):]
+        elapsed = time.time() - start
+        not_found = []
+        manifests = []
+        for key, value, absent in zip(missing, values, absents):
+            if isinstance(value, ChunkedItem):
+                manifests.append([key, value])
+            elif value is not None:
+                cache_metrics.record_hit("memcache", get_metrics_namespace(key), elapsed,
+                                         len(value) if isinstance(value, str) else 0)
+                value, pickled_size = decode_memcache_value(value)
+                lru_cache.set(key, value, pickled_size)
+                results[key] = value
+            elif absent == KEY_ABSENT:
+                cache_metrics.record_hit("memcache", get_metrics_namespace(key), elapsed)
+                lru_cache.set(key, ABSENT, 0, NEGATIVE_LRU_CACHE_TIMEOUT)
+                results[key] = None
+            else:
+                cache_metrics.record_miss("memcache", get_metrics_namespace(key), elapsed)
+                not_found.append(key)
+        if manifests:
+            chunks_keys = [manifest.get_chunks_keys(key) for key, manifest in manifests]
+            chunks = yield [
+                ndb_context.memcache_get(chunk_key, use_cache=False)
+                for keys_of_item in chunks_keys
+                for chunk_key in keys_of_item
+            ]
+            offset = 0
+            for (key, manifest), keys_of_item in zip(manifests, chunks_keys):
+                item_chunks = chunks[offset:offset+len(keys_of_item)]
+                offset += len(keys_of_item)
+                if None in item_chunks:
+                    logging.warn("Ignoring chunked item on memcache because some chunks are missing :~")
+                    cache_metrics.record_miss("memcache", get_metrics_namespace(key), time.time() - start)
+                    not_found.append(key)
+                    continue
+                value = "".join(item_chunks)
+                cache_metrics.record_hit("memcache", get_metrics_namespace(key), time.time() - start, len(value))
+                value, pickled_size = decode_memcache_value(value)
+                lru_cache.set(key, value, pickled_size)
+                results[key] = value
+            del chunks
+        if log:
+            logging.debug("Found %d of %d items on memcache in %f seconds", len(missing) - len(not_found),
+                          len(missing), time.time()-start)
+        missing = not_found
+    if persistent and missing:
+        start = time.time()
+        filenames = yield map(get_gcs_filename, missing)
+        reads = run_in_parallel(read_from_gcs, [[filename] for filename in filenames])
+        futures = []
+        for key, read in zip(missing, reads):
             try:
-                size = len(value)
-                if size >= 1e6:
-                    value = zlib.compress(value, 9)
-                    if len(value) < 1e6:
-                        if log:
-                            logging.debug("Saving (large) item on memcached (it has %d bytes)..", size)
-                        yield ndb_context.memcache_set(key, value, CACHE_TIMEOUT)
-                    else:
-                        logging.warn("Ignoring large item because it does not fit on memcache :~")
-                else:
-                    if log:
-                        logging.debug("Saving (small) item on memcached (it has %d bytes)..", size)
-                    yield ndb_context.memcache_set(key, result, CACHE_TIMEOUT)
+                value = read.get_result()
             except:
-                pass
-            raise ndb.Return(result)
-        except Exception, e:
-            if isinstance(e, ndb.Return):
-                raise e
-            elif not isinstance(e, gcs.NotFoundError):
                 logging.exception("Error detected when getting from GCS")
+                cache_metrics.record_miss("gcs", get_metrics_namespace(key), time.time() - start)
+                continue
+            if value is None:
+                cache_metrics.record_miss("gcs", get_metrics_namespace(key), time.time() - start)
+                if log:
+                    logging.debug("Item not found on any tier, saving it on the negative cache")
+                lru_cache.set(key, ABSENT, 0, NEGATIVE_LRU_CACHE_TIMEOUT)
+                if memcache:
+                    futures.append(ndb_context.memcache_add(NEGATIVE_CACHE_KEY % key, KEY_ABSENT,
+                                                            NEGATIVE_CACHE_TIMEOUT))
+                continue
+            cache_metrics.record_hit("gcs", get_metrics_namespace(key), time.time() - start, len(value))
+            result, size = decode_value(value)
+            lru_cache.set(key, result, size)
+            results[key] = result
+            if memcache:
+                if not is_blob(value):
+                    value = encode_value(result)[0]
+                futures.extend(
+                    ndb_context.memcache_set(memcache_key, memcache_value, CACHE_TIMEOUT)
+                    for memcache_key, memcache_value in encode_memcache_value(key, value, log).iteritems()
+                )
+            del value
+        if log:
+            logging.debug("Read %d items from GCS in %f seconds", len(missing), time.time()-start)
+        try:
+            if futures:
+                yield futures
+        except:
+            pass
+    raise ndb.Return([results.get(key) for key in keys])
 
 
 def set(key, value, ttl=None):
@@ -248,48 +919,73 @@ def get(key):
 
 
 @ndb.tasklet
-def set_into_cache(key, value, persistent=True, memcache=True, log=True):
-    lru_cache[key] = value
-    pickled_value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
-    size = len(pickled_value)
-    if log:
-        logging.debug("The content saved to cache in the key '%s' has %d bytes", key, size)
-    if memcache:
-        try:
-            if size >= 1e6:
-                compressed_value = zlib.compress(pickled_value, 9)
-                if len(compressed_value) < 1e6:
-                    if log:
-                        logging.debug("Saving (large) item on memcached (it has %d bytes)..", size)
-                    yield ndb_context.memcache_set(key, compressed_value, CACHE_TIMEOUT)
-                else:
-                    logging.warn("Ignoring large item because it does not fit on memcache :~")
-            else:
-                if log:
-                    logging.debug("Saving (small) item on memcached")
-                yield ndb_context.memcache_set(key, value, CACHE_TIMEOUT)
-        except:
-            pass
-    if persistent:
-        try:
-            if log:
-                logging.debug("Saving item on GCS..")
-            filename = yield get_gcs_filename(key)
-            gcs_file = gcs.open(filename, 'w')
-            gcs_file.write(pickled_value)
-            gcs_file.close()
-            if log:
-                logging.debug("Saved item on GCS..")
-        except:
-            logging.exception("There is an error when saving to GCS, but okay :v")
-            pass
+def set_into_cache(key, value, persistent=True, memcache=True, log=True, codec=None, compressor=None):
+    yield set_many_into_cache({key: value}, persistent=persistent, memcache=memcache, log=log, codec=codec,
+                              compressor=compressor)
+
+
+@ndb.tasklet
+def set_many_into_cache(values, persistent=True, memcache=True, log=True, codec=None, compressor=None):
+    """
+    Save many values in the cache at once: the values are sent to memcache in a single batch and written to GCS in
+    parallel.
+
+    :param values: A dict with the values to save, indexed by key
+    :type values: dict
+    :param codec: The name of the codec used to serialize the values (see encode_value)
+    :type codec: str
+    :param compressor: The name of the compressor used to compress the values (see encode_value)
+    :type compressor: str
+    """
+    futures = []
+    blobs = {}
+    for key, value in values.iteritems():
+        blob, size = encode_value(value, codec, compressor)
+        lru_cache.set(key, value, size)
+        # Invalidates the negative cache (the LRU cache is invalidated by the line above)
+        futures.append(ndb_context.memcache_set(NEGATIVE_CACHE_KEY % key, KEY_PRESENT, NEGATIVE_CACHE_TIMEOUT))
+        if log:
+            logging.debug("The content saved to cache in the key '%s' has %d bytes", key, size)
+        if memcache:
+            # All the sets (including the chunks of large items) are sent in the same batch (a single set_multi)
+            futures.extend(
+                ndb_context.memcache_set(memcache_key, memcache_value, CACHE_TIMEOUT)
+                for memcache_key, memcache_value in encode_memcache_value(key, blob, log).iteritems()
+            )
+            cache_metrics.record_write("memcache", get_metrics_namespace(key), len(blob))
+        if persistent:
+            blobs[key] = blob
+            cache_metrics.record_write("gcs", get_metrics_namespace(key), len(blob))
+    if blobs:
+        if log:
+            logging.debug("Saving %d items on GCS..", len(blobs))
+        keys = blobs.keys()
+        filenames = yield map(get_gcs_filename, keys)
+        writes = run_in_parallel(
+            write_to_gcs,
+            [[filename, blobs[key]] for key, filename in zip(keys, filenames)]
+        )
+        for write in writes:
+            try:
+                write.get_result()
+            except:
+                logging.exception("There is an error when saving to GCS, but okay :v")
+        if log:
+            logging.debug("Saved items on GCS..")
+    try:
+        yield futures
+    except:
+        pass
 
 
 @ndb.tasklet
 def delete_from_cache(key, persistent=True):
     logging.debug("Deleting key '%s' from cache", key)
     lru_cache.pop(key, None)
-    yield ndb_context.memcache_delete(key, CACHE_TIMEOUT)
+    yield (
+        ndb_context.memcache_delete(key, CACHE_TIMEOUT),
+        ndb_context.memcache_delete(NEGATIVE_CACHE_KEY % key)
+    )
     if persistent:
         try:
             filename = yield get_gcs_filename(key)
@@ -299,7 +995,142 @@ def delete_from_cache(key, persistent=True):
             pass
 
 
-def clear_lru_cache():
-    logging.warning("Clearing %d items of the LRU Cache", len(lru_cache))
-    lru_cache.clear()
+@ndb.tasklet
+def get_generation(namespace):
+    """
+    Get the current generation of the namespace
+
+    :param namespace: The namespace
+    :type namespace: str
+    :return: The generation (0 if the namespace was never invalidated)
+    :rtype: ndb.Future
+    """
+    key = GENERATION_KEY % namespace
+    generation = lru_cache.get(key)
+    if generation is None:
+        generation = yield ndb_context.memcache_get(key, use_cache=False)
+        if generation is None:
+            # A namespace not found on memcache is in the generation 0, so the requests never wait for GCS. As memcache
+            # may lose the generation (and the data of older generations is not valid anymore), the generation saved
+            # on GCS is restored in background by the instance that initializes the generation on memcache
+            generation = 0
+            added = yield ndb_context.memcache_add(key, generation, CACHE_TIMEOUT)
+            if added:
+                filename = yield get_gcs_filename(key)
+                threaded(restore_generation)(key, filename)
+        lru_cache.set(key, generation, 0, GENERATION_LRU_TIMEOUT)
+    raise ndb.Return(generation)
+
+
+def restore_generation(key, filename):
+    """
+    Restore on memcache the generation saved on GCS, if it is newer than the generation on memcache
+
+    :param key: The key of the generation
+    :type key: str
+    :param filename: The name of the file of the generation on GCS
+    :type filename: str
+    """
+    try:
+        blob = read_from_gcs(filename)
+    except:
+        logging.exception("Error detected when getting generation from GCS")
+        return
+    generation = int(blob) if blob else 0
+    if not generation:
+        return
+    client = memcache_api.Client()
+    for _ in xrange(3):
+        current = client.gets(key)
+        if current is None:
+            if client.add(key, generation, CACHE_TIMEOUT):
+                break
+            continue
+        if current >= generation:
+            break
+        if client.cas(key, generation, CACHE_TIMEOUT):
+            logging.warning("Restored generation %d of the key '%s' (it was %d on memcache)", generation, key,
+                            current)
+            break
+
+
+@ndb.tasklet
+def set_generation(namespace, generation):
+    """
+    Publish a new generation of the namespace. Note that the data of the new generation should be saved before.
+
+    :param namespace: The namespace
+    :type namespace: str
+    :param generation: The new generation
+    :type generation: int
+    """
+    key = GENERATION_KEY % namespace
+    logging.debug("Moving namespace '%s' to generation %d", namespace, generation)
+    filename = yield get_gcs_filename(key)
+    write_to_gcs(filename, str(generation))
+    yield ndb_context.memcache_set(key, generation, CACHE_TIMEOUT)
+    lru_cache.set(key, generation, 0, GENERATION_LRU_TIMEOUT)
+
+
+def get_versioned_key(key, generation):
+    """
+    Get the key of the specified generation (the generation 0 uses the key itself)
+
+    :param key: The key
+    :type key: str
+    :param generation: The generation
+    :type generation: int
+    :return: The key of the generation
+    :rtype: str
+    """
+    if not generation:
+        return key
+    return "%s/v%d" % (key, generation)
+
+
+def enqueue_refresh(key, fn, filters, queue_name="frontend", **kwargs):
+    """
+    Enqueue (at most once each REFRESH_LOCK_TIMEOUT seconds for each key) a task that calls the decorated function
+    to refresh the value of the cache
+
+    :param key: The key that is refreshed
+    :type key: str
+    :param fn: The original (not decorated) function
+    :param filters: The filters to pass to the function
+    :param queue_name: The name of the queue of the task (see queue.yaml)
+    :type queue_name: str
+    :param kwargs: The keyword arguments to pass to the decorated function
+    :return: If the task was enqueued
+    :rtype: bool
+    """
+    locked = ndb_context.memcache_add(REFRESH_LOCK_KEY % key, 1, REFRESH_LOCK_TIMEOUT).get_result()
+    if not locked:
+        return False
+    logging.debug("Enqueuing refresh of the key '%s'", key)
+    try:
+        taskqueue.add(
+            url=REFRESH_URL,
+            method="POST",
+            queue_name=queue_name,
+            payload=json.dumps({
+                "module": fn.__module__,
+                "function": fn.__name__,
+                "filters": filters,
+                "kwargs": kwargs
+            })
+        )
+    except:
+        logging.exception("Error detected when enqueuing refresh of the key '%s'", key)
+        ndb_context.memcache_delete(REFRESH_LOCK_KEY % key).get_result()
+        return False
+    return True
+
+
+def clear_lru_cache(prefix=None):
+    if prefix is None:
+        logging.warning("Clearing %d items of the LRU Cache", len(lru_cache))
+        lru_cache.clear()
+    else:
+        logging.warning("Clearing items with prefix '%s' of the LRU Cache", prefix)
+        lru_cache.clear_prefix(prefix)
     gc_collect()
\ No newline at end of file
@@ -1,4 +1,5 @@
-from app.cache import get_from_cache, set_into_cache, delete_from_cache
+from app.cache import get_from_cache, set_into_cache, delete_from_cache, get_generation, set_generation, \
+    get_versioned_key, enqueue_refresh, RefreshableItem
 import logging as _logging
 import hashlib, json
 
@@ -9,37 +10,86 @@ __author__ = 'fernando'
 
 CACHE_CACHEABLE_KEY = "cache/functions/%s/%s"
 
-def cacheable(consider_only=None):
+
+def unwrap(value):
+    if isinstance(value, RefreshableItem):
+        return value.value
+    return value
+
+
+def cacheable(consider_only=None, soft_ttl=None, hard_ttl=None):
+    """
+    Cache the results of the function.
+
+    After soft_ttl seconds (if specified) the cached result is still returned, but a task is enqueued to refresh it in
+    background.
+    After hard_ttl seconds (if specified) the cached result is ignored and the function is called to get a new one.
+    """
     def decorator(fn):
         def dec(filters, **kwargs):
             if consider_only is not None and filters:
                 filters = {k: filters[k] for k in filters.iterkeys() if k in consider_only}
             filters_hash = hashlib.sha1(json.dumps(filters, sort_keys=True)).hexdigest()
-            cache_key = CACHE_CACHEABLE_KEY % (
+            namespace = CACHE_CACHEABLE_KEY % (
                 fn.__name__,
                 filters_hash
             )
+            generation = get_generation(namespace).get_result()
+            cache_key = get_versioned_key(namespace, generation)
             persistent = kwargs.get("persistent", True)
             if kwargs.get("overwrite"):
+                # The new value is saved in the next generation, so the instances with the old value in the LRU cache
+                # see the new value as soon as the generation is published
+                next_cache_key = get_versioned_key(namespace, generation + 1)
                 update_with = kwargs.get("update_with")
                 if update_with:
-                    result = get_from_cache(cache_key, persistent=persistent).get_result()
+                    result = unwrap(get_from_cache(cache_key, persistent=persistent).get_result())
                     if not result:
                         result = update_with
                     if type(result) == type(update_with):
                         logging.debug("Updating cache with passed in value")
-                        set_into_cache(cache_key, update_with, persistent=persistent).get_result()
+                        set_into_cache(
+                            next_cache_key,
+                            RefreshableItem(update_with, soft_ttl, hard_ttl),
+                            persistent=persistent
+                        ).get_result()
                     else:
                         raise Exception("Types differents: %s != %s" % (str(type(result)), str(type(update_with))))
                 elif kwargs.get("exclude"):
+                    set_generation(namespace, generation + 1).get_result()
                     return delete_from_cache(cache_key, persistent=persistent).get_result()
                 else:
                     result = None
-            else:
-                result = get_from_cache(cache_key, persistent=persistent).get_result()
+                if not result:
+                    result = fn(filters)
+                    set_into_cache(
+                        next_cache_key,
+                        RefreshableItem(result, soft_ttl, hard_ttl),
+                        persistent=persistent
+                    ).get_result()
+                set_generation(namespace, generation + 1).get_result()
+                if generation > 0:
+                    # The current generation may still be used by other instances for some seconds, but the previous
+                    # one is not used anymore
+                    delete_from_cache(get_versioned_key(namespace, generation - 1), persistent=persistent).get_result()
+                return result
+            result = get_from_cache(cache_key, persistent=persistent).get_result()
+            if isinstance(result, RefreshableItem):
+                if result.is_expired():
+                    logging.debug("Ignoring expired result of %s", fn.__name__)
+                    result = None
+                else:
+                    if result.needs_refresh():
+                        # Stale while revalidate: the stale result is returned while a task refreshes it
+                        enqueue_refresh(namespace, fn, filters, overwrite=True, persistent=persistent)
+                    result = result.value
             if not result:
                 result = fn(filters)
-                set_into_cache(cache_key, result, persistent=persistent).get_result()
+                set_into_cache(
+                    cache_key,
+                    RefreshableItem(result, soft_ttl, hard_ttl),
+                    persistent=persistent
+                ).get_result()
             return result
 
         dec.__name__ = fn.__name__
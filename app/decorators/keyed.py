@@ -0,0 +1,271 @@
+import hashlib
+import json
+import math
+import time
+import zlib
+import logging as _logging
+from google.appengine.ext import ndb
+from app.cache import get_from_cache, get_many_from_cache, set_many_into_cache, delete_from_cache, get_generation, \
+    set_generation, get_versioned_key, enqueue_refresh, RefreshableItem
+from app.decorators.searchable import remove_prefix, get_fingerprint, encode_cursor, decode_cursor
+from app.json_serializer import JSONEncoder
+
+__author__ = 'fernando'
+
+logging = _logging.getLogger("matrufsc2_keyed")
+logging.setLevel(_logging.WARNING)
+
+CACHE_KEYED_NAMESPACE = "cache/keyedStore/%s/%s"
+CACHE_KEYED_KEY = CACHE_KEYED_NAMESPACE + "/%s"
+# The records are distributed in buckets (by the hash of their ids) with about RECORDS_PER_BUCKET records each
+RECORDS_PER_BUCKET = 100
+
+
+class StoreManifest(object):
+    """
+    The description of the buckets of a store: the generation in which each bucket was saved (the buckets that are
+    not changed by an update are kept in their generations) and its number of records
+    """
+    __slots__ = ["generations", "counts", "replaced"]
+
+    def __init__(self, generations=None, counts=None, replaced=None):
+        self.generations = generations or []
+        self.counts = counts or []
+        # The keys of the buckets replaced when this manifest was published, deleted when the next one is published
+        self.replaced = replaced or []
+
+    def __getstate__(self):
+        return self.generations, self.counts, self.replaced
+
+    def __setstate__(self, state):
+        self.generations, self.counts, self.replaced = state
+
+    def get_count(self):
+        return sum(self.counts)
+
+
+def get_bucket(record_id, buckets_count):
+    if isinstance(record_id, unicode):
+        record_id = record_id.encode("utf-8")
+    return (zlib.crc32(record_id) & 0xffffffff) % buckets_count
+
+
+def keyed(prefix=None, consider_only=None, soft_ttl=None, fallback=None):
+    """
+    Save the records returned by the function (dicts with an id) in a store keyed by their ids.
+
+    The ids are passed in the query (q), separated by spaces, and all of them are fetched with a single batched read
+    of the buckets that contain them. Without a query, the records are returned in pages (by page or by cursor, as in
+    searchable).
+
+    The store is built (or updated, with update_with and exclude) only when authorized (with the overwrite keyword
+    argument). When it is older than soft_ttl seconds (if specified) a task is enqueued to rebuild it in background on
+    the robot. A missing store is not rebuilt by the reads, as the filters come from the users.
+
+    The fallback (if specified) is a decorator for the function that reads the records from where they were saved
+    before the store existed. While the store is not built, the reads are made by it (and, when it finds records, the
+    store is built in background).
+    """
+    if consider_only is None:
+        consider_only = []
+    consider_only.extend(["page", "limit", "q", "cursor"])
+    if prefix is None:
+        prefix = ""
+
+    def decorator(fn):
+        fallback_fn = fallback(fn) if fallback is not None else None
+
+        def dec(filters, **kwargs):
+            start_processing = time.time()
+            filters = {k: filters[k] for k in filters.iterkeys() if k in consider_only}
+            original_query = filters.pop("q", "")
+            page = int(filters.pop("page", 1))
+            limit = int(filters.pop("limit", 5))
+            cursor = filters.pop("cursor", None)
+            filters_hash = hashlib.sha1(json.dumps(filters, sort_keys=True)).hexdigest()
+            namespace = CACHE_KEYED_NAMESPACE % (fn.__name__, filters_hash)
+            generation = get_generation(namespace).get_result()
+            get_key = lambda kind, generation=generation: get_versioned_key(
+                CACHE_KEYED_KEY % (fn.__name__, filters_hash, kind),
+                generation
+            )
+            get_bucket_key = lambda bucket, generation: get_key("bucket/%d" % bucket, generation)
+            manifest = get_from_cache(get_key("manifest"), persistent=True).get_result()
+            if isinstance(manifest, RefreshableItem):
+                if manifest.is_expired():
+                    manifest = None
+                elif manifest.needs_refresh() and not kwargs.get("overwrite"):
+                    logging.debug("Store is stale, returning it while it is rebuilt")
+                    enqueue_refresh(namespace, fn, filters, queue_name="default", overwrite=True, index=True)
+            manifest = manifest.value if isinstance(manifest, RefreshableItem) else None
+
+            def load_buckets(buckets):
+                buckets = sorted(set(buckets))
+                keys = [get_bucket_key(bucket, manifest.generations[bucket]) for bucket in buckets]
+                values = get_many_from_cache(keys, persistent=True).get_result()
+                for bucket, value in zip(buckets, values):
+                    if value is None:
+                        logging.error("The bucket %d of the store '%s' was not found", bucket, namespace)
+                # The missing buckets are None
+                return dict(zip(buckets, values))
+
+            if manifest is None and fallback_fn is not None and not kwargs.get("overwrite"):
+                return read_fallback(fallback_fn, namespace, fn, filters, original_query, page, limit, cursor, prefix)
+
+            if kwargs.get("overwrite"):
+                start = time.time()
+                update_with = kwargs.get("update_with")
+                exclude = kwargs.get("exclude")
+                changed = None
+                if manifest is not None and manifest.counts and (update_with or exclude):
+                    logging.debug("Updating the store with %d records (and %d exclusions)..",
+                                  len(update_with or []), len(exclude or []))
+                    update_with = json.loads(JSONEncoder(separators=(',', ':')).encode(update_with or []))
+                    update_with = [record for record in update_with if record and isinstance(record, dict)]
+                    exclude = [remove_prefix(record_id, prefix) for record_id in exclude or []]
+                    for record in update_with:
+                        record["id"] = remove_prefix(record["id"], prefix)
+                    buckets_count = len(manifest.counts)
+                    changed = load_buckets(
+                        [get_bucket(record_id, buckets_count) for record_id in exclude] +
+                        [get_bucket(record["id"], buckets_count) for record in update_with]
+                    )
+                    if None in changed.itervalues():
+                        # The records of a missing bucket would be lost by the update
+                        logging.warn("Buckets of the store not found, so it is built again instead of updated")
+                        changed = None
+                    else:
+                        changed = dict((bucket, dict(records)) for bucket, records in changed.iteritems())
+                        for record_id in exclude:
+                            changed[get_bucket(record_id, buckets_count)].pop(record_id, None)
+                        for record in update_with:
+                            changed[get_bucket(record["id"], buckets_count)][record["id"]] = record
+                        new_manifest = StoreManifest(list(manifest.generations), list(manifest.counts))
+                if changed is None:
+                    logging.debug("Creating the store..")
+                    records = json.loads(JSONEncoder(separators=(',', ':')).encode(fn(filters)))
+                    records = [record for record in records if record and isinstance(record, dict)]
+                    exclude = set(remove_prefix(record_id, prefix) for record_id in kwargs.get("exclude") or [])
+                    buckets_count = max(1, int(math.ceil(float(len(records)) / RECORDS_PER_BUCKET)))
+                    changed = dict((bucket, {}) for bucket in xrange(buckets_count))
+                    for record in records:
+                        record["id"] = remove_prefix(record["id"], prefix)
+                        if record["id"] not in exclude:
+                            changed[get_bucket(record["id"], buckets_count)][record["id"]] = record
+                    new_manifest = StoreManifest([0] * buckets_count, [0] * buckets_count)
+                if manifest is not None:
+                    new_manifest.replaced = [
+                        get_bucket_key(bucket, bucket_generation)
+                        for bucket, bucket_generation in enumerate(manifest.generations)
+                        if bucket in changed or len(manifest.counts) != len(new_manifest.counts)
+                    ]
+                values = {}
+                for bucket, records in changed.iteritems():
+                    new_manifest.generations[bucket] = generation + 1
+                    new_manifest.counts[bucket] = len(records)
+                    values[get_bucket_key(bucket, generation + 1)] = records
+                values[get_key("manifest", generation + 1)] = RefreshableItem(new_manifest, soft_ttl)
+                set_many_into_cache(values, persistent=True).get_result()
+                set_generation(namespace, generation + 1).get_result()
+                # The buckets replaced by the previous manifest (and the manifest before it) are not used anymore
+                obsolete = list(manifest.replaced) if manifest is not None else []
+                if generation > 0:
+                    obsolete.append(get_key("manifest", generation - 1))
+                ndb.Future.wait_all([delete_from_cache(key, persistent=True) for key in obsolete])
+                logging.debug("Store saved with %d records (in %d buckets, %d changed) in %f seconds",
+                              new_manifest.get_count(), len(new_manifest.counts), len(changed), time.time() - start)
+                manifest = new_manifest
+            elif manifest is None:
+                logging.warn("Store not found and not authorized :v")
+            if manifest is None:
+                manifest = StoreManifest()
+            ids = [remove_prefix(record_id, prefix) for record_id in original_query.split()]
+            next_cursor = None
+            if ids and manifest.counts:
+                buckets_count = len(manifest.counts)
+                buckets = load_buckets([get_bucket(record_id, buckets_count) for record_id in ids])
+                results = [(buckets[get_bucket(record_id, buckets_count)] or {}).get(record_id) for record_id in ids]
+                results = [record for record in results if record is not None]
+            elif ids:
+                results = []
+            else:
+                fingerprint = get_fingerprint(filters_hash, [])
+                page_start = (page - 1) * limit
+                if cursor:
+                    position = decode_cursor(cursor, fingerprint)
+                    if position is not None:
+                        page_start = position
+                page_end = page_start + limit
+                # The records are listed in the order of the buckets (and of the ids in each bucket)
+                needed = []
+                first = 0
+                for bucket, count in enumerate(manifest.counts):
+                    if first < page_end and first + count > page_start:
+                        needed.append((bucket, first))
+                    first += count
+                buckets = load_buckets([bucket for bucket, _ in needed])
+                results = []
+                for bucket, first in needed:
+                    records = buckets[bucket] or {}
+                    for record_id in sorted(records)[max(page_start - first, 0):page_end - first]:
+                        results.append(records[record_id])
+                if page_end < manifest.get_count():
+                    next_cursor = encode_cursor(fingerprint, page_end)
+            results = {
+                "more": next_cursor is not None,
+                "results": results,
+                "id_prefix": prefix,
+                "prefetch": False,
+                "suggestions": [],
+                "query": original_query if original_query else None,
+                "next_cursor": next_cursor
+            }
+            logging.debug("Found %d records (in a total of %d records) in %f seconds", len(results["results"]),
+                          manifest.get_count(), time.time() - start_processing)
+            return results
+
+        dec.__name__ = fn.__name__
+        dec.__doc__ = fn.__doc__
+        return dec
+
+    return decorator
+
+
+def read_fallback(fallback_fn, namespace, fn, filters, query, page, limit, cursor, prefix):
+    """
+    Read the records with the fallback of a store that is not built yet, building the store in background when
+    records are found (so the filters that find nothing, as the ones of campi that do not exist, build nothing)
+
+    :param fallback_fn: The function decorated with the fallback
+    :param namespace: The namespace of the store
+    :type namespace: str
+    :param fn: The original (not decorated) function
+    :param filters: The filters (without the query and the paging)
+    :type filters: dict
+    :return: The results, as returned by the store
+    :rtype: dict
+    """
+    logging.warn("Store '%s' not found, so the records are read with the fallback", namespace)
+    ids = query.split()
+    if ids:
+        # The fallback may not find many records at once, so each one is read on its own
+        results = []
+        for record_id in ids:
+            results.extend(fallback_fn(dict(filters, q=record_id))["results"])
+        results = {
+            "more": False,
+            "results": results,
+            "id_prefix": prefix,
+            "prefetch": False,
+            "suggestions": [],
+            "query": query,
+            "next_cursor": None
+        }
+    else:
+        paging = {"page": page, "limit": limit}
+        if cursor:
+            paging["cursor"] = cursor
+        results = fallback_fn(dict(filters, **paging))
+    if results["results"]:
+        enqueue_refresh(namespace, fn, filters, queue_name="default", overwrite=True, index=True)
+    return results
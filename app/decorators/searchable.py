@@ -1,13 +1,22 @@
+import base64
 import json
+import threading
 import time
+import cloudstorage as gcs
 from google.appengine.ext import ndb
-from app.cache import get_from_cache, set_into_cache, clear_lru_cache, gc_collect
+from array import array
+from app.cache import get_from_cache, get_many_from_cache, set_many_into_cache, \
+    delete_from_cache, clear_lru_cache, get_generation, set_generation, get_versioned_key, \
+    enqueue_refresh, RefreshableItem, LRUCache, get_gcs_filename, write_to_gcs, lru_cache, ABSENT, \
+    IN_FLIGHT_TIMEOUT, NEGATIVE_LRU_CACHE_TIMEOUT
 from app.json_serializer import JSONEncoder
-from app.support.combinations import combinations
-from app.support.islice import islice
-from app.support.intersect import intersect
+from app.support.combinations import combinations, best_combinations
+from app.support.index_file import dump_index, load_index_file
+from app.support.intersect import intersect_all
 from app.support.sift3 import sift3
-from app.support.Trie import Trie
+from app.support.ngrams import build_ngrams_index, get_candidates, get_ngrams
+from app.support.ranking import get_features, rank
+from app.support.Trie import Trie, POSTINGS_TYPECODE
 from collections import defaultdict
 import logging as _logging
 import hashlib, itertools, pprint
@@ -18,13 +27,635 @@ __author__ = 'fernando'
 logging = _logging.getLogger("matrufsc2_searchable")
 logging.setLevel(_logging.WARNING)
 
-CACHE_INDEX_KEY = "cache/searchIndex/%s/%s/%s"
+CACHE_INDEX_PREFIX = "cache/searchIndex/"
+CACHE_INDEX_NAMESPACE = CACHE_INDEX_PREFIX + "%s/%s"
+CACHE_INDEX_KEY = CACHE_INDEX_NAMESPACE + "/%s"
+# The kinds of the keys saved in the generation in which the index is built (the items and the features are saved in
+# shards, see ItemsManifest, and the features were saved in a single key before)
+CACHE_INDEX_KINDS = ["index", "words", "ngrams", "features", "file"]
+# The indexes of words may be saved also as index files, loaded once by each instance (see get_index_file)
+INDEX_BACKEND_FILE = "file"
+# Words with a distance (see sift3) up to SUGGESTION_MAX_DISTANCE are suggested, and at most SUGGESTION_CANDIDATES
+# words (the ones that share more n-grams with the unknown word) are compared with it
+SUGGESTION_MAX_DISTANCE = 3
+SUGGESTION_CANDIDATES = 500
+# Maximum number of combinations of suggestions tried and maximum time (in seconds) used to try them, shared equally
+# by the numbers of words of the combinations
+SUGGESTION_MAX_COMBINATIONS = 2000
+SUGGESTION_TIME_BUDGET = 0.5
+# When a search has up to PREFETCH_SIZE results, all of them are returned (so the next pages are made by the client)
+PREFETCH_SIZE = 40
+# The sorted results (positions of the items) of the last queries are kept in memory, for all the pages of a query
+QUERY_CACHE_CAPACITY = 2000
+QUERY_CACHE_MAX_SIZE = 8 * 1024 * 1024
+QUERY_CACHE_EXPIRATION = 600
+# Number of hexadecimal digits of the hash of the query saved in the cursors
+CURSOR_FINGERPRINT_LENGTH = 16
 
+query_cache = LRUCache()
+query_cache.set_capacity(QUERY_CACHE_CAPACITY)
+query_cache.set_max_size(QUERY_CACHE_MAX_SIZE)
+query_cache.set_expiration(QUERY_CACHE_EXPIRATION)
 
-def searchable(get_formatted_string, prefix=None, consider_only=None, min_word_length=1):
+# The items of an index are saved in shards with ITEMS_SHARD_SIZE items (the item in the position p is the item
+# p % ITEMS_SHARD_SIZE of the shard p // ITEMS_SHARD_SIZE), so a page loads only the shards of its items
+ITEMS_SHARD_SIZE = 100
+# The updates are saved as the positions added to and removed from the lists of the changed words (see IndexDelta),
+# and the index is built again when more than INDEX_DELTA_MAX_POSTINGS positions were changed since it was built
+INDEX_DELTA_MAX_POSTINGS = 10000
+# The shards are encoded and saved in batches of SAVE_BATCH_SIZE shards (see save_in_batches)
+SAVE_BATCH_SIZE = 20
+
+# The index files being loaded by this instance (by key), so each one is loaded by one thread at once
+index_files = {}
+index_files_lock = threading.Lock()
+
+
+def remove_prefix(item_id, prefix):
+    if prefix and item_id.startswith(prefix):
+        return item_id[len(prefix):]
+    return item_id
+
+
+def get_item_words(item, get_formatted_string, min_word_length):
+    """
+    Get the words under which the item is indexed
+
+    :param item: The item
+    :type item: dict
+    :param get_formatted_string: The function that returns the text of the item
+    :param min_word_length: The minimum length of the words
+    :type min_word_length: int
+    :return: The words
+    :rtype: set
+    """
+    words = set()
+    for word in get_formatted_string(item).lower().split():
+        for token in ["".join(filter(unicode.isalnum, word)), "".join(filter(unicode.isdigit, word))]:
+            if len(token) >= min_word_length:
+                words.add(token)
+    return words
+
+
+def consume(values):
+    """
+    Iterate over the values, removing each one from the list (if it is a list) before it is returned
+
+    :param values: The values
+    :return: The values, in order
+    :rtype: generator
+    """
+    if not isinstance(values, list):
+        for value in values:
+            yield value
+        return
+    # The values are removed from the end of the list, that is cheap
+    values.reverse()
+    while values:
+        yield values.pop()
+
+
+def iter_items(models, prefix, exclude=None):
+    """
+    Convert the models (or any JSON serializable values) to plain dicts, one at a time, so the catalog is never
+    encoded in JSON at once
+
+    :param models: The models returned by the decorated function (a list, that is emptied while it is converted so each
+    model is released once converted, or any other iterable, as a generator)
+    :param prefix: The prefix removed from the ids
+    :type prefix: str
+    :param exclude: The ids (with or without prefix) of the items to skip
+    :type exclude: list
+    :return: The items, as dicts
+    :rtype: generator
+    """
+    encoder = JSONEncoder(separators=(',', ':'))
+    exclude = set(remove_prefix(item_id, prefix) for item_id in exclude or [])
+    for model in consume(models):
+        item = json.loads(encoder.encode(model))
+        if not item or not isinstance(item, dict):
+            continue
+        item["id"] = remove_prefix(item["id"], prefix)
+        if item["id"] not in exclude:
+            yield item
+
+
+def iter_postings(items, get_formatted_string, min_word_length):
+    """
+    Get the pairs of word and position of each item, in the order of the items (so the list of positions of each word
+    is built already sorted)
+
+    :param items: The items
+    :param get_formatted_string: The function that returns the text of the item
+    :param min_word_length: The minimum length of the words
+    :type min_word_length: int
+    :return: The pairs of word and position
+    :rtype: generator
+    """
+    for position, item in enumerate(items):
+        for word in get_item_words(item, get_formatted_string, min_word_length):
+            yield word, position
+
+
+def build_index(items, get_formatted_string, min_word_length):
+    """
+    Build the index in a single pass over the items, keeping only the items (the first one of each id) and their
+    features
+
+    :param items: The items (as returned by iter_items)
+    :param get_formatted_string: The function that returns the text of the item
+    :param min_word_length: The minimum length of the words
+    :type min_word_length: int
+    :return: The index, the items and their features (None when min_word_length is not 1)
+    :rtype: tuple
+    """
+    kept = []
+    features = [] if min_word_length == 1 else None
+
+    def keep(items):
+        items_ids = set()
+        for item in items:
+            if item["id"] in items_ids:
+                logging.debug("The item '%s' already exists! Ignoring..", item["id"])
+                continue
+            items_ids.add(item["id"])
+            kept.append(item)
+            if features is not None:
+                features.append(get_features(get_formatted_string(item)))
+            yield item
+
+    index = Trie() if min_word_length == 1 else defaultdict(list)
+    for word, position in iter_postings(keep(items), get_formatted_string, min_word_length):
+        index[word].append(position)
+    if min_word_length == 1:
+        # The lists of ids are saved in a single array (see Trie.compact)
+        index.compact()
+    else:
+        index = dict(index)
+    return index, kept, features
+
+
+def encode_cursor(fingerprint, position):
+    """
+    Get the cursor of a position of the results of a query
+
+    :param fingerprint: The fingerprint of the query (see get_fingerprint)
+    :type fingerprint: str
+    :param position: The position of the first result of the page
+    :type position: int
+    :return: The cursor (an opaque string)
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode("%s:%d" % (fingerprint, position))
+
+
+def decode_cursor(cursor, fingerprint):
+    """
+    Get the position saved in the cursor
+
+    :param cursor: The cursor (as returned by encode_cursor)
+    :type cursor: basestring
+    :param fingerprint: The fingerprint of the query the cursor should belong to
+    :type fingerprint: str
+    :return: The position, or None if the cursor is invalid or belongs to another query
+    :rtype: int
+    """
+    try:
+        cursor_fingerprint, position = base64.urlsafe_b64decode(str(cursor)).split(":")
+        position = int(position)
+    except (TypeError, ValueError):
+        return None
+    if cursor_fingerprint != fingerprint or position < 0:
+        return None
+    return position
+
+
+def get_fingerprint(filters_hash, query_words):
+    return hashlib.sha1("%s:%s" % (filters_hash, " ".join(query_words))).hexdigest()[:CURSOR_FINGERPRINT_LENGTH]
+
+
+class ItemsManifest(object):
+    """
+    Saved (instead of the list of items) in the key of the items: the description of the shards of the items (and of
+    their features), with the generation in which each shard was saved (the shards that are not changed by an update
+    are kept in their generations), and of the index, with the changes made to it by the updates
+    """
+    __slots__ = ["count", "shard_size", "generations", "index_generation", "delta", "replaced"]
+
+    def __init__(self, count, shard_size, generation=0):
+        self.count = count
+        self.shard_size = shard_size
+        self.generations = [generation] * self.get_shards_count()
+        self.index_generation = generation
+        # The positions added to and removed from the list of each word changed since the index was built
+        self.delta = {}
+        # The keys replaced when this manifest was published, deleted when the next one is published
+        self.replaced = []
+
+    def __getstate__(self):
+        return self.count, self.shard_size, self.generations, self.index_generation, self.delta, self.replaced
+
+    def __setstate__(self, state):
+        if len(state) == 2:
+            # Saved before the shards had generations (everything is in the generation of the manifest)
+            state = tuple(state) + (None, None, {}, [])
+        self.count, self.shard_size, self.generations, self.index_generation, self.delta, self.replaced = state
+
+    def get_shards_count(self):
+        return (self.count + self.shard_size - 1) // self.shard_size
+
+    def get_delta_size(self):
+        return sum(len(added) + len(removed) for added, removed in self.delta.itervalues())
+
+    def is_indexed(self):
+        """
+        Check if the items were not changed since the index was built
+        """
+        return not self.delta and all(generation <= self.index_generation for generation in self.generations)
+
+
+class ShardedItems(object):
+    """
+    The items saved in shards, loaded (with batched reads of the cache) only when used
+    """
+
+    def __init__(self, manifest, get_shard_key):
+        self.manifest = manifest
+        self.get_shard_key = get_shard_key
+        self.shards = {}
+
+    def __len__(self):
+        return self.manifest.count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.manifest.count:
+            raise IndexError("Item %d not found" % position)
+        shard = self.shards.get(position // self.manifest.shard_size)
+        if shard is not None and position % self.manifest.shard_size < len(shard):
+            return shard[position % self.manifest.shard_size]
+        result = self.get_many([position])
+        if not result:
+            raise IndexError("Item %d not found (its shard is missing)" % position)
+        return result[0]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def load_shards(self, shards):
+        missing = sorted(set(shards).difference(self.shards))
+        if not missing:
+            return
+        values = get_many_from_cache([self.get_shard_key(shard) for shard in missing], persistent=True).get_result()
+        for shard, value in zip(missing, values):
+            if value is None:
+                logging.error("The shard %d of the items was not found", shard)
+                value = []
+            self.shards[shard] = value
+
+    def get_many(self, positions):
+        """
+        Get the items in the positions, loading all the shards needed at once
+
+        :param positions: The positions of the items
+        :type positions: list
+        :return: The items (the ones of missing shards are ignored)
+        :rtype: list
+        """
+        shard_size = self.manifest.shard_size
+        self.load_shards([position // shard_size for position in positions])
+        result = []
+        for position in positions:
+            shard = self.shards[position // shard_size]
+            if position % shard_size < len(shard):
+                result.append(shard[position % shard_size])
+        return result
+
+    def tolist(self):
+        return self.get_many(range(self.manifest.count))
+
+
+class IndexDelta(object):
+    """
+    The index with the changes made by the updates since it was built (the positions added to and removed from the
+    lists of the changed words, see merge_delta). It has the interface of the index used by the searches.
+    """
+    __slots__ = ["index", "delta"]
+
+    def __init__(self, index, delta):
+        self.index = index
+        self.delta = delta
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, word):
+        return self.get(word, [])
+
+    def get(self, word, d=None):
+        ids = self.index.get(word, [])
+        changes = self.delta.get(word)
+        if changes is not None:
+            added, removed = changes
+            ids = sorted(set(ids).union(added).difference(removed))
+        return ids if len(ids) else d
+
+    def get_new_words(self):
+        """
+        Get the words added by the updates (the words of the changes that are not in the index), that are not in the
+        words saved with the index (used by the suggestions)
+
+        :return: The words
+        :rtype: list
+        """
+        return sorted(
+            word for word, (added, removed) in self.delta.iteritems() if len(added) and self.index.find(word) is None
+        )
+
+    def get_list(self, item):
+        """
+        Get the ids of all the words starting with the prefix (the index should be compacted)
+
+        :param item: The prefix
+        :type item: basestring
+        :return: The ids, sorted and without duplicates
+        :rtype: list
+        """
+        changed = [word for word in self.delta if word.startswith(item)]
+        if not changed:
+            return self.index.get_list(item)
+        start, end = self.index.get_prefix_range(item)
+        skipped = sorted(position for position in map(self.index.find, changed) if position is not None)
+        ids = set()
+        # The lists of the words that were not changed are read as slices between the changed ones
+        for position in skipped + [end]:
+            ids.update(self.index.get_postings(start, position))
+            start = position + 1
+        for word in changed:
+            ids.update(self.get(word, []))
+        return sorted(ids)
+
+
+def open_items(value, get_shard_key):
+    """
+    Get the items saved in the key of the items (a list, or the manifest of the shards)
+
+    :param value: The value of the key of the items
+    :param get_shard_key: The function that returns the key of each shard
+    :return: The items (or None if they are not found)
+    """
+    if isinstance(value, ItemsManifest):
+        return ShardedItems(value, get_shard_key)
+    return value
+
+
+def get_items(items, positions):
+    """
+    Get the items in the positions
+
+    :param items: The items (a list or a sequence returned by open_items or by an index file)
+    :param positions: The positions of the items
+    :type positions: list
+    :return: The items
+    :rtype: list
+    """
+    if isinstance(items, ShardedItems):
+        return items.get_many(positions)
+    return map(items.__getitem__, positions)
+
+
+def iter_shards(values, get_shard_key, shard_size=ITEMS_SHARD_SIZE):
+    """
+    Split the values (the items or their features) in shards, one at a time
+
+    :param values: The values
+    :type values: list
+    :param get_shard_key: The function that returns the key of each shard
+    :param shard_size: The number of values of each shard
+    :type shard_size: int
+    :return: The pairs of key and shard
+    :rtype: generator
+    """
+    for shard in xrange((len(values) + shard_size - 1) // shard_size):
+        yield get_shard_key(shard), values[shard * shard_size:(shard + 1) * shard_size]
+
+
+def iter_index_values(index, get_key, soft_ttl, min_word_length):
+    """
+    Get the values saved with the index (the index, its words and the index of n-grams of its words), one at a time
+
+    :param index: The index
+    :param get_key: The function that returns the key of each kind of value
+    :param soft_ttl: The soft TTL of the index
+    :type soft_ttl: int
+    :param min_word_length: The minimum length of the words
+    :type min_word_length: int
+    :return: The pairs of key and value
+    :rtype: generator
+    """
+    yield get_key("index"), RefreshableItem(index, soft_ttl)
+    if min_word_length == 1:
+        words = index.get_words()
+        yield get_key("words"), words
+        yield get_key("ngrams"), build_ngrams_index(words)
+
+
+def save_in_batches(values, batch_size=None):
+    """
+    Save the values in batches, so only the values of a batch are encoded (and kept encoded in memory) at once
+
+    :param values: The pairs of key and value (that may be produced one at a time)
+    :param batch_size: The number of values of each batch (SAVE_BATCH_SIZE by default)
+    :type batch_size: int
+    """
+    if batch_size is None:
+        batch_size = SAVE_BATCH_SIZE
+    batch = {}
+    for key, value in values:
+        batch[key] = value
+        if len(batch) >= batch_size:
+            set_many_into_cache(batch, persistent=True).get_result()
+            batch = {}
+    if batch:
+        set_many_into_cache(batch, persistent=True).get_result()
+
+
+def get_index_file(key):
+    """
+    Get the index file saved on GCS with the key. It is kept on the LRU cache (accounted by its size), and it is loaded
+    by only one thread of the instance at once (the other threads wait for it).
+
+    :param key: The key of the index file
+    :type key: str
+    :return: The index file, or None if it does not exist
+    :rtype: app.support.index_file.IndexFile
+    """
+    index_file = lru_cache.get(key)
+    if index_file is not None:
+        return None if index_file is ABSENT else index_file
+    with index_files_lock:
+        loading = index_files.get(key)
+        leader = loading is None
+        if leader:
+            loading = index_files[key] = threading.Event()
+    if not leader:
+        logging.debug("Waiting for the index file '%s' loaded by another thread", key)
+        if loading.wait(IN_FLIGHT_TIMEOUT):
+            index_file = lru_cache.get(key)
+            if index_file is not None:
+                return None if index_file is ABSENT else index_file
+        logging.warn("Index file '%s' not loaded by the other thread, so it is loaded again", key)
+    try:
+        filename = get_gcs_filename(key).get_result()
+        try:
+            gcs_file = gcs.open(filename, "r")
+        except gcs.NotFoundError:
+            logging.debug("Index file '%s' not found", key)
+            index_file = None
+            lru_cache.set(key, ABSENT, 0, NEGATIVE_LRU_CACHE_TIMEOUT)
+        else:
+            try:
+                index_file = load_index_file(gcs_file, key)
+            finally:
+                gcs_file.close()
+            lru_cache.set(key, index_file, len(index_file.buffer))
+    finally:
+        if leader:
+            with index_files_lock:
+                index_files.pop(key, None)
+            loading.set()
+    return index_file
+
+
+def is_valid_index(index, min_word_length):
+    if min_word_length == 1:
+        return isinstance(index, Trie) and not hasattr(index, "nodes")
+    return isinstance(index, dict)
+
+
+def update_index(items, update_with, exclude, get_formatted_string, prefix, min_word_length):
+    """
+    Apply the changes to the items, getting the positions added to and removed from the lists of the words of the
+    added, changed and removed items. Each removed item is replaced by the last item, so the positions of the other
+    items are kept.
+
+    :param items: The indexed items (that are changed)
+    :type items: list
+    :param update_with: The items to add or to replace (the ones with the same id)
+    :type update_with: list
+    :param exclude: The ids of the items to remove
+    :type exclude: list
+    :return: The positions added to the list of each word, the positions removed from the list of each word and the
+    positions of the changed items (including the removed ones)
+    :rtype: tuple
+    """
+    positions = {}
+    for position, item in enumerate(items):
+        positions.setdefault(item["id"], position)
+    added = defaultdict(set)
+    removed = defaultdict(set)
+    changed = set()
+
+    def add(words, position):
+        for word in words:
+            if position in removed[word]:
+                removed[word].discard(position)
+            else:
+                added[word].add(position)
+
+    def remove(words, position):
+        for word in words:
+            if position in added[word]:
+                added[word].discard(position)
+            else:
+                removed[word].add(position)
+
+    get_words = lambda item: get_item_words(item, get_formatted_string, min_word_length)
+    for item_id in exclude:
+        position = positions.pop(remove_prefix(item_id, prefix), None)
+        if position is None:
+            continue
+        remove(get_words(items[position]), position)
+        last = len(items) - 1
+        if position != last:
+            moved = items[last]
+            moved_words = get_words(moved)
+            remove(moved_words, last)
+            add(moved_words, position)
+            items[position] = moved
+            if positions.get(moved["id"]) == last:
+                positions[moved["id"]] = position
+        items.pop()
+        changed.update([position, last])
+    for item in update_with:
+        if not item or not isinstance(item, dict):
+            continue
+        item["id"] = remove_prefix(item["id"], prefix)
+        position = positions.get(item["id"])
+        if position is None:
+            positions[item["id"]] = position = len(items)
+            items.append(item)
+            add(get_words(item), position)
+        else:
+            old_words = get_words(items[position])
+            new_words = get_words(item)
+            remove(old_words - new_words, position)
+            add(new_words - old_words, position)
+            items[position] = item
+        changed.add(position)
+    added = dict((word, ids) for word, ids in added.iteritems() if ids)
+    removed = dict((word, ids) for word, ids in removed.iteritems() if ids)
+    return added, removed, changed
+
+
+def merge_delta(index, delta, added, removed):
+    """
+    Merge the changes of an update with the changes made to the index since it was built, keeping only the positions
+    added that are not in the lists of the index and the positions removed that are in them
+
+    :param index: The index (as built)
+    :param delta: The positions added to and removed from the list of each word since the index was built
+    :type delta: dict
+    :param added: The positions added to the list of each word by the update
+    :type added: dict
+    :param removed: The positions removed from the list of each word by the update
+    :type removed: dict
+    :return: The new delta (the one received is not changed)
+    :rtype: dict
+    """
+    delta = dict(delta)
+    for word in set(added).union(removed):
+        indexed = set(index.get(word, []))
+        word_added, word_removed = delta.get(word, ((), ()))
+        word_added = set(word_added).union(added.get(word, set()) - indexed).difference(removed.get(word, ()))
+        word_removed = set(word_removed).union(removed.get(word, set()) & indexed).difference(added.get(word, ()))
+        if word_added or word_removed:
+            delta[word] = (array(POSTINGS_TYPECODE, sorted(word_added)), array(POSTINGS_TYPECODE, sorted(word_removed)))
+        else:
+            delta.pop(word, None)
+    return delta
+
+
+def searchable(get_formatted_string, prefix=None, consider_only=None, min_word_length=1, soft_ttl=None,
+               index_backend=None):
+    """
+    Index the results of the function to allow searches on them.
+
+    The index is built only when authorized (with the index keyword argument). When it is older than soft_ttl seconds
+    (if specified) a task is enqueued to rebuild it in background on the robot. A missing index is not rebuilt by the
+    searches, as the filters come from the users.
+
+    The pages may be requested by number (page and limit) or by the cursor (and limit) returned as next_cursor with
+    the previous page, which is sliced from the cached results of the query.
+
+    With index_backend INDEX_BACKEND_FILE, the index of words is saved on GCS also as an index file (see
+    app.support.index_file), that is used by the searches instead of the pickled index and items.
+
+    When each letter is indexed (min_word_length is 1) the results are sorted by relevance (see app.support.ranking),
+    and the first word of the formatted string of each item is considered its code.
+    """
     if consider_only is None:
         consider_only = []
-    consider_only.extend(["page", "limit", "q"])
+    consider_only.extend(["page", "limit", "q", "cursor"])
     if prefix is None:
         prefix = ""
 
@@ -36,348 +667,462 @@ def searchable(get_formatted_string, prefix=None, consider_only=None, min_word_l
             query = unidecode(unicode(original_query)).lower()
             page = int(filters.pop("page", 1))
             limit = int(filters.pop("limit", 5))
+            cursor = filters.pop("cursor", None)
             page_start = (page - 1) * limit
-            page_end = page * limit
             filters_hash = hashlib.sha1(json.dumps(filters, sort_keys=True)).hexdigest()
-            items_key = CACHE_INDEX_KEY % (
+            namespace = CACHE_INDEX_NAMESPACE % (
                 fn.__name__,
-                filters_hash,
-                "items"
+                filters_hash
+            )
+            generation = get_generation(namespace).get_result()
+            get_key = lambda kind, generation=generation: get_versioned_key(
+                CACHE_INDEX_KEY % (fn.__name__, filters_hash, kind),
+                generation
             )
+            items_key = get_key("items")
+            get_shard_key = lambda shard, generation=generation: get_key("items/%d" % shard, generation)
+            get_features_key = lambda shard, generation: get_key("features/%d" % shard, generation)
+
+            def open_shards(manifest, get_shard_key):
+                return ShardedItems(manifest, lambda shard: get_shard_key(shard, manifest.generations[shard]))
+
+            def get_index_keys(manifest, generation):
+                """
+                Get the keys of the index described by the manifest (saved in the key of the items in the generation)
+                """
+                if isinstance(manifest, ItemsManifest) and manifest.generations is not None:
+                    keys = [get_key(kind, manifest.index_generation) for kind in CACHE_INDEX_KINDS]
+                    generations = manifest.generations
+                else:
+                    # Saved before the shards had generations, so everything is in the generation
+                    keys = [get_key(kind, generation) for kind in CACHE_INDEX_KINDS]
+                    generations = [generation] * (
+                        manifest.get_shards_count() if isinstance(manifest, ItemsManifest) else 0
+                    )
+                for shard, shard_generation in enumerate(generations):
+                    keys.extend([get_shard_key(shard, shard_generation), get_features_key(shard, shard_generation)])
+                return keys
+
+            def publish(values, previous):
+                """
+                Save the values (the manifest) and publish the next generation, deleting the keys that are not used
+                anymore
+                """
+                set_many_into_cache(values, persistent=True).get_result()
+                set_generation(namespace, generation + 1).get_result()
+                if isinstance(previous, ItemsManifest) and previous.generations is not None:
+                    # The keys replaced by the previous manifest (and the manifest before it) are not used anymore
+                    obsolete = list(previous.replaced)
+                elif generation > 0:
+                    # The previous generation is not used anymore
+                    obsolete = get_index_keys(
+                        get_from_cache(get_key("items", generation - 1), persistent=True).get_result(),
+                        generation - 1
+                    )
+                else:
+                    obsolete = []
+                if generation > 0:
+                    obsolete.append(get_key("items", generation - 1))
+                ndb.Future.wait_all([delete_from_cache(key, persistent=True) for key in obsolete])
+
             query_words = filter(None, map(lambda word: "".join(filter(str.isalnum, word)), query.split()))
+            fingerprint = get_fingerprint(filters_hash, query_words)
+            if cursor:
+                position = decode_cursor(cursor, fingerprint)
+                if position is None:
+                    logging.warning("Ignoring invalid cursor '%s'", cursor)
+                else:
+                    page_start = position
+            page_end = page_start + limit
+            next_cursor = None
             if query_words:
                 logging.debug("Doing search based on query '%s'..", query)
-                index_key = CACHE_INDEX_KEY % (
-                    fn.__name__,
-                    filters_hash,
-                    "index"
-                )
-                words_key = CACHE_INDEX_KEY % (
-                    fn.__name__,
-                    filters_hash,
-                    "words"
-                )
-                if kwargs.get("overwrite"):
-                    index, items = None, None
-                    update_with = kwargs.get("update_with")
-                    if update_with:
-                        logging.debug("Detected instruction to update items list..okay")
-                        old_items = get_from_cache(items_key, persistent=True).get_result()
-                        items = []
-                        update_with = json.loads(json.dumps(update_with, cls=JSONEncoder, separators=(',', ':')))
-                        updated_items = []
-                        old_items_ids = []
-                        for item in old_items:
-                            item["id"] = item["id"].replace(prefix, "")
-                            if item["id"] in old_items_ids:
-                                continue
-                            old_items_ids.append(item["id"])
-                            for new_item in update_with:
-                                new_item["id"] = new_item["id"].replace(prefix, "")
-                                if str(item["id"]) == str(new_item["id"]):
-                                    logging.warn("Detected update to the item '%s' == '%s'", item["id"], new_item["id"])
-                                    items.append(new_item)
-                                    updated_items.append(new_item["id"])
-                                    break
-                            else:
-                                items.append(item)
-                        logging.debug("Updated %d items", len(updated_items))
-                        inserted_count = 0
-                        for new_item in update_with:
-                            if new_item["id"] in updated_items:
-                                continue
-                            logging.debug("Adding item '%s' to the items list", new_item["id"])
-                            items.append(new_item)
-                            inserted_count += 1
-                        logging.debug("Inserted %d items", inserted_count)
-                        if inserted_count + len(updated_items) != len(update_with):
-                            logging.warning("There is %d items duplicated",
-                                            len(filter(lambda item: updated_items.count(item) > 1, updated_items)))
-                            logging.warning(
-                                "Expected to update/insert %d items but inserted %d items and updated %d items" % (
-                                    len(update_with), inserted_count, len(updated_items)))
+                # The results are cached with the generation of the index, so they change when the index changes
+                query_key = get_key("query/%s" % hashlib.sha1(" ".join(query_words)).hexdigest())
+                cached = None
+                if not kwargs.get("overwrite"):
+                    cached = query_cache.get(query_key)
+                # The manifest of the index is saved in the key of the items
+                saved_items = get_from_cache(items_key, persistent=True).get_result()
+                if isinstance(saved_items, ItemsManifest) and saved_items.generations is not None:
+                    manifest = saved_items
+                    index_generation = manifest.index_generation
+                    items = open_shards(manifest, get_shard_key)
+                    features = open_shards(manifest, get_features_key) if min_word_length == 1 else None
                 else:
-                    index_items = [
-                        get_from_cache(index_key, persistent=True),
-                        get_from_cache(items_key, persistent=True)
-                    ]
-                    index = index_items[0].get_result()
-                    if min_word_length == 1 and index and isinstance(index, Trie) and hasattr(index, "nodes"):
-                        logging.warning("Resetting index status because of invalid format "
-                                        "(it should be a Trie, but it is %s)"%type(index).__name__)
-                        index = None
-                    elif min_word_length > 1 and index and not isinstance(index, dict):
-                        logging.warning("Resetting index status because of invalid format "
-                                        "(it should be a dict, but it is %s)"%type(index).__name__)
-                        index = None
-                    items = index_items[1].get_result()
-                if kwargs.get("index"):
-                    logging.debug("Index not found, creating index..(as authorized)")
-                    if min_word_length == 1:
-                        logging.debug("Creating a Trie instance")
-                        index = Trie()
-                        index.editable = True
-                    else:
-                        logging.debug("Creating a default dict instance")
-                        index = defaultdict(lambda: [])
-                    items_ids = {}
-                    start = time.time()
-                    index_words = []
-
-                    if items is None:
-                        clear_lru_cache()  # We need nothing before calling the original function..
-                        items = fn(filters)
-                        clear_lru_cache()  # To guarantee that the memory is clean
+                    # Saved before the shards had generations, so everything is in the current generation
+                    manifest = None
+                    index_generation = generation
+                    items = open_items(saved_items, get_shard_key)
+                    features = None
+                index_key = get_key("index", index_generation)
+                words_key = get_key("words", index_generation)
+                ngrams_key = get_key("ngrams", index_generation)
+                index_file = None
+                if not kwargs.get("overwrite") and index_backend == INDEX_BACKEND_FILE and min_word_length == 1:
+                    index_file = get_index_file(get_key("file", index_generation))
+                    # The items of the index file are used while they are not changed by the updates
+                    if index_file is not None and (manifest is None or manifest.is_indexed()):
+                        items, features = index_file.items, index_file.features
+                if cached is not None and items is None:
+                    cached = None
+                if cached is None:
+                    # When the index is rebuilt, the results are not saved in the current generation
+                    cacheable = not kwargs.get("overwrite")
+                    index = None
+                    saved = False
+                    if kwargs.get("overwrite"):
+                        update_with = kwargs.get("update_with")
+                        exclude = kwargs.get("exclude")
+                        if kwargs.get("index") and (update_with or exclude):
+                            logging.debug("Detected instruction to update the index..okay")
+                            index = get_from_cache(index_key, persistent=True).get_result()
+                            if isinstance(index, RefreshableItem):
+                                index = index.value
+                            if manifest is None or not is_valid_index(index, min_word_length):
+                                logging.warn("Index not found (or invalid), so it is rebuilt instead of updated")
+                                index = None
+                        if index is None:
+                            items, features = None, None
+                        else:
+                            start = time.time()
+                            update_with = json.loads(
+                                json.dumps(update_with or [], cls=JSONEncoder, separators=(',', ':'))
+                            )
+                            items = items.tolist()
+                            added, removed, changed = update_index(items, update_with, exclude or [],
+                                                                   get_formatted_string, prefix, min_word_length)
+                            delta = merge_delta(index, manifest.delta, added, removed)
+                            logging.debug("Index updated with %d items (and %d exclusions) in %f seconds",
+                                          len(update_with), len(exclude or []), time.time() - start)
+                            new_manifest = ItemsManifest(len(items), manifest.shard_size, generation + 1)
+                            new_manifest.index_generation = manifest.index_generation
+                            new_manifest.delta = delta
+                            if new_manifest.get_delta_size() > INDEX_DELTA_MAX_POSTINGS:
+                                logging.debug("Building the index again, as it has too many changes")
+                                index, items, features = build_index(items, get_formatted_string, min_word_length)
+                                manifest = None
+                            else:
+                                # Only the shards of the changed items are saved in the next generation, the others
+                                # are kept (with the index) in their generations
+                                start = time.time()
+                                shard_size = manifest.shard_size
+                                shards_count = new_manifest.get_shards_count()
+                                shards = set(position // shard_size for position in changed)
+                                for shard in xrange(min(shards_count, manifest.get_shards_count())):
+                                    if shard not in shards:
+                                        new_manifest.generations[shard] = manifest.generations[shard]
+                                for shard, shard_generation in enumerate(manifest.generations):
+                                    if shard in shards or shard >= shards_count:
+                                        new_manifest.replaced.extend([
+                                            get_shard_key(shard, shard_generation),
+                                            get_features_key(shard, shard_generation)
+                                        ])
+                                values = {}
+                                for shard in shards:
+                                    if shard >= shards_count:
+                                        continue
+                                    shard_items = items[shard * shard_size:(shard + 1) * shard_size]
+                                    values[get_shard_key(shard, generation + 1)] = shard_items
+                                    if min_word_length == 1:
+                                        values[get_features_key(shard, generation + 1)] = [
+                                            get_features(get_formatted_string(item)) for item in shard_items
+                                        ]
+                                save_in_batches(values.iteritems())
+                                publish({get_key("items", generation + 1): new_manifest}, manifest)
+                                logging.debug("Saved %d shards (and %d changed positions of the index) in %f seconds",
+                                              len(values), new_manifest.get_delta_size(), time.time() - start)
+                                saved = True
+                                manifest = new_manifest
+                                if min_word_length == 1:
+                                    features = open_shards(manifest, get_features_key)
+                    elif index_file is not None:
+                        if index_file.needs_refresh():
+                            logging.debug("Index file is stale, returning it while it is rebuilt")
+                            enqueue_refresh(namespace, fn, dict(filters, q=query), queue_name="default",
+                                            overwrite=True, index=True)
+                        index = index_file
                     else:
-                        logging.warn("Detected update with %d items", len(items))
-                    logging.debug("Simplifying %d items..", len(items))
-                    clear_lru_cache()
-                    items = json.loads(JSONEncoder(separators=(',', ':')).encode(items))
-                    clear_lru_cache()
-                    logging.debug("%d Items simplified in %f seconds!", len(items), time.time() - start)
-                    logging.debug("Filtering non None items on the list of results (total actually: %d)", len(items))
-                    items = filter(lambda item: item and isinstance(item, dict), items)
-                    logging.debug("Filtering non None items on the list of results. Now we have %d items", len(items))
-                    exclude = kwargs.get("exclude", [])
-                    if exclude:
-                        logging.debug("Excluding %d specified items..", len(exclude))
-                        if prefix:
-                            exclude = map(lambda exclude_item: exclude_item.replace(prefix, ""), exclude)
-                        items = filter(lambda item: item["id"] not in exclude, items)
-                    logging.debug("Creating list of words based on %d items..", len(items))
-                    for item_id, item in enumerate(items):
-                        if item["id"].startswith(prefix):
-                            item["id"] = item["id"][len(prefix):]
-                        if item["id"] in items_ids:
-                            logging.debug("The task already exists! Ignoring..")
-                            continue
-                        words = get_formatted_string(item).lower().split()
-                        index_words.extend(
-                            map(
-                                lambda word: [word, len(word), item],
-                                filter(
-                                    lambda word: len(word) >= min_word_length,
-                                    map(
-                                        lambda word: "".join(filter(unicode.isalnum, word)),
-                                        words
-                                    )
-                                )
+                        if manifest is None:
+                            # The features were saved in a single key before the shards had generations
+                            index, features = get_many_from_cache(
+                                [index_key, get_key("features")],
+                                persistent=True
+                            ).get_result()
+                        else:
+                            index = get_from_cache(index_key, persistent=True).get_result()
+                        if isinstance(index, RefreshableItem):
+                            if index.is_expired():
+                                index = None
+                            else:
+                                if index.needs_refresh():
+                                    logging.debug("Index is stale, returning it while it is rebuilt")
+                                    enqueue_refresh(namespace, fn, dict(filters, q=query), queue_name="default",
+                                                    overwrite=True, index=True)
+                                index = index.value
+                        if min_word_length == 1 and index and isinstance(index, Trie) and hasattr(index, "nodes"):
+                            logging.warning("Resetting index status because of invalid format "
+                                            "(it should be a Trie, but it is %s)"%type(index).__name__)
+                            index = None
+                        elif min_word_length > 1 and index and not isinstance(index, dict):
+                            logging.warning("Resetting index status because of invalid format "
+                                            "(it should be a dict, but it is %s)"%type(index).__name__)
+                            index = None
+                    if index is not None and manifest is not None and manifest.delta:
+                        index = IndexDelta(index, manifest.delta)
+                    if kwargs.get("index"):
+                        if index is None:
+                            logging.debug("Index not found, creating index..(as authorized)")
+                            start = time.time()
+                            # We need nothing before calling the original function..
+                            clear_lru_cache(CACHE_INDEX_PREFIX)
+                            # The models are converted and indexed one at a time, so only the models, the items and
+                            # the index are kept in memory at once
+                            index, items, features = build_index(
+                                iter_items(fn(filters), prefix, kwargs.get("exclude")),
+                                get_formatted_string,
+                                min_word_length
                             )
-                        )
-                        index_words.extend(
-                            map(
-                                lambda word: [word, len(word), item],
-                                filter(
-                                    lambda word: len(word) >= min_word_length,
-                                    map(
-                                        lambda word: "".join(filter(unicode.isdigit, word)),
-                                        words
-                                    )
-                                )
+                            logging.debug("Index created in %f seconds with %d words", time.time() - start, len(index))
+                        if not saved:
+                            start = time.time()
+                            logging.debug(
+                                "Saving processed result with %d items in storage and %d items in index..",
+                                len(items),
+                                len(index)
                             )
-                        )
-                        items_ids[item["id"]] = item_id
-                    logging.debug("List of words created in %f seconds with %d words", time.time() - start,
-                                  len(index_words))
-                    index_words.sort(key=lambda item: item[0])
-                    word = None
-                    word_items = []
-                    for index_word in index_words:
-                        if word is None:
-                            word = index_word[0]
-                        if word != index_word[0]:
-                            index[word].extend(set([items_ids[item['id']] for item in word_items]))
-                            index[word].sort()
-                            word = index_word[0]
-                            word_items = []
-                        word_items.append(index_word[2])
-                    if word is not None:
-                        index[word].extend(set([items_ids[item['id']] for item in word_items]))
-                        index[word].sort()
-                    del index_words
-                    if min_word_length == 1:
-                        index.editable = False
-                    else:
-                        index = dict(index)
-                    del items_ids
-                    start = time.time()
-                    logging.debug(
-                        "Saving processed result with %d items in storage and %d items in index..",
-                        len(items),
-                        len(index)
-                    )
-                    logging.debug("The index is being saved as a %s", type(index).__name__)
-                    futures = [
-                        set_into_cache(index_key, index, persistent=True),
-                        set_into_cache(items_key, items, persistent=True)
-                    ]
+                            logging.debug("The index is being saved as a %s", type(index).__name__)
+                            # The new index is saved in the next generation, which is published only after everything
+                            # is saved, so the other instances move to it at once (keeping everything else in their
+                            # LRU cache)
+                            new_manifest = ItemsManifest(len(items), ITEMS_SHARD_SIZE, generation + 1)
+                            new_manifest.replaced = get_index_keys(saved_items, generation)
+                            # The shards are saved in batches as they are split, and the values saved with the index
+                            # (the largest ones) one at a time, so the whole index is never encoded at once
+                            shards = iter_shards(items, lambda shard: get_shard_key(shard, generation + 1))
+                            if min_word_length == 1:
+                                shards = itertools.chain(
+                                    shards,
+                                    iter_shards(features, lambda shard: get_features_key(shard, generation + 1))
+                                )
+                            save_in_batches(shards)
+                            save_in_batches(iter_index_values(index, lambda kind: get_key(kind, generation + 1),
+                                                              soft_ttl, min_word_length), 1)
+                            if index_backend == INDEX_BACKEND_FILE and min_word_length == 1:
+                                blob = dump_index(index, items, features, time.time() + soft_ttl if soft_ttl else None)
+                                logging.debug("Saving index file with %d bytes", len(blob))
+                                write_to_gcs(get_gcs_filename(get_key("file", generation + 1)).get_result(), blob)
+                                del blob
+                            publish({get_key("items", generation + 1): new_manifest}, saved_items)
+                            logging.debug("Saving made in %f seconds", time.time() - start)
+                    elif index is None or items is None:
+                        logging.warn("Index not found and not authorized :v")
+                        pprint.pprint(filters)
+                        index = Trie()
+                        items = []
+                        features = None
+                        cacheable = False
+                    suggestions = []
                     if min_word_length == 1:
-                        futures.append(set_into_cache(words_key, list(index.get_words()), persistent=True))
-                    ndb.Future.wait_all(futures)
-                    logging.debug("Saving made in %f seconds", time.time() - start)
-                elif index is None or items is None:
-                    logging.warn("Index not found and not authorized :v")
-                    pprint.pprint(filters)
-                    index = Trie()
-                    items = []
-                suggestions = []
-                if min_word_length == 1:
-                    found = [[i, word, list(index.get_list(word))] for i, word in enumerate(query_words)]
-                else:
-                    found = [[i, word, list(index.get(word, []))] for i, word in enumerate(query_words)]
-                not_found = []
-                results = None
-                for item in found:
-                    if not item[2]:
-                        not_found.append([item[0], item[1]])
-                        continue
-                    if results is None:
-                        results = item[2]
+                        found = [[i, word, list(index.get_list(word))] for i, word in enumerate(query_words)]
                     else:
-                        results = intersect(results, item[2])
-                results = list(results if results else [])
-                if not results and not not_found:
-                    # If no results are found, search for a suggestion if possible
-                    l = len(found)
-                    for n in xrange(l-1, 0, -1):
-                        to_try = combinations([range(l) for _ in xrange(n)])
-                        for combination in to_try:
-                            if len(set(combination)) != len(combination) or sorted(combination) != combination:
-                                continue
-                            results = list(reduce(intersect, (found[word][2] for word in combination)))
+                        found = [[i, word, list(index.get(word, []))] for i, word in enumerate(query_words)]
+                    not_found = [[item[0], item[1]] for item in found if not item[2]]
+                    # All the results are needed, as they are cached for all the pages
+                    results = intersect_all([item[2] for item in found if item[2]])
+                    if not results and not not_found:
+                        # If no results are found, search for a suggestion if possible
+                        l = len(found)
+                        for n in xrange(l-1, 0, -1):
+                            to_try = combinations([range(l) for _ in xrange(n)])
+                            for combination in to_try:
+                                if len(set(combination)) != len(combination) or sorted(combination) != combination:
+                                    continue
+                                results = intersect_all([found[word][2] for word in combination])
+                                if results:
+                                    not_found = [[item[0], item[1]] for item in found if item[0] not in combination]
+                                    break
                             if results:
-                                not_found = [[item[0], item[1]] for item in found if item[0] not in combination]
                                 break
+                        if not results:
+                            not_found = [[item[0], item[1]] for item in found]
+                    not_found = [item for item in not_found if len(item[1]) > 2]
+                    # If each letter is individually indexed, we can suggest things!
+                    if not_found and min_word_length == 1:
+                        queue = []
+                        all_words, ngrams = get_many_from_cache([words_key, ngrams_key]).get_result()
+                        # The words added by the updates are not in the words saved with the index (nor in its n-grams)
+                        new_words = index.get_new_words() if isinstance(index, IndexDelta) else []
+                        if all_words or new_words:
+                            all_words = all_words or []
+                            words_cache = {}
+                            for item in not_found:
+                                l = len(item[1])
+                                # A word longer than l + 2 * SUGGESTION_MAX_DISTANCE + 1 is always too distant
+                                max_length = l + 2 * SUGGESTION_MAX_DISTANCE + 1
+                                if ngrams is not None:
+                                    candidates = get_candidates(ngrams, all_words, item[1], l, max_length,
+                                                                SUGGESTION_CANDIDATES)
+                                else:
+                                    # Index saved before the index of n-grams existed
+                                    if l not in words_cache:
+                                        words_cache[l] = [i for i, word in enumerate(all_words) if len(word) >= l]
+                                    candidates = words_cache[l]
+                                # As the candidates of the n-grams, the new words should share some n-gram with the word
+                                word_ngrams = get_ngrams(item[1]) if ngrams is not None else None
+                                candidates = [all_words[position] for position in candidates] + [
+                                    word for word in new_words
+                                    if l <= len(word) <= max_length and (
+                                        word_ngrams is None or not word_ngrams.isdisjoint(get_ngrams(word))
+                                    )
+                                ]
+                                distances = []
+                                for word in candidates:
+                                    distance = sift3(word, item[1])
+                                    if distance <= SUGGESTION_MAX_DISTANCE:
+                                        distances.append((distance, word))
+                                distances.sort()
+                                queue.append([
+                                    [item, word, index[word], distance]
+                                    for distance, word in distances[:50]
+                                ])
+                            del words_cache, all_words, ngrams
                         if results:
-                            break
-                    if not results:
-                        not_found = [[item[0], item[1]] for item in found]
-                not_found = [item for item in not_found if len(item[1]) > 2]
-                if not_found and min_word_length == 1:  # If each letter is individually indexed, we can suggest things!
-                    queue = []
-                    all_words = get_from_cache(words_key).get_result()
-                    if all_words:
-                        words_cache = {}
-                        for item in not_found:
-                            l = len(item[1])
-                            if l not in words_cache:
-                                words_cache[l] = [word for word in all_words if len(word) >= l]
-                            item_suggestions = list(islice(
-                                sorted(
-                                    (word for word in words_cache[l] if sift3(word, item[1]) <= 3),
-                                    key=lambda word: sift3(word, item[1])
-                                ),
-                                0,
-                                50
-                            ))
-                            queue.append([[item, suggestion, index[suggestion]] for suggestion in item_suggestions])
-                        del words_cache, all_words
-                    if results:
-                        get_results = lambda item: [item[0], list(intersect(item[1], results))]
-                    else:
-                        get_results = lambda item: item
-                    not_found_total = len(not_found)
-                    for n in xrange(not_found_total, 0, -1):
-                        gc_collect()
-                        logging.warning("Generating combinations with %d words", n)
-                        new_queue = (item for item in ([item, list(islice(reduce(intersect, (sug[2] for sug in item)), 0, 10))] for item in combinations(queue, n)) if item[1])
-                        for item in new_queue:
-                            results_list = get_results(item)
-                            if results_list[1]:
-                                sug = query_words[:]
-                                # Replace the initial suggestions in the original query words
-                                for s in item[0]:
-                                    sug[s[0][0]] = s[1]
-                                if sift3(query, " ".join(sug)) > 10 or len(set(sug)) != len(sug): # See duplicated words
+                            get_results = lambda item: [item[0], intersect_all([item[1], results])]
+                        else:
+                            get_results = lambda item: item
+                        not_found_total = len(not_found)
+                        # The combinations of each number of words are tried from the one with the smallest total
+                        # distance, until their share of the budgets is exhausted (so a query with many unknown words
+                        # cannot use the instance for a long time, and the combinations with less words are still
+                        # tried when the ones with more words exhaust their share)
+                        max_combinations = max(SUGGESTION_MAX_COMBINATIONS // not_found_total, 1)
+                        time_budget = float(SUGGESTION_TIME_BUDGET) / not_found_total
+                        for n in xrange(not_found_total, 0, -1):
+                            logging.debug("Generating combinations with %d words", n)
+                            deadline = time.time() + time_budget
+                            evaluated = 0
+                            new_queue = best_combinations(queue, n, lambda sug: sug[3], max_combinations)
+                            for item in new_queue:
+                                if time.time() > deadline:
+                                    logging.warning("Stopping the search of suggestions with %d words after trying %d "
+                                                    "combinations", n, evaluated)
+                                    break
+                                evaluated += 1
+                                item = [item, intersect_all([sug[2] for sug in item], 10)]
+                                if not item[1]:
                                     continue
-                                if n < not_found_total:
-                                    # Eliminates words not included in the suggestion in case of trying suggestions
-                                    # with less words than wrong words
-                                    item_indexes = [s[0][0] for s in item[0]]
-                                    for s in sorted(not_found, key=lambda s: s[0], reverse=True):
-                                        if s[0] not in item_indexes:
-                                            del sug[s[0]]
-
-                                results_list_items = [items[i] for i in results_list[1]]
-
-                                # Reorganize the words of the suggestions in the correct order
-                                # (ex.: 'organizacao no computadores' -> 'organizacao computadores no')
-                                r = get_formatted_string(results_list_items[0]).lower().split(" ")
-                                r = ("".join(filter(unicode.isalnum, word)) for word in r)
-                                nsug = []
-                                for i in r:
-                                    for s in sug:
-                                        if i.startswith(s):
-                                            if s not in nsug and len(s) > 2:
-                                                nsug.append(s)
-                                if nsug:
-                                    sug = nsug
-
-                                # Check if the words does not match itself in the suggestion
-                                # (ex.: 'estruturas da dados' is ignored here)
-                                invalid = False
-                                for i, s in enumerate(sug):
-                                    for i2, s2 in enumerate(sug):
-                                        if i2 == i:
-                                            continue
-                                        if s.startswith(s2):
-                                            invalid = True
+                                results_list = get_results(item)
+                                if results_list[1]:
+                                    sug = query_words[:]
+                                    # Replace the initial suggestions in the original query words
+                                    for s in item[0]:
+                                        sug[s[0][0]] = s[1]
+                                    # See duplicated words
+                                    if sift3(query, " ".join(sug)) > 10 or len(set(sug)) != len(sug):
+                                        continue
+                                    if n < not_found_total:
+                                        # Eliminates words not included in the suggestion in case of trying suggestions
+                                        # with less words than wrong words
+                                        item_indexes = [s[0][0] for s in item[0]]
+                                        for s in sorted(not_found, key=lambda s: s[0], reverse=True):
+                                            if s[0] not in item_indexes:
+                                                del sug[s[0]]
+
+                                    results_list_items = get_items(items, results_list[1])
+
+                                    # Reorganize the words of the suggestions in the correct order
+                                    # (ex.: 'organizacao no computadores' -> 'organizacao computadores no')
+                                    r = get_formatted_string(results_list_items[0]).lower().split(" ")
+                                    r = ("".join(filter(unicode.isalnum, word)) for word in r)
+                                    nsug = []
+                                    for i in r:
+                                        for s in sug:
+                                            if i.startswith(s):
+                                                if s not in nsug and len(s) > 2:
+                                                    nsug.append(s)
+                                    if nsug:
+                                        sug = nsug
+
+                                    # Check if the words does not match itself in the suggestion
+                                    # (ex.: 'estruturas da dados' is ignored here)
+                                    invalid = False
+                                    for i, s in enumerate(sug):
+                                        for i2, s2 in enumerate(sug):
+                                            if i2 == i:
+                                                continue
+                                            if s.startswith(s2):
+                                                invalid = True
+                                                break
+                                        if invalid:
                                             break
                                     if invalid:
-                                        break
-                                if invalid:
-                                    continue
+                                        continue
 
-                                sug = " ".join(sug)
+                                    sug = " ".join(sug)
 
-                                if sug in suggestions:
-                                    continue
-                                first = False
-                                for result_in_list in results_list_items:
-                                    if sug in get_formatted_string(result_in_list).lower():
-                                        # If the suggestion matches the string in the correct order, stop the processing
-                                        if len(results_list_items) == 1:
-                                            suggestions = [sug]
-                                        else:
-                                            suggestions.insert(0, sug)
-                                        first = True
-                                        break
-                                if first:
-                                    break
-                                else:
-                                    suggestions.append(sug)
-                                    if len(suggestions) > 5:
+                                    if sug in suggestions:
+                                        continue
+                                    first = False
+                                    for result_in_list in results_list_items:
+                                        if sug in get_formatted_string(result_in_list).lower():
+                                            # If the suggestion matches the string in the correct order, stop the
+                                            # processing
+                                            if len(results_list_items) == 1:
+                                                suggestions = [sug]
+                                            else:
+                                                suggestions.insert(0, sug)
+                                            first = True
+                                            break
+                                    if first:
                                         break
-                        if suggestions:  # If we already have suggestions, stops the loop!
-                            break
+                                    else:
+                                        suggestions.append(sug)
+                                        if len(suggestions) > 5:
+                                            break
+                            if suggestions:  # If we already have suggestions, stops the loop!
+                                break
 
+                    items_len = len(items)
+                    results = [result for result in results if result < items_len]
+                    if suggestions:
+                        results = []
+                        suggestions = sorted(suggestions, key=lambda suggestion: sift3(query, suggestion))
+                    elif results and features is not None and len(features) == items_len:
+                        if isinstance(features, ShardedItems):
+                            # The shards with the features of all the results are loaded at once
+                            features.load_shards(set(result // features.manifest.shard_size for result in results))
+                        results = rank(results, features, query_words)
+                    cached = (array(POSTINGS_TYPECODE, results), suggestions)
+                    if cacheable:
+                        query_cache.set(query_key, cached)
+                results, suggestions = cached
                 # If the total number of results is less than N items, we send all the results we found
-                items_len = len(items)
-                results = [result for result in results if result < items_len]
-                prefetch = next(islice(results, 40, 41), False) is False
+                prefetch = not suggestions and len(results) <= PREFETCH_SIZE
                 if not prefetch:
                     # if not prefetch, slice the results according to page and limit variables
-                    results = islice(results, page_start, page_end)
-                results = map(items.__getitem__, results)
-                if suggestions:
-                    prefetch = False
-                    results = []
-                    suggestions = sorted(suggestions, key=lambda suggestion: sift3(query, suggestion))
+                    if page_end < len(results):
+                        next_cursor = encode_cursor(fingerprint, page_end)
+                    results = results[page_start:page_end]
+                results = get_items(items, results)
+                suggestions = list(suggestions)
             else:
                 if kwargs.get("overwrite"):
                     items = None
                 else:
-                    items = get_from_cache(items_key, persistent=True).get_result()
+                    saved_items = get_from_cache(items_key, persistent=True).get_result()
+                    if isinstance(saved_items, ItemsManifest) and saved_items.generations is not None:
+                        items = open_shards(saved_items, get_shard_key)
+                    else:
+                        items = open_items(saved_items, get_shard_key)
                 if kwargs.get("index"):
-                    items = fn(filters)
-                    items = json.loads(json.dumps(items, cls=JSONEncoder, separators=(',', ':')))
-                    for item in items:
-                        if item["id"].startswith(prefix):
-                            item["id"] = item["id"][len(prefix):]
-                    set_into_cache(items_key, items, persistent=True).get_result()
+                    # The items are saved only with the index (by the searches), so they are not changed without it
+                    items = list(iter_items(fn(filters), prefix))
                 elif items is None:
                     items = []
-                results = list(islice(items, page_start, page_end))
+                results = get_items(items, range(page_start, min(page_end, len(items))))
+                if page_end < len(items):
+                    next_cursor = encode_cursor(fingerprint, page_end)
                 prefetch = False
                 suggestions = []
             results = {
@@ -386,7 +1131,8 @@ def searchable(get_formatted_string, prefix=None, consider_only=None, min_word_l
                 "id_prefix": prefix,
                 "prefetch": prefetch,
                 "suggestions": suggestions,
-                "query": original_query if original_query else None
+                "query": original_query if original_query else None,
+                "next_cursor": next_cursor
             }
             start_processing = time.time() - start_processing
             logging.debug(
@@ -0,0 +1,210 @@
+import bisect
+import os
+import threading
+import time
+import logging as _logging
+from google.appengine.api import memcache
+
+__author__ = 'fernando'
+
+logging = _logging.getLogger("matrufsc2_metrics")
+logging.setLevel(_logging.WARNING)
+
+# Upper bounds (in milliseconds) of the buckets of the latency histograms (the last bucket has no upper bound)
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# Each instance saves its metrics on memcache at most each FLUSH_INTERVAL seconds
+FLUSH_INTERVAL = 60
+METRICS_KEY = "metrics/%s/instance/%s"
+METRICS_INSTANCES_KEY = "metrics/%s/instances"
+METRICS_TIMEOUT = 86400
+COUNTERS = ["hits", "misses", "bytes_read", "bytes_written", "evictions", "latency_count", "latency_sum"]
+
+
+class Metrics(object):
+    """
+    The counters and the latency histogram of a tier and a namespace
+    """
+    __slots__ = COUNTERS + ["latency_buckets"]
+
+    def __init__(self):
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record_latency(self, latency):
+        latency *= 1000
+        self.latency_count += 1
+        self.latency_sum += latency
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def to_dict(self):
+        result = dict((counter, getattr(self, counter)) for counter in COUNTERS)
+        result["latency_buckets"] = list(self.latency_buckets)
+        return result
+
+
+def merge_values(target, source):
+    for counter in COUNTERS:
+        target[counter] += source.get(counter, 0)
+    target["latency_buckets"] = [a + b for a, b in zip(target["latency_buckets"], source["latency_buckets"])]
+    return target
+
+
+def merge_metrics(target, source):
+    """
+    Sum the metrics (as returned by MetricsRegistry.snapshot) of source into target
+
+    :param target: The metrics that are updated
+    :type target: dict
+    :param source: The metrics to sum
+    :type source: dict
+    :return: The target
+    :rtype: dict
+    """
+    for tier, namespaces in source.iteritems():
+        target_namespaces = target.setdefault(tier, {})
+        for namespace, values in namespaces.iteritems():
+            if namespace not in target_namespaces:
+                target_namespaces[namespace] = Metrics().to_dict()
+            merge_values(target_namespaces[namespace], values)
+    return target
+
+
+def summarize(metrics):
+    """
+    Add the totals of each tier and the derived values (hit rate and mean latency) to the metrics
+
+    :param metrics: The metrics (as returned by MetricsRegistry.snapshot)
+    :type metrics: dict
+    :return: The metrics with the totals of each tier in the namespace "*"
+    :rtype: dict
+    """
+    for namespaces in metrics.itervalues():
+        total = Metrics().to_dict()
+        for values in namespaces.itervalues():
+            merge_values(total, values)
+        namespaces["*"] = total
+        for values in namespaces.itervalues():
+            lookups = values["hits"] + values["misses"]
+            values["hit_rate"] = float(values["hits"]) / lookups if lookups else None
+            count = values["latency_count"]
+            values["latency_mean"] = values["latency_sum"] / count if count else None
+    return metrics
+
+
+class MetricsRegistry(object):
+    """
+    In-process registry of hits, misses, latency, bytes and evictions per tier and per namespace. The metrics of each
+    instance are periodically saved on memcache, so the metrics of all the instances can be aggregated.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.started_on = time.time()
+        self.flushed_on = self.started_on
+        self.flushing = False
+        self.instance_id = os.environ.get("INSTANCE_ID", "local")
+
+    def get(self, tier, namespace):
+        key = (tier, namespace)
+        metrics = self.metrics.get(key)
+        if metrics is None:
+            metrics = self.metrics[key] = Metrics()
+        return metrics
+
+    def record_hit(self, tier, namespace, latency=None, size=0):
+        with self.lock:
+            metrics = self.get(tier, namespace)
+            metrics.hits += 1
+            metrics.bytes_read += size
+            if latency is not None:
+                metrics.record_latency(latency)
+        self.check_flush()
+
+    def record_miss(self, tier, namespace, latency=None):
+        with self.lock:
+            metrics = self.get(tier, namespace)
+            metrics.misses += 1
+            if latency is not None:
+                metrics.record_latency(latency)
+        self.check_flush()
+
+    def record_write(self, tier, namespace, size):
+        with self.lock:
+            self.get(tier, namespace).bytes_written += size
+
+    def record_eviction(self, tier, namespace):
+        with self.lock:
+            self.get(tier, namespace).evictions += 1
+
+    def snapshot(self):
+        """
+        Get the metrics of this instance
+
+        :return: A dict with the metrics of each namespace of each tier
+        :rtype: dict
+        """
+        with self.lock:
+            result = {}
+            for (tier, namespace), metrics in self.metrics.iteritems():
+                result.setdefault(tier, {})[namespace] = metrics.to_dict()
+            return result
+
+    def check_flush(self):
+        if self.flushing or time.time() - self.flushed_on < FLUSH_INTERVAL:
+            return
+        self.flushing = True
+        try:
+            self.flush()
+        except:
+            logging.exception("Error detected when saving the metrics on memcache")
+        finally:
+            self.flushed_on = time.time()
+            self.flushing = False
+
+    def flush(self):
+        """
+        Save the metrics of this instance on memcache and register the instance in the list of instances
+        """
+        client = memcache.Client()
+        now = time.time()
+        client.set(METRICS_KEY % (self.name, self.instance_id), {
+            "started_on": self.started_on,
+            "flushed_on": now,
+            "metrics": self.snapshot()
+        }, METRICS_TIMEOUT)
+        key = METRICS_INSTANCES_KEY % self.name
+        for _ in xrange(3):
+            instances = client.gets(key)
+            if instances is None:
+                if client.add(key, {self.instance_id: now}, METRICS_TIMEOUT):
+                    break
+                continue
+            instances = dict(
+                (instance_id, flushed_on) for instance_id, flushed_on in instances.iteritems()
+                if now - flushed_on < METRICS_TIMEOUT
+            )
+            instances[self.instance_id] = now
+            if client.cas(key, instances, METRICS_TIMEOUT):
+                break
+
+    def get_aggregated(self):
+        """
+        Get the metrics of all the instances (as saved in the last flush of each instance)
+
+        :return: A dict with the number of instances and the sum of their metrics
+        :rtype: dict
+        """
+        self.flush()
+        client = memcache.Client()
+        instances = client.get(METRICS_INSTANCES_KEY % self.name) or {}
+        snapshots = client.get_multi([METRICS_KEY % (self.name, instance_id) for instance_id in instances])
+        result = {}
+        for snapshot in snapshots.itervalues():
+            merge_metrics(result, snapshot["metrics"])
+        return {
+            "instances": len(snapshots),
+            "metrics": result
+        }
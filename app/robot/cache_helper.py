@@ -1,5 +1,4 @@
 import logging as _logging, time
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from app.api import teams, disciplines, campi, semesters
 from app.models import Discipline, Team
@@ -17,7 +16,8 @@ class CacheHelper(KeyGenerator, object):
         teams.get_all_teams({
             "q": "anything",
             "campus": self.generate_campus_key(campus, semester)
-        }, overwrite=True, index=True, update_with=modified_teams, exclude=excluded_teams)
+        }, overwrite=True, index=True, update_with=map(self.get_team_model, modified_teams), exclude=excluded_teams)
+        self.update_teams_search(modified_teams, excluded_teams, campus, semester)
         excluded_teams_keys = map(lambda team: ndb.Key(Team, team), excluded_teams)
         for excluded_team in excluded_teams:
             logging.debug("Deleting team '%s'", excluded_team)
@@ -28,6 +28,53 @@ class CacheHelper(KeyGenerator, object):
         excluded_teams = []
         return modified_teams, excluded_teams
 
+    @staticmethod
+    def get_team_model(team):
+        """
+        Get the model of a modified team, that is saved with the key of its discipline (or alone, by the tasks enqueued
+        before the modified teams had the keys of their disciplines)
+        """
+        return team["model"] if isinstance(team, dict) else team
+
+    def update_teams_search(self, modified_teams, excluded_teams, campus, semester):
+        """
+        Update the index of the teams by teachers and rooms (see app.api.teams.search_teams) with the modified and
+        the excluded teams
+
+        :param modified_teams: The modified teams (dicts with the model of the team and the key of its discipline, or
+        the models alone)
+        :type modified_teams: list
+        :param excluded_teams: The ids of the excluded teams
+        :type excluded_teams: list
+        """
+        campus_key = self.generate_campus_key(campus, semester)
+        disciplines_teams = {}
+        legacy_teams_ids = set()
+        for team in modified_teams:
+            if isinstance(team, dict):
+                disciplines_teams.setdefault(team["discipline"], []).append(team["model"].key.id())
+            else:
+                legacy_teams_ids.add(team.key.id())
+        if legacy_teams_ids:
+            # The disciplines of the teams saved without them are found in the teams of the disciplines
+            logging.debug("Looking for the disciplines of %d teams", len(legacy_teams_ids))
+            for page in teams.iter_disciplines_teams(campus_key):
+                for discipline in page:
+                    for team_id in legacy_teams_ids.intersection(discipline["teams"]):
+                        disciplines_teams.setdefault(discipline["id"], []).append(team_id)
+        modified_disciplines_teams = [
+            {"id": discipline, "teams": teams_ids} for discipline, teams_ids in disciplines_teams.iteritems()
+        ]
+        search_items = teams.get_teams_search_items(campus_key, modified_disciplines_teams)
+        if not search_items and not excluded_teams:
+            return
+        logging.debug("Updating the search of teams with %d teams (and %d exclusions)", len(search_items),
+                      len(excluded_teams))
+        teams.search_teams({
+            "q": "anything",
+            "campus": campus_key
+        }, overwrite=True, index=True, update_with=search_items, exclude=excluded_teams)
+
     def update_disciplines_index(self, campus, semester, modified_disciplines, excluded_disciplines):
         start = time.time()
         logging.debug("Indexing all the disciplines of the campus \o/")
@@ -45,6 +92,16 @@ class CacheHelper(KeyGenerator, object):
             "q": "anything",
             "campus": self.generate_campus_key(campus, semester)
         }, overwrite=True, index=True, update_with=modified_disciplines_teams, exclude=excluded_disciplines)
+        # The teams of the modified disciplines (including the new teams) are indexed by teachers and rooms
+        search_items = teams.get_teams_search_items(
+            self.generate_campus_key(campus, semester),
+            modified_disciplines_teams
+        )
+        if search_items:
+            teams.search_teams({
+                "q": "anything",
+                "campus": self.generate_campus_key(campus, semester)
+            }, overwrite=True, index=True, update_with=search_items)
         excluded_disciplines_keys = map(lambda discipline: ndb.Key(Discipline, discipline), excluded_disciplines)
         for excluded_discipline in excluded_disciplines:
             logging.debug("Deleting discipline '%s'", excluded_discipline)
@@ -555,7 +555,11 @@ class Robot(CommunityFetcher, CacheHelper, object):
             team_key = yield self.get_team_key(team, campus, semester, team_old)
             if team_key["modified"]:
                 logging.warn("Adding team '%s' to the list of modified teams", team.code)
-                modified_teams.append(team_key["model"])
+                # The discipline is kept with the team, so the search of teams is updated without looking for it
+                modified_teams.append({
+                    "model": team_key["model"],
+                    "discipline": self.generate_discipline_key(team.discipline, campus, semester)
+                })
             team_key = team_key["key"]
             if discipline == team.discipline.code:
                 logging.debug("Appending team to the list of teams in a discipline")
@@ -769,8 +773,7 @@ class Robot(CommunityFetcher, CacheHelper, object):
             else:
                 semester_key = yield self.get_semester_key(semester, registered_campi)
                 self.update_semester_cache(semester_key)
-                # Clear LRU cache on the frontend
-                taskqueue.add(url="/secret/clear_cache/", method="GET", queue_name="frontend", target="default")
+                # The frontend does not need to clear its LRU cache: the updated caches are saved in new generations
             clear_lru_cache()
         logging.info("Flushing all the things :D")
         yield context.flush()
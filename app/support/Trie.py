@@ -1,18 +1,50 @@
-from app.support.sort import sort
+import bisect
+from array import array
+from itertools import izip
 
 __author__ = 'fernando'
 
+# The merged lists of the prefixes with up to this length (the most expensive to merge) are cached
+PREFIX_CACHE_LENGTH = 2
+PREFIX_CACHE_CAPACITY = 512
+# Type of the items of the compact posting lists (unsigned int, 4 bytes)
+POSTINGS_TYPECODE = "I"
+
 
 class Trie(dict):
-    __slots__ = ["editable"]
+    """
+    Index of words to sorted lists of ids. The prefix lookups (get_list) are made with binary search over a sorted
+    array of the words, that is saved with the index (and rebuilt on first use when the index is changed or when the
+    index was saved before the array existed).
+
+    After the index is built, it should be compacted: the lists of all the words are concatenated (in the order of
+    the words) in a single array of ints and the index maps each word to its position. So the lists of the words of
+    a prefix are a single slice of the array, and the index is saved (and loaded) without an object for each id.
+    """
+    __slots__ = ["editable", "words", "prefix_cache", "offsets", "postings"]
 
     def __init__(self):
         super(Trie, self).__init__()
         self.editable = True
+        self.words = None
+        self.prefix_cache = {}
+        self.offsets = None
+        self.postings = None
+
+    def __reduce__(self):
+        # The words are saved only in the state (dict subclasses are saved with all their items again by default)
+        return Trie, (), self.__getstate__()
 
     def __getstate__(self):
+        if self.postings is not None:
+            return {
+                "words": self.words,
+                "offsets": self.offsets,
+                "postings": self.postings
+            }
         s = {
             "data": self.copy(),
+            "words": self.get_sorted_words()
         }
         if self.editable is True:
             s["editable"] = self.editable
@@ -20,10 +52,163 @@ class Trie(dict):
 
     def __setstate__(self, state):
         self.editable = state.pop("editable", False)
-        self.update(state.pop("data", {}))
+        self.prefix_cache = {}
+        self.words = state.pop("words", None)
+        self.postings = state.pop("postings", None)
+        self.offsets = state.pop("offsets", None)
+        if self.postings is not None:
+            super(Trie, self).update(izip(self.words, xrange(len(self.words))))
+        else:
+            super(Trie, self).update(state.pop("data", {}))
+
+    def is_compact(self):
+        return self.postings is not None
+
+    def compact(self):
+        """
+        Concatenate the lists of all the words in a single array, making the index read only
+        """
+        words = self.get_sorted_words()
+        getitem = super(Trie, self).__getitem__
+        self.load_postings(words, [getitem(word) for word in words])
+
+    def load_postings(self, words, lists):
+        """
+        Replace the content of the index by the lists of the words, compacted
+
+        :param words: The words, sorted
+        :type words: list
+        :param lists: The sorted list of ids of each word
+        :type lists: list
+        """
+        offsets = array(POSTINGS_TYPECODE, [0])
+        postings = array(POSTINGS_TYPECODE)
+        for ids in lists:
+            postings.extend(ids)
+            offsets.append(len(postings))
+        super(Trie, self).clear()
+        super(Trie, self).update(izip(words, xrange(len(words))))
+        self.editable = False
+        self.words = words
+        self.prefix_cache = {}
+        self.offsets = offsets
+        self.postings = postings
+
+    def expand(self):
+        """
+        Convert a compacted index back to an index with a list for each word, so it can be changed
+        """
+        postings, offsets = self.postings, self.offsets
+        self.postings = self.offsets = None
+        words = self.get_sorted_words()
+        super(Trie, self).clear()
+        super(Trie, self).update(
+            (word, postings[offsets[position]:offsets[position + 1]].tolist()) for position, word in enumerate(words)
+        )
+        self.prefix_cache = {}
+
+    def invalidate(self):
+        # Only assignments here: the items of indexes saved by older versions are set before __setstate__ is called
+        if getattr(self, "postings", None) is not None:
+            self.expand()
+        self.words = None
+        self.prefix_cache = {}
+
+    def __setitem__(self, key, value):
+        self.invalidate()
+        super(Trie, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.invalidate()
+        super(Trie, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self.invalidate()
+        super(Trie, self).update(*args, **kwargs)
+
+    def setdefault(self, key, d=None):
+        self.invalidate()
+        return super(Trie, self).setdefault(key, d)
+
+    def pop(self, key, *args):
+        self.invalidate()
+        return super(Trie, self).pop(key, *args)
+
+    def popitem(self):
+        self.invalidate()
+        return super(Trie, self).popitem()
+
+    def clear(self):
+        self.invalidate()
+        super(Trie, self).clear()
+
+    def get_sorted_words(self):
+        words = self.words
+        if words is None:
+            words = self.words = sorted(self.iterkeys())
+        return words
 
     def get_words(self):
-        return sorted(self.iterkeys())
+        return list(self.get_sorted_words())
+
+    def get_prefix_words(self, prefix):
+        """
+        Get the words starting with the prefix
+
+        :param prefix: The prefix
+        :type prefix: basestring
+        :return: The words, sorted
+        :rtype: list
+        """
+        start, end = self.get_prefix_range(prefix)
+        return self.get_sorted_words()[start:end]
+
+    def get_prefix_range(self, prefix):
+        """
+        Get the positions (in the sorted array of words) of the words starting with the prefix
+
+        :param prefix: The prefix
+        :type prefix: basestring
+        :return: The position of the first word and the position after the last word
+        :rtype: tuple
+        """
+        words = self.get_sorted_words()
+        start = end = bisect.bisect_left(words, prefix)
+        total = len(words)
+        while end < total and words[end].startswith(prefix):
+            end += 1
+        return start, end
+
+    def find(self, word):
+        """
+        Get the position of the word in the sorted array of words
+
+        :param word: The word
+        :type word: basestring
+        :return: The position, or None if the word is not indexed
+        :rtype: int
+        """
+        if self.postings is not None:
+            return super(Trie, self).get(word)
+        words = self.get_sorted_words()
+        position = bisect.bisect_left(words, word)
+        if position < len(words) and words[position] == word:
+            return position
+        return None
+
+    def get_postings(self, start, end):
+        """
+        Get the concatenated lists of the words between two positions of the sorted array of words (of a compacted
+        index)
+
+        :param start: The position of the first word
+        :type start: int
+        :param end: The position after the last word
+        :type end: int
+        :return: The ids (with duplicates)
+        :rtype: array
+        """
+        return self.postings[self.offsets[start]:self.offsets[end]]
 
     def get(self, key, d=None):
         editable = self.editable
@@ -40,28 +225,43 @@ class Trie(dict):
             return d
 
     def get_list(self, item):
-        item_length = len(item)
-        words = (word for word in self.iterkeys() if word[:item_length] == item)
-        queue = [self[word] for word in words]
-        while len(queue) > 1:
-            item_old = None
-            temp = []
-            for item in queue:
-                if item_old is None:
-                    item_old = item
-                else:
-                    temp.append(sort(item, item_old))
-                    item_old = None
-            if item_old is not None:
-                temp[-1] = sort(item_old, temp[-1])
-            queue = temp
-        if queue:
-            return list(queue[0])
-        return []
+        """
+        Get the ids of all the words starting with the prefix
+
+        :param item: The prefix
+        :type item: basestring
+        :return: The ids, sorted and without duplicates
+        :rtype: list
+        """
+        result = self.prefix_cache.get(item)
+        if result is not None:
+            return list(result)
+        if self.postings is not None:
+            start, end = self.get_prefix_range(item)
+            postings = self.postings[self.offsets[start]:self.offsets[end]]
+            result = postings.tolist() if end - start == 1 else sorted(set(postings))
+        else:
+            getitem = super(Trie, self).__getitem__
+            lists = [getitem(word) for word in self.get_prefix_words(item)]
+            if not lists:
+                result = []
+            elif len(lists) == 1:
+                result = list(lists[0])
+            else:
+                result = sorted(set().union(*lists))
+        if not self.editable and len(item) <= PREFIX_CACHE_LENGTH:
+            prefix_cache = self.prefix_cache
+            if len(prefix_cache) >= PREFIX_CACHE_CAPACITY:
+                prefix_cache.clear()
+            prefix_cache[item] = result
+            return list(result)
+        return result
 
     def __getitem__(self, item):
         try:
             value = super(Trie, self).__getitem__(item)
+            if self.postings is not None:
+                value = self.postings[self.offsets[value]:self.offsets[value + 1]]
         except KeyError:
             if self.editable:
                 self[item] = value = []
@@ -1,3 +1,5 @@
+import heapq
+import itertools
 from app.support.ijoin import ijoin
 
 __author__ = 'fernando'
@@ -26,3 +28,40 @@ def combinations(items, limit=None):
         return ijoin(result)
     else:
         return iter([])
+
+
+def best_combinations(items, limit, cost, max_states=None):
+    """
+    Generate the combinations of one item of each of `limit` lists, in the same format of combinations(items, limit),
+    but from the combination with the lowest total cost to the one with the highest (best-first, with a heap)
+
+    :param items: The lists of items, each one sorted by cost
+    :type items: list
+    :param limit: The number of lists used in each combination
+    :type limit: int
+    :param cost: The function that returns the cost of an item
+    :param max_states: The maximum number of combinations kept in the heap (the work done is bounded by it)
+    :type max_states: int
+    """
+    heap = []
+    seen = set()
+    for subset in itertools.combinations(xrange(len(items)), limit):
+        if max_states is not None and len(seen) >= max_states:
+            break
+        if all(items[i] for i in subset):
+            choice = (0,) * limit
+            seen.add((subset, choice))
+            heapq.heappush(heap, (sum(cost(items[i][0]) for i in subset), subset, choice))
+    while heap:
+        total, subset, choice = heapq.heappop(heap)
+        yield [items[i][c] for i, c in itertools.izip(subset, choice)]
+        for k, i in enumerate(subset):
+            position = choice[k]
+            if position + 1 >= len(items[i]) or (max_states is not None and len(seen) >= max_states):
+                continue
+            next_choice = choice[:k] + (position + 1,) + choice[k + 1:]
+            if (subset, next_choice) in seen:
+                continue
+            seen.add((subset, next_choice))
+            next_total = total - cost(items[i][position]) + cost(items[i][position + 1])
+            heapq.heappush(heap, (next_total, subset, next_choice))
@@ -0,0 +1,293 @@
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import logging as _logging
+from array import array
+
+try:
+    import mmap
+except ImportError:
+    # Not available on the sandbox of App Engine, where the index files are read from memory
+    mmap = None
+
+__author__ = 'fernando'
+
+logging = _logging.getLogger("matrufsc2_index_file")
+logging.setLevel(_logging.WARNING)
+
+# The file starts with a header (the magic string, the version, the time after which the index should be refreshed,
+# the number of words and of items and the position of each section), followed by the sections:
+#  - the offset table of the vocabulary and the vocabulary (the words, encoded in UTF-8 and sorted by their bytes)
+#  - the offset table of the posting lists (in the order of the vocabulary) and the posting lists
+#  - the offset table of the items and the items (encoded in JSON)
+#  - the offset table of the features and the features (see app.support.ranking), that are optional
+# All the integers are little-endian and unsigned, with 4 bytes
+MAGIC = "MIDX"
+VERSION = 1
+SECTIONS = ["vocabulary_offsets", "vocabulary", "postings_offsets", "postings", "items_offsets", "items",
+            "features_offsets", "features"]
+HEADER = struct.Struct("<4sHxxdII" + "I" * len(SECTIONS))
+OFFSET = struct.Struct("<I")
+OFFSETS = struct.Struct("<II")
+OFFSETS_TYPECODE = "I"
+# Prefix of the names of the local copies of the index files (on the temporary directory)
+LOCAL_FILE_PREFIX = "matrufsc2-index-"
+READ_CHUNK_SIZE = 1024 * 1024
+# The merged lists of the prefixes with up to this length are cached (see Trie)
+PREFIX_CACHE_LENGTH = 2
+PREFIX_CACHE_CAPACITY = 512
+
+
+def pack_integers(values):
+    values = array(OFFSETS_TYPECODE, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tostring()
+
+
+def unpack_integers(data):
+    values = array(OFFSETS_TYPECODE)
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def pack_records(records):
+    offsets = array(OFFSETS_TYPECODE, [0])
+    total = 0
+    for record in records:
+        total += len(record)
+        offsets.append(total)
+    return pack_integers(offsets), "".join(records)
+
+
+def dump_index(index, items, features=None, refresh_on=None):
+    """
+    Serialize the index, the items and the features in the binary format of the index files
+
+    :param index: The index (of each word to the sorted list of positions of its items)
+    :type index: app.support.Trie.Trie
+    :param items: The items
+    :type items: list
+    :param features: The features of the items (see app.support.ranking), if any
+    :type features: list
+    :param refresh_on: The time after which the index should be refreshed, if any
+    :type refresh_on: float
+    :return: The content of the index file
+    :rtype: str
+    """
+    words = sorted((word.encode("utf-8"), word) for word in index.get_sorted_words())
+    postings = array(OFFSETS_TYPECODE)
+    postings_offsets = array(OFFSETS_TYPECODE, [0])
+    for _, word in words:
+        postings.extend(index.get(word, []))
+        postings_offsets.append(len(postings))
+    sections = list(pack_records([word for word, _ in words]))
+    sections.extend([pack_integers(postings_offsets), pack_integers(postings)])
+    sections.extend(pack_records([json.dumps(item, separators=(',', ':')) for item in items]))
+    if features is not None:
+        sections.extend(pack_records([str(item_features) for item_features in features]))
+    else:
+        sections.extend(["", ""])
+    positions = []
+    position = HEADER.size
+    for section in sections:
+        positions.append(position)
+        position += len(section)
+    if features is None:
+        positions[-2:] = [0, 0]
+    header = HEADER.pack(MAGIC, VERSION, refresh_on or 0, len(words), len(items), *positions)
+    return "".join([header] + sections)
+
+
+class IndexFileRecords(object):
+    """
+    The items (or the features) of an index file, decoded only when accessed
+    """
+    __slots__ = ["index_file", "offsets", "data", "count", "decode"]
+
+    def __init__(self, index_file, offsets, data, count, decode):
+        self.index_file = index_file
+        self.offsets = offsets
+        self.data = data
+        self.count = count
+        self.decode = decode
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("Record %d not found on index file" % position)
+        buffer = self.index_file.buffer
+        start, end = OFFSETS.unpack_from(buffer, self.offsets + OFFSET.size * position)
+        return self.decode(buffer[self.data + start:self.data + end])
+
+    def __iter__(self):
+        for position in xrange(self.count):
+            yield self[position]
+
+
+class IndexFile(object):
+    """
+    Read only index over the content of an index file (a string or a memory-mapped file). The words are found with
+    binary search directly on the content, so a lookup reads only the words compared and the posting lists returned.
+
+    It has the same interface of a compacted Trie, and the items and features are available as sequences.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        header = HEADER.unpack_from(buffer, 0)
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ValueError("Invalid index file (version %r)" % (header[1],))
+        self.refresh_on = header[2] or None
+        self.words_count, self.items_count = header[3:5]
+        sections = dict(zip(SECTIONS, header[5:]))
+        self.vocabulary_offsets = sections["vocabulary_offsets"]
+        self.vocabulary = sections["vocabulary"]
+        self.postings_offsets = sections["postings_offsets"]
+        self.postings = sections["postings"]
+        self.prefix_cache = {}
+        self.items = IndexFileRecords(self, sections["items_offsets"], sections["items"], self.items_count,
+                                      json.loads)
+        if sections["features_offsets"]:
+            self.features = IndexFileRecords(self, sections["features_offsets"], sections["features"],
+                                             self.items_count, str)
+        else:
+            self.features = None
+
+    def __len__(self):
+        return self.words_count
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def __getitem__(self, word):
+        return self.get(word, [])
+
+    def needs_refresh(self):
+        return self.refresh_on is not None and self.refresh_on < time.time()
+
+    def get_word(self, position):
+        start, end = OFFSETS.unpack_from(self.buffer, self.vocabulary_offsets + OFFSET.size * position)
+        return self.buffer[self.vocabulary + start:self.vocabulary + end]
+
+    def bisect(self, word):
+        low, high = 0, self.words_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_word(middle) < word:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, word):
+        word = word.encode("utf-8") if isinstance(word, unicode) else word
+        position = self.bisect(word)
+        if position < self.words_count and self.get_word(position) == word:
+            return position
+        return None
+
+    def get_words(self):
+        return [self.get_word(position).decode("utf-8") for position in xrange(self.words_count)]
+
+    def get_prefix_range(self, prefix):
+        """
+        Get the positions (in the vocabulary) of the words starting with the prefix
+
+        :param prefix: The prefix
+        :type prefix: basestring
+        :return: The position of the first word and the position after the last word
+        :rtype: tuple
+        """
+        prefix = prefix.encode("utf-8") if isinstance(prefix, unicode) else prefix
+        # No byte of a string encoded in UTF-8 is \xff, so it is after every word starting with the prefix
+        return self.bisect(prefix), self.bisect(prefix + "\xff")
+
+    def get_postings(self, start, end):
+        buffer = self.buffer
+        first = OFFSET.unpack_from(buffer, self.postings_offsets + OFFSET.size * start)[0]
+        last = OFFSET.unpack_from(buffer, self.postings_offsets + OFFSET.size * end)[0]
+        return unpack_integers(buffer[self.postings + OFFSET.size * first:self.postings + OFFSET.size * last])
+
+    def get(self, word, d=None):
+        position = self.find(word)
+        if position is None:
+            return d
+        return self.get_postings(position, position + 1)
+
+    def get_list(self, item):
+        """
+        Get the ids of all the words starting with the prefix
+
+        :param item: The prefix
+        :type item: basestring
+        :return: The ids, sorted and without duplicates
+        :rtype: list
+        """
+        result = self.prefix_cache.get(item)
+        if result is not None:
+            return list(result)
+        start, end = self.get_prefix_range(item)
+        postings = self.get_postings(start, end)
+        result = postings.tolist() if end - start == 1 else sorted(set(postings))
+        if len(item) <= PREFIX_CACHE_LENGTH:
+            if len(self.prefix_cache) >= PREFIX_CACHE_CAPACITY:
+                self.prefix_cache.clear()
+            self.prefix_cache[item] = result
+            return list(result)
+        return result
+
+
+def open_index_file(filename):
+    """
+    Open a local index file, memory-mapped (when mmap is available)
+
+    :param filename: The name of the file
+    :type filename: str
+    :return: The index
+    :rtype: IndexFile
+    """
+    with open(filename, "rb") as local_file:
+        if mmap is None:
+            return IndexFile(local_file.read())
+        return IndexFile(mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def load_index_file(source, name):
+    """
+    Load an index file from a file-like object (as a file opened from GCS). The content is copied to a local temporary
+    file that is memory-mapped, so only the pages used by the lookups are read. When it is not possible (as on the
+    sandbox of App Engine, that has no writable filesystem) the content is kept in memory.
+
+    :param source: The file-like object
+    :param name: The name of the index
+    :type name: str
+    :return: The index
+    :rtype: IndexFile
+    """
+    if mmap is not None:
+        filename = None
+        try:
+            descriptor, filename = tempfile.mkstemp(prefix=LOCAL_FILE_PREFIX)
+            with os.fdopen(descriptor, "wb") as local_file:
+                for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), ""):
+                    local_file.write(chunk)
+            index_file = open_index_file(filename)
+            # The mapping is kept after the file is removed
+            os.remove(filename)
+            return index_file
+        except (IOError, OSError):
+            logging.warning("Local copy of the index file '%s' not created, so it is loaded in memory", name)
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+            source.seek(0)
+    return IndexFile(source.read())
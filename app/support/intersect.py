@@ -1,5 +1,10 @@
+from bisect import bisect_left
+
 __author__ = 'fernando'
 
+# Lists at least GALLOP_MIN_RATIO times longer than the partial result of an intersection are searched with gallop
+GALLOP_MIN_RATIO = 64
+
 
 def intersect(x, y):
     x = iter(x if x else []).next
@@ -14,4 +19,81 @@ def intersect(x, y):
         elif xo > yo:
             yo = y()
         else:
-            xo = x()
\ No newline at end of file
+            xo = x()
+
+
+def gallop(values, target, start=0):
+    """
+    Find the position of the first value greater than or equal to the target, starting at the specified position
+    and doubling the step until the target is passed (so the cost depends on the distance, not on the length).
+
+    :param values: The sorted values (a list or an array)
+    :param target: The value to search
+    :param start: The position where the search starts
+    :type start: int
+    :return: The position found (or the length of the values, if all the values are smaller than the target)
+    :rtype: int
+    """
+    size = len(values)
+    step = 1
+    end = start
+    while end < size and values[end] < target:
+        start = end + 1
+        end += step
+        step <<= 1
+    return bisect_left(values, target, start, min(end, size))
+
+
+def gallop_intersect(values, other, limit=None):
+    """
+    Intersect a short sorted list with a long one, searching (with gallop) each value of the short list in the long one
+
+    :param values: The short list
+    :param other: The long list
+    :param limit: The maximum number of values returned
+    :type limit: int
+    :return: The values found in both lists, sorted
+    :rtype: list
+    """
+    result = []
+    position = 0
+    size = len(other)
+    for value in values:
+        position = gallop(other, value, position)
+        if position == size:
+            break
+        if other[position] == value:
+            result.append(value)
+            if limit is not None and len(result) >= limit:
+                break
+    return result
+
+
+def intersect_all(lists, limit=None):
+    """
+    Intersect many sorted lists of ids at once. The lists are intersected from the shortest to the longest one, so the
+    partial result only shrinks. When a list is much longer than the partial result, the ids of the partial result
+    are searched in it with gallop (stopping when the limit is reached in the last list). Otherwise a set intersection
+    (that runs in C, so it is faster than any merge made in Python for lists with similar lengths) is used.
+
+    :param lists: The sorted lists (or arrays) of ids
+    :type lists: list
+    :param limit: The maximum number of ids returned
+    :type limit: int
+    :return: The ids found in all the lists, sorted
+    :rtype: list
+    """
+    lists = sorted((values if hasattr(values, "__getitem__") else list(values) for values in lists), key=len)
+    if not lists or not lists[0]:
+        return []
+    result = lists[0]
+    last = len(lists) - 1
+    for i in xrange(1, len(lists)):
+        other = lists[i]
+        if len(other) >= GALLOP_MIN_RATIO * len(result):
+            result = gallop_intersect(result, other, limit if i == last else None)
+        else:
+            result = sorted(set(result).intersection(other))
+        if not result:
+            return []
+    return list(result[:limit])
@@ -0,0 +1,70 @@
+from collections import defaultdict
+from app.support.Trie import Trie
+
+__author__ = 'fernando'
+
+NGRAM_SIZE = 2
+# The words are padded, so the first and the last letters are also part of NGRAM_SIZE n-grams
+NGRAM_PADDING = "$"
+
+
+def get_ngrams(word):
+    """
+    Get the n-grams of the word (padded at start and at end)
+
+    :param word: The word
+    :type word: basestring
+    :return: The n-grams of the word
+    :rtype: set
+    """
+    padding = NGRAM_PADDING * (NGRAM_SIZE - 1)
+    word = "".join([padding, word, padding])
+    return set(word[i:i + NGRAM_SIZE] for i in xrange(len(word) - NGRAM_SIZE + 1))
+
+
+def build_ngrams_index(words):
+    """
+    Build the index of the n-grams of the words
+
+    :param words: The sorted list of words (as saved by searchable)
+    :type words: list
+    :return: An index of each n-gram to the positions of the words that contain it
+    :rtype: Trie
+    """
+    index = Trie()
+    for position, word in enumerate(words):
+        for ngram in get_ngrams(word):
+            index[ngram].append(position)
+    index.compact()
+    return index
+
+
+def get_candidates(ngrams_index, words, word, min_length=0, max_length=None, limit=None):
+    """
+    Get the words that share more n-grams with the word
+
+    :param ngrams_index: The index of n-grams (as returned by build_ngrams_index)
+    :type ngrams_index: Trie
+    :param words: The words used to build the index of n-grams
+    :type words: list
+    :param word: The word
+    :type word: basestring
+    :param min_length: The minimum length of the candidates
+    :type min_length: int
+    :param max_length: The maximum length of the candidates
+    :type max_length: int
+    :param limit: The maximum number of candidates
+    :type limit: int
+    :return: The positions of the candidates, from the ones that share more n-grams to the ones that share less
+    :rtype: list
+    """
+    counts = defaultdict(int)
+    for ngram in get_ngrams(word):
+        for position in ngrams_index.get(ngram, []):
+            counts[position] += 1
+    candidates = [
+        position for position in counts
+        if len(words[position]) >= min_length and (max_length is None or len(words[position]) <= max_length)
+    ]
+    candidates.sort(key=lambda position: (-counts[position], position))
+    return candidates[:limit]
@@ -0,0 +1,77 @@
+import heapq
+from unidecode import unidecode
+
+__author__ = 'fernando'
+
+# Kinds of match of a word of the query with the words of an item (the first word of an item is its code)
+EXACT_CODE = 0
+CODE_PREFIX = 1
+WORD_START = 2
+SUBSTRING = 3
+NO_MATCH = 4
+# Subtracted from the score for each pair of consecutive words of the query found in consecutive words of the item
+PROXIMITY_BONUS = 0.5
+
+
+def get_features(text):
+    """
+    Get the features used to rank an item: its words, normalized as the words of the queries, each one preceded by a
+    space (so the matches are found with the string methods)
+
+    :param text: The text of the item
+    :type text: basestring
+    :return: The words of the text, in order
+    :rtype: str
+    """
+    words = ("".join(filter(str.isalnum, word)) for word in unidecode(unicode(text)).lower().split())
+    return "".join(" " + word for word in words if word)
+
+
+def get_score(features, query_words):
+    """
+    Get the score of an item (the smaller, the more relevant)
+
+    :param features: The features of the item (as returned by get_features)
+    :type features: str
+    :param query_words: The words of the query
+    :type query_words: list
+    :return: The score
+    :rtype: float
+    """
+    score = 0
+    previous = -1
+    for query_word in query_words:
+        word_start = " " + query_word
+        position = features.find(word_start)
+        if position == 0:
+            end = len(word_start)
+            score += EXACT_CODE if end == len(features) or features[end] == " " else CODE_PREFIX
+        elif position > 0:
+            score += WORD_START
+        else:
+            score += SUBSTRING if query_word in features else NO_MATCH
+        if position >= 0 and previous >= 0 and features.find(" ", previous + 1) == position:
+            score -= PROXIMITY_BONUS
+        previous = position
+    return score
+
+
+def rank(positions, features, query_words, limit=None):
+    """
+    Sort the positions of the items by relevance (and by position, between items with the same score)
+
+    :param positions: The positions of the items
+    :type positions: list
+    :param features: The features of all the items (as returned by get_features)
+    :type features: list
+    :param query_words: The words of the query
+    :type query_words: list
+    :param limit: The maximum number of positions returned (only these are fully sorted)
+    :type limit: int
+    :return: The most relevant positions
+    :rtype: list
+    """
+    key = lambda position: (get_score(features[position], query_words), position)
+    if limit is None or limit >= len(positions):
+        return sorted(positions, key=key)
+    return heapq.nsmallest(limit, positions, key=key)
@@ -1,5 +1,8 @@
+import json
 import time
-from app.cache import clear_lru_cache
+from app.cache import clear_lru_cache, cache_metrics
+from app.metrics import summarize
+from werkzeug.utils import import_string
 from app.robot.robot import Robot
 from flask import request
 import logging as _logging
@@ -27,3 +30,27 @@ def update():
 def clear_cache():
     clear_lru_cache()
     return "OK", 200, {}
+
+
+def refresh_cache():
+    data = json.loads(request.get_data())
+    fn = import_string(".".join([data["module"], data["function"]]))
+    kwargs = dict((str(key), value) for key, value in data.get("kwargs", {}).iteritems())
+    logging.debug("Refreshing cache of the function '%s'", data["function"])
+    start = time.time()
+    fn(data["filters"], **kwargs)
+    logging.debug("Refreshed cache of the function '%s' in %f seconds", data["function"], time.time()-start)
+    return "OK", 200, {}
+
+
+def metrics():
+    if request.args.get("scope") == "instance":
+        result = {
+            "instance": cache_metrics.instance_id,
+            "started_on": cache_metrics.started_on,
+            "metrics": cache_metrics.snapshot()
+        }
+    else:
+        result = cache_metrics.get_aggregated()
+    summarize(result["metrics"])
+    return json.dumps(result), 200, {"Content-Type": "application/json"}
\ No newline at end of file
@@ -10,6 +10,11 @@ def get_teams():
     return serialize(result)
 
 
+def search_teams():
+    result = teams.search_teams(request.args.to_dict())
+    return serialize(result)
+
+
 def get_team(id_value):
     result = teams.get_team(id_value)
     return serialize(result)
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+Benchmark of the codecs and compressors of the cache (see app.cache.encode_value) using search indexes like the ones
+saved by the searchable decorator.
+
+Usage:
+    python -m benchmarks.cache_codecs [--campus FLO] [--repeat 3] [--payload FILE ...]
+
+The payloads can also be real ones (for example, downloaded from the GCS bucket of the application), saved either as
+a pickle or as a blob created by the cache.
+"""
+import argparse
+import gc
+import time
+from benchmarks import catalog
+from app import cache
+from app.support.Trie import Trie
+
+__author__ = 'fernando'
+
+COMBINATIONS = [
+    ["pickle", "none", None],
+    ["pickle", "zlib", 1],
+    ["pickle", "zlib", 6],
+    ["pickle", "zlib", 9],
+    ["marshal", "none", None],
+    ["marshal", "zlib", 1],
+    ["marshal", "zlib", 6],
+    ["marshal", "zlib", 9]
+]
+
+
+def build_index(items, get_formatted_string, compact=True):
+    """
+    Build an index (and the list of words) in the same way searchable does (compact=False builds the index with a
+    list for each word, as saved by older versions)
+    """
+    words = {}
+    for item_id, item in enumerate(items):
+        for word in get_formatted_string(item).lower().split():
+            for token in ["".join(filter(unicode.isalnum, word)), "".join(filter(unicode.isdigit, word))]:
+                if token:
+                    words.setdefault(token, set()).add(item_id)
+    index = Trie()
+    for word, items_ids in words.iteritems():
+        index[word].extend(sorted(items_ids))
+    if compact:
+        index.compact()
+    else:
+        index.editable = False
+    return index, index.get_words()
+
+
+def generate_payloads(campus):
+    data = catalog.generate_catalog(campus)
+    disciplines = data["disciplines"]
+    index, words = build_index(disciplines, lambda item: " - ".join([item['code'], item['name']]))
+    return [
+        ["disciplines items", disciplines],
+        ["disciplines index", index],
+        ["disciplines words", words],
+        ["teams items", data["teams"]],
+        ["disciplines teams", data["disciplines_teams"]]
+    ]
+
+
+def load_payload(filename):
+    with open(filename, "rb") as payload_file:
+        return cache.decode_value(payload_file.read())[0]
+
+
+def measure(fn, repeat):
+    best = None
+    result = None
+    for _ in xrange(repeat):
+        gc.collect()
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def run(payloads, repeat):
+    print "%-20s %-8s %-5s %-5s %12s %12s %12s" % (
+        "payload", "codec", "comp", "level", "size (KB)", "encode (ms)", "decode (ms)"
+    )
+    for name, payload in payloads:
+        for codec, compressor, level in COMBINATIONS:
+            try:
+                encode_time, (blob, size) = measure(
+                    lambda: cache.encode_value(payload, codec, compressor, level),
+                    repeat
+                )
+            except ValueError:
+                print "%-20s %-8s (not supported)" % (name, codec)
+                continue
+            decode_time, _ = measure(lambda: cache.decode_value(blob), repeat)
+            print "%-20s %-8s %-5s %-5s %12.1f %12.2f %12.2f" % (
+                name, codec, compressor, level if level is not None else "-", len(blob) / 1024.0,
+                encode_time * 1000, decode_time * 1000
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the codecs of the cache")
+    parser.add_argument("--campus", default="FLO", choices=sorted(catalog.CAMPI_SIZES))
+    parser.add_argument("--repeat", default=3, type=int)
+    parser.add_argument("--payload", action="append", default=[], help="File with a real payload to measure")
+    args = parser.parse_args()
+    payloads = [[filename, load_payload(filename)] for filename in args.payload]
+    if not payloads:
+        payloads = generate_payloads(args.campus)
+    # Compress everything, so the compressors are always measured
+    cache.COMPRESS_MIN_SIZE = 0
+    run(payloads, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
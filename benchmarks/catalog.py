@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import random
+from unidecode import unidecode
+
+__author__ = 'fernando'
+
+DEPARTMENTS = ["INE", "MTM", "FSC", "QMC", "EEL", "EMC", "ECV", "CNM", "DIR", "LLE", "HST", "ENS", "ARQ", "BQA", "CCN",
+               "EGR", "ENF", "FIL", "GCN", "PSI"]
+
+WORDS = [u"Introdução", u"Fundamentos", u"Programação", u"Computação", u"Cálculo", u"Álgebra", u"Linear", u"Física",
+         u"Química", u"Orgânica", u"Estruturas", u"Dados", u"Sistemas", u"Operacionais", u"Redes", u"Computadores",
+         u"Organização", u"Arquitetura", u"Engenharia", u"Software", u"Análise", u"Projeto", u"Algoritmos",
+         u"Matemática", u"Discreta", u"Estatística", u"Probabilidade", u"Economia", u"Direito", u"Constitucional",
+         u"Civil", u"Penal", u"História", u"Filosofia", u"Ética", u"Psicologia", u"Educação", u"Língua", u"Portuguesa",
+         u"Inglesa", u"Literatura", u"Brasileira", u"Geometria", u"Analítica", u"Mecânica", u"Elétrica", u"Circuitos",
+         u"Eletrônica", u"Digital", u"Controle", u"Automação", u"Termodinâmica", u"Fenômenos", u"Transporte",
+         u"Materiais", u"Resistência", u"Bioquímica", u"Genética", u"Ecologia", u"Anatomia", u"Fisiologia",
+         u"Enfermagem", u"Saúde", u"Pública", u"Metodologia", u"Pesquisa", u"Científica", u"Trabalho", u"Conclusão",
+         u"Curso", u"Estágio", u"Supervisionado", u"Tópicos", u"Especiais", u"Laboratório", u"Avançada", u"Teoria",
+         u"Prática", u"Desenho", u"Técnico", u"Gestão", u"Projetos", u"Inteligência", u"Artificial", u"Banco",
+         u"Segurança", u"Informação", u"Compiladores", u"Linguagens", u"Formais", u"Autômatos", u"Paralela",
+         u"Distribuída", u"Gráfica", u"Interação", u"Humano", u"Numérico", u"Cálculo", u"Vetorial", u"Equações",
+         u"Diferenciais", u"Ordinárias", u"Parciais", u"Séries", u"Sinais"]
+
+CONNECTORS = [u"de", u"da", u"do", u"e", u"em", u"para", u"dos", u"das"]
+
+FIRST_NAMES = [u"José", u"João", u"Antônio", u"Francisco", u"Luís", u"Maria", u"Ana", u"Cláudia", u"Márcia",
+               u"Fábio", u"Sérgio", u"Mário", u"Lúcia", u"Patrícia", u"Vinícius", u"Rogério", u"Renato", u"Fernanda",
+               u"Débora", u"Flávio", u"Ângela", u"Caetano", u"Inês", u"Conceição"]
+
+LAST_NAMES = [u"Silva", u"Santos", u"Oliveira", u"Souza", u"Pereira", u"Lima", u"Carvalho", u"Gonçalves", u"Araújo",
+              u"Ribeiro", u"Müller", u"Schmitz", u"Conceição", u"Magalhães", u"Brandão", u"Falcão", u"Simões",
+              u"Guimarães", u"Assunção", u"Nóbrega"]
+
+BUILDINGS = [u"CTC", u"CFM", u"CFH", u"CCS", u"CCB", u"CED", u"CSE", u"CCJ", u"CDS", u"EFI", u"AUX"]
+
+# Number of disciplines of each campus, approximately
+CAMPI_SIZES = {
+    "FLO": 3600,
+    "JOI": 350,
+    "CBS": 200,
+    "ARA": 300,
+    "BLN": 280
+}
+
+
+def generate_id(*parts):
+    return hashlib.sha1("-".join(map(unicode, parts)).encode("utf-8")).hexdigest()
+
+
+def generate_name(rnd):
+    words = []
+    for i in xrange(rnd.randint(1, 6)):
+        if words and rnd.random() < 0.3:
+            words.append(rnd.choice(CONNECTORS))
+        words.append(rnd.choice(WORDS))
+    if rnd.random() < 0.15:
+        words.append(rnd.choice([u"I", u"II", u"III", u"IV"]))
+    return u" ".join(words)
+
+
+def generate_disciplines(count, campus="FLO", seed=0):
+    """
+    Generate disciplines like the ones returned (as JSON) by the API
+
+    :param count: The number of disciplines to generate
+    :type count: int
+    :param campus: The name of the campus (used in the ids)
+    :type campus: str
+    :param seed: The seed of the random generator
+    :type seed: int
+    :return: A list of dicts with id, code and name of each discipline
+    :rtype: list
+    """
+    rnd = random.Random(seed)
+    disciplines = []
+    codes = set()
+    while len(disciplines) < count:
+        code = u"%s%04d" % (rnd.choice(DEPARTMENTS), rnd.randint(1000, 9999))
+        if code in codes:
+            continue
+        codes.add(code)
+        disciplines.append({
+            "id": generate_id(campus, code),
+            "code": code,
+            "name": generate_name(rnd)
+        })
+    return disciplines
+
+
+def generate_teams(disciplines, campus="FLO", seed=0, min_teams=1, max_teams=6):
+    """
+    Generate teams (with schedules and teachers embedded) for the specified disciplines
+
+    :param disciplines: The disciplines (as returned by generate_disciplines)
+    :type disciplines: list
+    :return: A list with the teams and a list with the disciplines and the ids of their teams
+    :rtype: tuple
+    """
+    rnd = random.Random(seed)
+    teachers = []
+    for i in xrange(max(10, len(disciplines) / 2)):
+        name = u" ".join([rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES), rnd.choice(LAST_NAMES)])
+        teachers.append({
+            "id": generate_id(campus, u"teacher", i),
+            "name": name
+        })
+    teams = []
+    disciplines_teams = []
+    for discipline in disciplines:
+        teams_ids = []
+        for i in xrange(rnd.randint(min_teams, max_teams)):
+            code = u"%02d%03dA" % (rnd.randint(1, 10), 200 + i)
+            team_id = generate_id(campus, discipline["code"], code)
+            schedules = []
+            for j in xrange(rnd.randint(1, 3)):
+                room = u"%s-%03d" % (rnd.choice(BUILDINGS), rnd.randint(1, 350))
+                schedule = {
+                    "hourStart": rnd.choice([7, 8, 10, 13, 15, 18, 20]),
+                    "minuteStart": rnd.choice([30, 20, 10, 0]),
+                    "numberOfLessons": rnd.randint(1, 4),
+                    "dayOfWeek": rnd.randint(2, 7),
+                    "room": room
+                }
+                schedule["id"] = generate_id(*[schedule[key] for key in sorted(schedule)])
+                schedules.append(schedule)
+            offered = rnd.randint(10, 60)
+            teams.append({
+                "id": team_id,
+                "code": code,
+                "vacancies_offered": offered,
+                "vacancies_filled": rnd.randint(0, offered),
+                "schedules": schedules,
+                "teachers": rnd.sample(teachers, rnd.randint(1, 2))
+            })
+            teams_ids.append(team_id)
+        disciplines_teams.append({
+            "id": discipline["id"],
+            "teams": teams_ids
+        })
+    return teams, disciplines_teams
+
+
+def generate_catalog(campus="FLO", size=None, seed=0):
+    """
+    Generate the catalog of a campus
+
+    :param campus: The name of the campus (see CAMPI_SIZES)
+    :type campus: str
+    :param size: The number of disciplines (by default, the size of the campus)
+    :type size: int
+    :return: A dict with the disciplines, the teams and the teams of each discipline
+    :rtype: dict
+    """
+    if size is None:
+        size = CAMPI_SIZES[campus]
+    disciplines = generate_disciplines(size, campus, seed)
+    teams, disciplines_teams = generate_teams(disciplines, campus, seed)
+    return {
+        "disciplines": disciplines,
+        "teams": teams,
+        "disciplines_teams": disciplines_teams
+    }
+
+
+def generate_queries(disciplines, count, seed=0, words=2):
+    """
+    Generate queries (made of prefixes of words of the names of the disciplines) like the ones made by the users
+
+    :param disciplines: The disciplines (as returned by generate_disciplines)
+    :type disciplines: list
+    :param count: The number of queries
+    :type count: int
+    :param words: The maximum number of words of each query
+    :type words: int
+    :return: The list of queries
+    :rtype: list
+    """
+    rnd = random.Random(seed)
+    queries = []
+    for i in xrange(count):
+        discipline = rnd.choice(disciplines)
+        name_words = [word for word in discipline["name"].split() if len(word) > 2]
+        query = [unidecode(word).lower()[:rnd.randint(3, len(word))]
+                 for word in rnd.sample(name_words, min(len(name_words), rnd.randint(1, words)))]
+        queries.append(u" ".join(query))
+    return queries
@@ -0,0 +1,58 @@
+"""
+Microbenchmark of the intersection of posting lists: the pairwise generator (app.support.intersect.intersect, as
+folded by searchable before) against the n-way galloping intersection (app.support.intersect.intersect_all).
+
+Usage:
+    python -m benchmarks.intersect [--campus FLO] [--repeat 5]
+"""
+import argparse
+import random
+from app.support.islice import islice
+from app.support.intersect import intersect, intersect_all
+from benchmarks import catalog
+from benchmarks.cache_codecs import build_index, measure
+
+__author__ = 'fernando'
+
+
+def generate_cases(campus):
+    """
+    Generate the cases: the lists of the words of queries made over a generated catalog, and synthetic lists with
+    similar and very different lengths
+    """
+    disciplines = catalog.generate_catalog(campus)["disciplines"]
+    index, _ = build_index(disciplines, lambda item: " - ".join([item['code'], item['name']]))
+    queries = catalog.generate_queries(disciplines, 200, words=3)
+    rnd = random.Random(0)
+    universe = xrange(100000)
+    return [
+        ["catalog queries", [[index.get_list(word) for word in query.split()] for query in queries]],
+        ["similar lengths", [[sorted(rnd.sample(universe, 5000)) for _ in xrange(3)] for _ in xrange(10)]],
+        ["skewed lengths", [[sorted(rnd.sample(universe, 50)), sorted(rnd.sample(universe, 20000)),
+                             sorted(rnd.sample(universe, 50000))] for _ in xrange(10)]]
+    ]
+
+
+def run(campus, repeat, limit):
+    print "%-18s %16s %16s %16s" % ("case", "pairwise (ms)", "n-way (ms)", "n-way limit (ms)")
+    for name, cases in generate_cases(campus):
+        pairwise_time, _ = measure(
+            lambda: [list(islice(reduce(intersect, lists), 0, limit)) for lists in cases],
+            repeat
+        )
+        nway_time, _ = measure(lambda: [intersect_all(lists) for lists in cases], repeat)
+        limit_time, _ = measure(lambda: [intersect_all(lists, limit) for lists in cases], repeat)
+        print "%-18s %16.2f %16.2f %16.2f" % (name, pairwise_time * 1000, nway_time * 1000, limit_time * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the intersection of posting lists")
+    parser.add_argument("--campus", default="FLO", choices=sorted(catalog.CAMPI_SIZES))
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--limit", default=41, type=int, help="Number of results of the limited intersection")
+    args = parser.parse_args()
+    run(args.campus, args.repeat, args.limit)
+
+
+if __name__ == "__main__":
+    main()
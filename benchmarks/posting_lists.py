@@ -0,0 +1,76 @@
+"""
+Benchmark of the representation of the posting lists of the search indexes: a list for each word (as saved by older
+versions) against the compact index (see app.support.Trie.Trie.compact).
+
+Usage:
+    python -m benchmarks.posting_lists [--campus FLO] [--repeat 5]
+"""
+import argparse
+import gc
+import sys
+from benchmarks import catalog
+from benchmarks.cache_codecs import build_index, measure
+from app import cache
+
+__author__ = 'fernando'
+
+
+def get_memory_size(value, seen=None):
+    """
+    Get the memory used by the value and by all the objects referenced by it (each object is counted once)
+
+    :param value: The value
+    :return: The size, in bytes
+    :rtype: int
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += get_memory_size(key, seen) + get_memory_size(item, seen)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            size += get_memory_size(item, seen)
+    for name in getattr(type(value), "__slots__", []):
+        size += get_memory_size(getattr(value, name, None), seen)
+    return size
+
+
+def run(campus, repeat):
+    data = catalog.generate_catalog(campus)
+    disciplines = data["disciplines"]
+    queries = catalog.generate_queries(disciplines, 200, words=1)
+    print "%-10s %12s %12s %12s %12s" % ("index", "memory (KB)", "blob (KB)", "load (ms)", "lookup (us)")
+    for name, compact in [["lists", False], ["compact", True]]:
+        blob, _ = cache.encode_value(
+            build_index(disciplines, lambda item: " - ".join([item['code'], item['name']]), compact)[0]
+        )
+        load_time, index = measure(lambda: cache.decode_value(blob)[0], repeat)
+        gc.collect()
+        memory = get_memory_size(index)
+
+        def lookup():
+            for query in queries:
+                index.prefix_cache.clear()
+                index.get_list(query)
+
+        lookup_time, _ = measure(lookup, repeat)
+        print "%-10s %12.1f %12.1f %12.2f %12.2f" % (
+            name, memory / 1024.0, len(blob) / 1024.0, load_time * 1000, lookup_time * 1000000 / len(queries)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the posting lists of the search indexes")
+    parser.add_argument("--campus", default="FLO", choices=sorted(catalog.CAMPI_SIZES))
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+    run(args.campus, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
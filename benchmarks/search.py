@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the searches made with the searchable decorator over generated catalogs (see benchmarks.catalog), from
+a small campus up to all the campi in a single index. The real decorator is used, with the cache (and GCS) replaced
+by a store in memory (see tests.helpers.MemoryStore), measuring:
+
+ - build: the creation of the index (as made by the robot)
+ - prefix: queries with a single prefix of a word
+ - multi-word: queries with prefixes of many words of the same discipline
+ - misspelled: queries with a misspelled word (that look for suggestions)
+ - paging: all the pages (by cursor) of queries with many results
+
+Usage:
+    python -m benchmarks.search [--campus CBS --campus FLO --campus ALL] [--backend default --backend file]
+                                [--queries 300] [--builds 3] [--cold] [--query-cache]
+
+By default the values are kept as objects in the store (as in the LRU cache of an instance that is already warm).
+With --cold, they are encoded when saved and decoded on each read (as on an instance that reads everything from
+memcache). Each query is made with the cache of queries empty, unless --query-cache is specified.
+"""
+import argparse
+import gc
+import math
+import random
+import time
+from app.decorators import searchable
+from benchmarks import catalog
+from benchmarks.suggestions import misspell
+from tests.helpers import MemoryStore
+
+__author__ = 'fernando'
+
+PREFIX = "matrufsc2-discipline-"
+ALL_CAMPI = "ALL"
+BACKENDS = {
+    "default": None,
+    "file": searchable.INDEX_BACKEND_FILE
+}
+PERCENTILES = [50, 90, 99]
+# The paging queries (prefixes with up to PAGING_PREFIX_LENGTH letters, so they have many results) are walked until
+# PAGING_MAX_PAGES pages
+PAGING_PREFIX_LENGTH = 2
+PAGING_MAX_PAGES = 20
+PAGE_LIMIT = 10
+
+
+def generate_disciplines(campus):
+    """
+    Generate the disciplines of the campus (or of all the campi, with ALL_CAMPI), with the ids as saved on NDB
+    """
+    if campus == ALL_CAMPI:
+        campi = sorted(catalog.CAMPI_SIZES)
+    else:
+        campi = [campus]
+    disciplines = []
+    for seed, name in enumerate(campi):
+        disciplines.extend(catalog.generate_catalog(name, seed=seed)["disciplines"])
+    return [dict(discipline, id=PREFIX + discipline["id"]) for discipline in disciplines]
+
+
+def create_search(disciplines, backend):
+    """
+    Create a function decorated like app.api.disciplines.get_disciplines, that returns the disciplines
+    """
+    @searchable.searchable(
+        lambda item: " - ".join([item['code'], item['name']]),
+        prefix=PREFIX,
+        consider_only=['campus'],
+        index_backend=BACKENDS[backend]
+    )
+    def get_disciplines(filters):
+        # A new list on each call, as returned by the repository
+        return [dict(discipline) for discipline in disciplines]
+    return get_disciplines
+
+
+def generate_workloads(disciplines, count, seed=0):
+    """
+    Generate the queries of each workload
+
+    :return: A list with the name and the queries of each workload
+    :rtype: list
+    """
+    rnd = random.Random(seed)
+    prefixes = [query.split()[0] for query in catalog.generate_queries(disciplines, count, seed, words=1)]
+    prefixes = [prefix[:rnd.randint(1, len(prefix))] for prefix in prefixes]
+    multi_word = [query for query in catalog.generate_queries(disciplines, count * 3, seed, words=4)
+                  if len(query.split()) > 1][:count]
+    misspelled = []
+    for query in catalog.generate_queries(disciplines, count * 3, seed + 1, words=3):
+        words = query.split()
+        long_words = [position for position, word in enumerate(words) if len(word) > 4]
+        if long_words:
+            position = rnd.choice(long_words)
+            words[position] = misspell(words[position], rnd)
+            misspelled.append(u" ".join(words))
+        if len(misspelled) == count:
+            break
+    paging = sorted(set(prefix[:PAGING_PREFIX_LENGTH] for prefix in prefixes))[:count]
+    return [
+        ["prefix", prefixes],
+        ["multi-word", multi_word],
+        ["misspelled", misspelled],
+        ["paging", paging]
+    ]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+def report(size, backend, workload, times):
+    total = sum(times)
+    print "%-6s %-8s %-11s %7d %10.1f %9.2f %9.2f %9.2f %9.2f" % tuple(
+        [size, backend, workload, len(times), len(times) / total if total else 0] +
+        [percentile(times, percent) * 1000 for percent in PERCENTILES] +
+        [max(times) * 1000]
+    )
+
+
+def run_queries(search, campus, queries, query_cache):
+    times = []
+    for query in queries:
+        if not query_cache:
+            searchable.query_cache.clear()
+        start = time.time()
+        search({"campus": campus, "q": query})
+        times.append(time.time() - start)
+    return times
+
+
+def run_paging(search, campus, queries, query_cache):
+    times = []
+    for query in queries:
+        if not query_cache:
+            searchable.query_cache.clear()
+        filters = {"campus": campus, "q": query, "limit": PAGE_LIMIT}
+        for _ in xrange(PAGING_MAX_PAGES):
+            start = time.time()
+            result = search(filters)
+            times.append(time.time() - start)
+            if not result["next_cursor"]:
+                break
+            filters["cursor"] = result["next_cursor"]
+    return times
+
+
+def run(campi, backends, queries_count, builds, cold, query_cache):
+    print "%-6s %-8s %-11s %7s %10s %9s %9s %9s %9s" % tuple(
+        ["size", "backend", "workload", "count", "ops/s"] + ["p%d (ms)" % percent for percent in PERCENTILES] +
+        ["max (ms)"]
+    )
+    for campus in campi:
+        disciplines = generate_disciplines(campus)
+        workloads = generate_workloads(disciplines, queries_count)
+        size = len(disciplines)
+        for backend in backends:
+            store = MemoryStore(cold)
+            store.install()
+            search = create_search(disciplines, backend)
+            times = []
+            for _ in xrange(builds):
+                gc.collect()
+                start = time.time()
+                search({"campus": campus, "q": disciplines[0]["code"]}, overwrite=True, index=True)
+                times.append(time.time() - start)
+            report(size, backend, "build", times)
+            for workload, queries in workloads:
+                run_workload = run_paging if workload == "paging" else run_queries
+                report(size, backend, workload, run_workload(search, campus, queries, query_cache))
+            print "%-6s %-8s stored %.1f KB" % (size, backend, store.get_size() / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the searches")
+    parser.add_argument("--campus", action="append", choices=sorted(catalog.CAMPI_SIZES) + [ALL_CAMPI])
+    parser.add_argument("--backend", action="append", choices=sorted(BACKENDS))
+    parser.add_argument("--queries", default=300, type=int)
+    parser.add_argument("--builds", default=3, type=int)
+    parser.add_argument("--cold", action="store_true", help="Decode the values on each read")
+    parser.add_argument("--query-cache", action="store_true", help="Keep the cache of the queries between queries")
+    args = parser.parse_args()
+    run(args.campus or ["CBS", "FLO", ALL_CAMPI], args.backend or sorted(BACKENDS), args.queries, args.builds,
+        args.cold, args.query_cache)
+
+
+if __name__ == "__main__":
+    main()
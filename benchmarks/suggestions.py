@@ -0,0 +1,88 @@
+"""
+Benchmark of the candidates of the suggestions ("did you mean"): the scan of all the words (as made by searchable
+before) against the index of n-grams (app.support.ngrams), measuring the time and how many suggestions are the same.
+
+Usage:
+    python -m benchmarks.suggestions [--campus FLO] [--queries 300] [--candidates 500]
+"""
+import argparse
+import random
+import time
+from unidecode import unidecode
+from app.decorators.searchable import SUGGESTION_MAX_DISTANCE
+from app.support.ngrams import build_ngrams_index, get_candidates
+from app.support.sift3 import sift3
+from benchmarks import catalog
+from benchmarks.cache_codecs import build_index
+
+__author__ = 'fernando'
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def misspell(word, rnd):
+    word = list(word)
+    for _ in xrange(rnd.randint(1, 2)):
+        operation = rnd.randint(0, 2)
+        position = rnd.randrange(len(word))
+        if operation == 0:
+            del word[position]
+        elif operation == 1:
+            word.insert(position, rnd.choice(LETTERS))
+        else:
+            word[position] = rnd.choice(LETTERS)
+    return "".join(word)
+
+
+def scan_suggestions(words, word):
+    length = len(word)
+    distances = sorted(
+        (sift3(candidate, word), position) for position, candidate in enumerate(words) if len(candidate) >= length
+    )
+    return [position for distance, position in distances if distance <= SUGGESTION_MAX_DISTANCE][:50]
+
+
+def ngrams_suggestions(ngrams, words, word, candidates):
+    length = len(word)
+    positions = get_candidates(ngrams, words, word, length, length + 2 * SUGGESTION_MAX_DISTANCE + 1, candidates)
+    distances = sorted((sift3(words[position], word), position) for position in positions)
+    return [position for distance, position in distances if distance <= SUGGESTION_MAX_DISTANCE][:50]
+
+
+def run(campus, queries_count, candidates):
+    disciplines = catalog.generate_catalog(campus)["disciplines"]
+    _, words = build_index(
+        disciplines,
+        lambda item: unidecode(" - ".join([item['code'], item['name']])).decode("ascii")
+    )
+    start = time.time()
+    ngrams = build_ngrams_index(words)
+    print "%d words, index of n-grams built in %.1f ms" % (len(words), (time.time() - start) * 1000)
+    rnd = random.Random(0)
+    long_words = [word for word in words if len(word) > 4]
+    queries = [misspell(rnd.choice(long_words), rnd) for _ in xrange(queries_count)]
+    start = time.time()
+    expected = [scan_suggestions(words, query) for query in queries]
+    scan_time = time.time() - start
+    start = time.time()
+    found = [ngrams_suggestions(ngrams, words, query, candidates) for query in queries]
+    ngrams_time = time.time() - start
+    print "%-10s %14s" % ("method", "time (ms/word)")
+    print "%-10s %14.2f" % ("scan", scan_time * 1000 / len(queries))
+    print "%-10s %14.2f" % ("n-grams", ngrams_time * 1000 / len(queries))
+    for top in [1, 5, 50]:
+        same = sum(1 for a, b in zip(expected, found) if a[:top] == b[:top])
+        print "Same top %d suggestions: %.1f%%" % (top, same * 100.0 / len(queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the candidates of the suggestions")
+    parser.add_argument("--campus", default="FLO", choices=sorted(catalog.CAMPI_SIZES))
+    parser.add_argument("--queries", default=300, type=int)
+    parser.add_argument("--candidates", default=500, type=int)
+    args = parser.parse_args()
+    run(args.campus, args.queries, args.candidates)
+
+
+if __name__ == "__main__":
+    main()
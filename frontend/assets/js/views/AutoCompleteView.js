@@ -116,6 +116,7 @@ define("views/AutoCompleteView", ["chaplin", "underscore", "jquery", "es6-promis
         "pageable": false,
         "url": null,
         "page": 1,
+        "nextCursor": null,
         "results": [],
         "selectedItem": 0,
         "searchString": "",
@@ -192,6 +193,7 @@ define("views/AutoCompleteView", ["chaplin", "underscore", "jquery", "es6-promis
             lowerSearchString = words.join(" ");
             this.searchString = lowerSearchString;
             this.page = 1;
+            this.nextCursor = null;
             this.lockMore = true;
             this.doRequest(lowerSearchString);
         },
@@ -201,6 +203,10 @@ define("views/AutoCompleteView", ["chaplin", "underscore", "jquery", "es6-promis
             if (this.pageable) {
                 url = url.replace("%(page)d", this.page);
                 url = url.replace("%(pageSize)d", this.pageSize);
+                if (this.page > 1 && this.nextCursor) {
+                    // The next page is sliced from the results of the previous page, without a new search
+                    url += "&cursor=" + encodeURIComponent(this.nextCursor);
+                }
             }
             return url;
         },
@@ -328,6 +334,7 @@ define("views/AutoCompleteView", ["chaplin", "underscore", "jquery", "es6-promis
             }
             results = results.results;
             this.more = response.more;
+            this.nextCursor = response.next_cursor || null;
             this.results = results;
             this.render();
         },
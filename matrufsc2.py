@@ -81,6 +81,7 @@ url("/api/disciplines/<id_value>", "disciplines.get_discipline")
 
 # Teams
 url("/api/teams/", "teams.get_teams")
+url("/api/teams/search/", "teams.search_teams")
 url("/api/teams/<id_value>", "teams.get_team")
 
 # Plans
@@ -129,6 +130,8 @@ url("/api/prismic_preview/", "prismic.prismic_preview")
 # Secret Routes
 url("/secret/update/", "secret.update", methods=["GET", "POST"])
 url("/secret/clear_cache/", "secret.clear_cache", methods=["GET", "POST"])
+url("/secret/refresh_cache/", "secret.refresh_cache", methods=["POST"])
+url("/secret/metrics/", "secret.metrics")
 
 # About
 url("/sobre/", "about.about")
@@ -0,0 +1,17 @@
+"""
+Tests of the backend. They must be run from the root of the repository with the App Engine SDK in the PYTHONPATH,
+like:
+
+    PYTHONPATH=<path to the SDK> python -m unittest discover tests
+"""
+import os
+import sys
+
+__author__ = 'fernando'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The same libraries vendored by appengine_config.py
+LIB = os.path.join(ROOT, "gaenv_lib")
+if os.path.isdir(LIB) and LIB not in sys.path:
+    sys.path.insert(0, LIB)
@@ -0,0 +1,179 @@
+"""
+Helpers shared by the tests (and by the benchmarks)
+"""
+from StringIO import StringIO
+from google.appengine.ext import ndb
+from app import cache
+from app.decorators import cacheable, keyed, searchable
+
+__author__ = 'fernando'
+
+
+def result(value):
+    """
+    Get a future already resolved with the value
+    """
+    future = ndb.Future()
+    future.set_result(value)
+    return future
+
+
+class Clock(object):
+    """
+    Clock that only advances when told to
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class MemoryFile(StringIO):
+    def __init__(self, files, filename, mode):
+        StringIO.__init__(self, files[filename] if mode == "r" else "")
+        self.files = files
+        self.filename = filename
+        self.mode = mode
+
+    def close(self):
+        if self.mode == "w":
+            self.files[self.filename] = self.getvalue()
+        StringIO.close(self)
+
+
+class MemoryStore(object):
+    """
+    Store in memory with the interface of the functions of app.cache (and of cloudstorage) used by searchable, by
+    keyed and by cacheable
+    """
+    NotFoundError = IOError
+
+    def __init__(self, cold=False):
+        self.cold = cold
+        self.values = {}
+        self.files = {}
+        self.generations = {}
+        self.refreshed = []
+
+    @staticmethod
+    def result(value):
+        return result(value)
+
+    def install(self):
+        for module in [searchable, keyed, cacheable]:
+            for name in ["get_from_cache", "get_many_from_cache", "set_into_cache", "set_many_into_cache",
+                         "delete_from_cache", "get_generation", "set_generation", "enqueue_refresh", "get_gcs_filename",
+                         "write_to_gcs"]:
+                if hasattr(module, name):
+                    setattr(module, name, getattr(self, name))
+        searchable.gcs = self
+        # The index files of the other stores are not valid anymore
+        cache.lru_cache.clear_prefix(searchable.CACHE_INDEX_PREFIX)
+        searchable.query_cache.clear()
+
+    def get_size(self):
+        """
+        Get the number of bytes saved (as encoded by the cache)
+        """
+        blobs = self.values.itervalues()
+        if not self.cold:
+            blobs = (cache.encode_value(value)[0] for value in blobs)
+        return sum(len(blob) for blob in blobs) + sum(len(blob) for blob in self.files.itervalues())
+
+    def get_value(self, key):
+        value = self.values.get(key)
+        if self.cold and value is not None:
+            value = cache.decode_value(value)[0]
+        return value
+
+    def get_from_cache(self, key, persistent=True, memcache=True, log=True):
+        return self.result(self.get_value(key))
+
+    def get_many_from_cache(self, keys, persistent=True, memcache=True, log=True):
+        return self.result(map(self.get_value, keys))
+
+    def set_many_into_cache(self, values, persistent=True, memcache=True, log=True, codec=None, compressor=None):
+        for key, value in values.iteritems():
+            self.values[key] = cache.encode_value(value, codec, compressor)[0] if self.cold else value
+        return self.result(None)
+
+    def set_into_cache(self, key, value, persistent=True, memcache=True, log=True, codec=None, compressor=None):
+        return self.set_many_into_cache({key: value}, persistent, memcache, log, codec, compressor)
+
+    def delete_from_cache(self, key, persistent=True):
+        self.values.pop(key, None)
+        self.files.pop(key, None)
+        return self.result(None)
+
+    def get_generation(self, namespace):
+        return self.result(self.generations.get(namespace, 0))
+
+    def set_generation(self, namespace, generation):
+        self.generations[namespace] = generation
+        return self.result(None)
+
+    def enqueue_refresh(self, key, fn, filters, queue_name="frontend", **kwargs):
+        self.refreshed.append(key)
+        return False
+
+    def get_gcs_filename(self, filename):
+        return self.result(filename)
+
+    def write_to_gcs(self, filename, blob):
+        self.files[filename] = blob
+
+    def open(self, filename, mode="r", **kwargs):
+        if mode == "r" and filename not in self.files:
+            raise self.NotFoundError(filename)
+        return MemoryFile(self.files, filename, mode)
+
+
+class MemoryMemcache(object):
+    """
+    Memcache in memory, with the interface of the context of NDB (used by app.cache) and of the memcache client
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def memcache_get(self, key, use_cache=True):
+        return result(self.values.get(key))
+
+    def memcache_set(self, key, value, time=0):
+        self.values[key] = value
+        return result(True)
+
+    def memcache_add(self, key, value, time=0):
+        return result(self.add(key, value, time))
+
+    def memcache_delete(self, key, seconds=0):
+        self.values.pop(key, None)
+        return result(True)
+
+    def Client(self):
+        return self
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def gets(self, key):
+        return self.values.get(key)
+
+    def get_multi(self, keys):
+        return dict((key, self.values[key]) for key in keys if key in self.values)
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def cas(self, key, value, time=0):
+        self.values[key] = value
+        return True
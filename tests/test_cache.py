@@ -0,0 +1,389 @@
+import os
+import pickle
+import threading
+import time
+import unittest
+from array import array
+from collections import OrderedDict
+from app import cache
+from tests.helpers import Clock, MemoryMemcache, result
+
+__author__ = 'fernando'
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.time = cache.time
+        cache.time = self.clock
+        self.lru = cache.LRUCache()
+        self.lru.set_capacity(3)
+        self.lru.set_expiration(60)
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def test_least_recently_used_item_is_evicted_over_the_capacity(self):
+        self.lru.set("a", 1)
+        self.lru.set("b", 2)
+        self.lru.set("c", 3)
+        self.assertEqual(1, self.lru.get("a"))
+        self.lru.set("d", 4)
+        self.assertEqual(["a", "c", "d"], sorted(self.lru.keys()))
+        self.lru.set("c", 5)
+        self.lru.set("e", 6)
+        self.assertEqual(["c", "d", "e"], sorted(self.lru.keys()))
+        self.assertEqual(5, self.lru.get("c"))
+
+    def test_expired_items_are_removed(self):
+        self.lru.set("a", 1)
+        self.lru.set("b", 2, ttl=10)
+        self.clock.now += 11
+        self.assertIsNone(self.lru.get("b"))
+        self.assertEqual(1, self.lru.get("a"))
+        self.clock.now += 50
+        self.assertIsNone(self.lru.get("a"))
+        self.assertEqual(0, len(self.lru))
+
+    def test_overwritten_item_expires_with_its_last_ttl(self):
+        self.lru.set("a", 1, ttl=10)
+        self.lru.set("a", 2, ttl=100)
+        self.clock.now += 11
+        self.assertEqual(2, self.lru.get("a"))
+
+    def test_expiration_heap_does_not_grow_with_overwrites(self):
+        self.lru.set_capacity(100)
+        for value in xrange(1000):
+            self.lru.set("a", value)
+        self.assertEqual(999, self.lru.get("a"))
+        self.assertLessEqual(len(self.lru.expiration_heap), 2 * len(self.lru) + 65)
+
+    def test_pop_and_clear_prefix(self):
+        self.lru.set("index/a", 1)
+        self.lru.set("index/b", 2)
+        self.lru.set("other", 3)
+        self.assertEqual(3, self.lru.pop("other"))
+        self.assertIsNone(self.lru.pop("other"))
+        self.lru.clear_prefix("index/")
+        self.assertEqual(0, len(self.lru))
+        # The recency list is still consistent after the removals
+        for key in ["a", "b", "c", "d"]:
+            self.lru.set(key, key)
+        self.assertEqual(["b", "c", "d"], sorted(self.lru.keys()))
+
+
+class LRUCacheSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.lru = cache.LRUCache()
+        self.lru.set_capacity(100)
+
+    def test_least_recently_used_items_are_evicted_over_the_byte_budget(self):
+        self.lru.set_max_size(30)
+        self.lru.set("a", "a", 10)
+        self.lru.set("b", "b", 10)
+        self.lru.set("c", "c", 10)
+        self.lru.get("a")
+        self.lru.set("d", "d", 10)
+        self.assertEqual(["a", "c", "d"], sorted(self.lru.keys()))
+        self.assertEqual(30, self.lru.get_size())
+
+    def test_items_of_a_namespace_do_not_evict_the_other_items(self):
+        self.lru.set_max_size(100)
+        self.lru.set_namespace_max_size("index/", 20)
+        self.lru.set("other", "other", 10)
+        for position in xrange(5):
+            self.lru.set("index/%d" % position, position, 10)
+        self.assertEqual(["index/3", "index/4", "other"], sorted(self.lru.keys()))
+        self.assertEqual(30, self.lru.get_size())
+
+    def test_items_larger_than_the_budget_are_not_saved(self):
+        self.lru.set_max_size(100)
+        self.lru.set_namespace_max_size("index/", 20)
+        self.lru.set("index/large", "large", 21)
+        self.lru.set("other", "other", 50)
+        self.assertEqual(["other"], self.lru.keys())
+
+    def test_size_is_estimated_when_not_known(self):
+        self.lru.set_max_size(1000)
+        self.lru.set("value", range(100))
+        self.assertEqual(cache.estimate_size(range(100)), self.lru.get_size())
+        self.lru.set("value", "abc")
+        self.assertEqual(3, self.lru.get_size())
+
+    def test_size_is_not_estimated_without_budgets(self):
+        self.lru.set("value", range(100))
+        self.assertEqual(0, self.lru.get_size())
+
+
+class CodecsTest(unittest.TestCase):
+    def get_codec(self, blob):
+        return cache.codecs[cache.BLOB_HEADER.unpack_from(blob)[1]].name
+
+    def test_plain_data_is_encoded_with_marshal(self):
+        value = {"items": [{"id": u"1", "code": "INE5401", "teams": (1, 2L, 3.0)}], "count": None}
+        blob, size = cache.encode_value(value)
+        self.assertEqual("marshal", self.get_codec(blob))
+        self.assertEqual(value, cache.decode_value(blob)[0])
+
+    def test_arrays_and_buffers_are_encoded_with_pickle(self):
+        for value in [array("i", [1, 2, 3]), {"postings": array("i", [1, 2, 3])}, [buffer("abc")]]:
+            self.assertEqual("pickle", self.get_codec(cache.encode_value(value)[0]))
+        value = {"postings": array("i", [1, 2, 3])}
+        decoded = cache.decode_value(cache.encode_value(value)[0])[0]
+        self.assertEqual(value, decoded)
+        self.assertIs(array, type(decoded["postings"]))
+
+    def test_subclasses_and_cycles_are_encoded_with_pickle(self):
+        cycle = []
+        cycle.append(cycle)
+        for value in [OrderedDict(a=1), [Plain("a")], cycle]:
+            self.assertEqual("pickle", self.get_codec(cache.encode_value(value)[0]))
+        decoded = cache.decode_value(cache.encode_value([Plain("a")])[0])[0]
+        self.assertIs(Plain, type(decoded[0]))
+
+    def test_large_values_are_compressed(self):
+        value = "a" * cache.COMPRESS_MIN_SIZE
+        blob, size = cache.encode_value(value)
+        self.assertEqual(cache.COMPRESS_MIN_SIZE + 5, size)
+        self.assertLess(len(blob), size)
+        self.assertEqual((value, size), cache.decode_value(blob))
+
+    def test_values_saved_before_the_header_are_unpickled(self):
+        self.assertEqual([1, 2], cache.decode_value(pickle.dumps([1, 2]))[0])
+
+
+class TiersTest(unittest.TestCase):
+    """
+    Base of the tests of the tiers of the cache, with memcache and GCS in memory
+    """
+
+    def setUp(self):
+        self.memcache = MemoryMemcache()
+        self.files = {}
+        self.reads = []
+        self.patched = {}
+        self.patch("ndb_context", self.memcache)
+        self.patch("get_gcs_filename", lambda filename: result("/bucket/" + filename))
+        self.patch("read_from_gcs", self.read_from_gcs)
+        self.patch("write_to_gcs", self.files.__setitem__)
+        cache.lru_cache.clear()
+
+    def tearDown(self):
+        for name, value in self.patched.iteritems():
+            setattr(cache, name, value)
+        cache.lru_cache.clear()
+
+    def patch(self, name, value):
+        self.patched[name] = getattr(cache, name)
+        setattr(cache, name, value)
+
+    def read_from_gcs(self, filename):
+        self.reads.append(filename)
+        return self.files.get(filename)
+
+
+class NegativeCacheTest(TiersTest):
+    def test_missing_key_is_read_from_gcs_once(self):
+        self.assertIsNone(cache.get_from_cache("missing").get_result())
+        self.assertIsNone(cache.get_from_cache("missing").get_result())
+        self.assertEqual(["/bucket/missing"], self.reads)
+        self.assertEqual(cache.KEY_ABSENT, self.memcache.values[cache.NEGATIVE_CACHE_KEY % "missing"])
+
+    def test_absent_key_is_known_by_the_other_instances(self):
+        cache.get_from_cache("missing").get_result()
+        # The LRU cache of another instance does not know the key
+        cache.lru_cache.clear()
+        self.assertIsNone(cache.get_from_cache("missing").get_result())
+        self.assertEqual(1, len(self.reads))
+
+    def test_saved_key_is_not_absent_anymore(self):
+        cache.get_from_cache("key").get_result()
+        cache.set_into_cache("key", [1, 2], memcache=False).get_result()
+        self.assertEqual(cache.KEY_PRESENT, self.memcache.values[cache.NEGATIVE_CACHE_KEY % "key"])
+        cache.lru_cache.clear()
+        self.assertEqual([1, 2], cache.get_from_cache("key").get_result())
+        self.assertEqual(2, len(self.reads))
+
+    def test_absent_key_is_not_marked_over_a_recent_write(self):
+        cache.set_into_cache("key", [1, 2], memcache=False).get_result()
+        # A miss that started before the write (and found nothing on GCS) cannot mark the key as absent
+        del self.files["/bucket/key"]
+        cache.lru_cache.clear()
+        cache.get_from_cache("key").get_result()
+        self.assertEqual(cache.KEY_PRESENT, self.memcache.values[cache.NEGATIVE_CACHE_KEY % "key"])
+
+
+class SingleFlightTest(TiersTest):
+    def read_from_gcs(self, filename):
+        time.sleep(0.1)
+        return super(SingleFlightTest, self).read_from_gcs(filename)
+
+    def test_concurrent_fetches_of_a_key_are_made_once(self):
+        self.files["/bucket/key"] = cache.encode_value({"items": range(10)})[0]
+        fetched = []
+        threads = [
+            threading.Thread(target=lambda: fetched.append(cache.get_from_cache("key").get_result())) for _ in xrange(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["/bucket/key"], self.reads)
+        self.assertEqual(4, len(fetched))
+        # The value is decoded once and shared by all the callers
+        self.assertTrue(all(value is fetched[0] for value in fetched))
+        self.assertEqual({}, cache.in_flight)
+
+    def test_fetches_of_different_keys_are_not_shared(self):
+        self.files["/bucket/a"] = cache.encode_value("a")[0]
+        self.files["/bucket/b"] = cache.encode_value("b")[0]
+        fetched = {}
+        threads = [
+            threading.Thread(target=lambda key=key: fetched.__setitem__(key, cache.get_from_cache(key).get_result()))
+            for key in ["a", "b"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({"a": "a", "b": "b"}, fetched)
+        self.assertEqual(["/bucket/a", "/bucket/b"], sorted(self.reads))
+
+
+class BatchesTest(TiersTest):
+    def test_values_are_fetched_from_each_tier_in_the_order_of_the_keys(self):
+        cache.lru_cache.set("lru", "from lru")
+        self.memcache.values["memcache"] = cache.encode_value("from memcache")[0]
+        self.files["/bucket/gcs"] = cache.encode_value("from gcs")[0]
+        keys = ["gcs", "missing", "lru", "memcache", "gcs"]
+        self.assertEqual(["from gcs", None, "from lru", "from memcache", "from gcs"],
+                         cache.get_many_from_cache(keys).get_result())
+        self.assertEqual(["/bucket/gcs", "/bucket/missing"], sorted(self.reads))
+
+    def test_values_found_on_the_slower_tiers_are_saved_on_the_faster_ones(self):
+        self.memcache.values["memcache"] = cache.encode_value("from memcache")[0]
+        self.files["/bucket/gcs"] = cache.encode_value("from gcs")[0]
+        cache.get_many_from_cache(["memcache", "gcs"]).get_result()
+        self.assertEqual("from memcache", cache.lru_cache.get("memcache"))
+        self.assertEqual("from gcs", cache.lru_cache.get("gcs"))
+        self.assertEqual(self.files["/bucket/gcs"], self.memcache.values["gcs"])
+
+    def test_values_are_saved_on_all_the_tiers(self):
+        cache.set_many_into_cache({"a": [1], "b": {"c": 2}}).get_result()
+        self.assertEqual([1], cache.lru_cache.get("a"))
+        self.assertEqual({"c": 2}, cache.decode_value(self.memcache.values["b"])[0])
+        self.assertEqual(self.memcache.values["a"], self.files["/bucket/a"])
+        cache.lru_cache.clear()
+        del self.memcache.values["a"]
+        self.assertEqual([[1], {"c": 2}], cache.get_many_from_cache(["a", "b"]).get_result())
+
+    def test_values_not_persistent_are_not_saved_on_gcs(self):
+        cache.set_many_into_cache({"a": [1]}, persistent=False).get_result()
+        self.assertEqual({}, self.files)
+        self.assertIn("a", self.memcache.values)
+
+
+class ChunksTest(TiersTest):
+    def setUp(self):
+        super(ChunksTest, self).setUp()
+        # Random data, so the value is not compressed below the limit of memcache
+        self.value = os.urandom(int(cache.MEMCACHE_CHUNK_SIZE * 2.5))
+
+    def get_chunks_keys(self):
+        return sorted(key for key in self.memcache.values if key.startswith("key/chunk/"))
+
+    def test_small_values_are_not_chunked(self):
+        self.assertEqual({"key": "blob"}, cache.encode_memcache_value("key", "blob"))
+
+    def test_large_values_are_saved_in_chunks(self):
+        blob = cache.encode_value(self.value)[0]
+        items = cache.encode_memcache_value("key", blob)
+        manifest = items.pop("key")
+        self.assertIsInstance(manifest, cache.ChunkedItem)
+        self.assertEqual(3, manifest.chunks)
+        self.assertEqual(manifest.get_chunks_keys("key"), sorted(items))
+        self.assertTrue(all(len(chunk) <= cache.MEMCACHE_CHUNK_SIZE for chunk in items.itervalues()))
+        self.assertEqual(blob, "".join(items[chunk_key] for chunk_key in manifest.get_chunks_keys("key")))
+
+    def test_chunked_value_is_read_from_memcache(self):
+        cache.set_into_cache("key", self.value).get_result()
+        self.assertEqual(3, len(self.get_chunks_keys()))
+        del self.files["/bucket/key"]
+        cache.lru_cache.clear()
+        self.assertEqual(self.value, cache.get_from_cache("key").get_result())
+        self.assertEqual([], self.reads)
+
+    def test_chunked_value_with_missing_chunks_is_read_from_gcs(self):
+        cache.set_into_cache("key", self.value).get_result()
+        old_chunks = self.get_chunks_keys()
+        del self.memcache.values[old_chunks[1]]
+        cache.lru_cache.clear()
+        self.assertEqual(self.value, cache.get_from_cache("key").get_result())
+        self.assertEqual(["/bucket/key"], self.reads)
+        # The chunks are saved again, with another generation
+        self.assertEqual(3, len(set(self.get_chunks_keys()).difference(old_chunks)))
+
+
+class GenerationsTest(unittest.TestCase):
+    def setUp(self):
+        self.memcache = MemoryMemcache()
+        self.files = {}
+        self.restored = []
+        self.patched = {}
+        self.patch("ndb_context", self.memcache)
+        self.patch("memcache_api", self.memcache)
+        self.patch("get_gcs_filename", lambda filename: result("/bucket/" + filename))
+        self.patch("read_from_gcs", self.files.get)
+        self.patch("write_to_gcs", self.files.__setitem__)
+        self.patch("threaded", lambda fn: lambda *args: self.restored.append(args) or fn(*args))
+        cache.lru_cache.clear_prefix("cache/generations/")
+
+    def tearDown(self):
+        for name, value in self.patched.iteritems():
+            setattr(cache, name, value)
+        cache.lru_cache.clear_prefix("cache/generations/")
+
+    def patch(self, name, value):
+        self.patched[name] = getattr(cache, name)
+        setattr(cache, name, value)
+
+    def test_unseen_namespace_is_in_the_generation_0(self):
+        self.assertEqual(0, cache.get_generation("unseen").get_result())
+        self.assertEqual(0, self.memcache.values["cache/generations/unseen"])
+        # The generation is restored from GCS only by the instance that initialized it on memcache
+        cache.lru_cache.clear_prefix("cache/generations/")
+        self.assertEqual(0, cache.get_generation("unseen").get_result())
+        self.assertEqual(1, len(self.restored))
+
+    def test_generation_is_published_to_all_the_tiers(self):
+        cache.set_generation("namespace", 3).get_result()
+        self.assertEqual(3, cache.get_generation("namespace").get_result())
+        cache.lru_cache.clear_prefix("cache/generations/")
+        self.assertEqual(3, cache.get_generation("namespace").get_result())
+        self.assertEqual("3", self.files["/bucket/cache/generations/namespace"])
+        self.assertEqual([], self.restored)
+
+    def test_generation_lost_by_memcache_is_restored_from_gcs(self):
+        cache.set_generation("namespace", 3).get_result()
+        del self.memcache.values["cache/generations/namespace"]
+        cache.lru_cache.clear_prefix("cache/generations/")
+        cache.get_generation("namespace").get_result()
+        self.assertEqual(3, self.memcache.values["cache/generations/namespace"])
+
+    def test_newer_generation_on_memcache_is_not_restored(self):
+        self.files["/bucket/cache/generations/namespace"] = "3"
+        self.memcache.values["cache/generations/namespace"] = 4
+        cache.restore_generation("cache/generations/namespace", "/bucket/cache/generations/namespace")
+        self.assertEqual(4, self.memcache.values["cache/generations/namespace"])
+
+    def test_versioned_keys(self):
+        self.assertEqual("key", cache.get_versioned_key("key", 0))
+        self.assertEqual("key/v2", cache.get_versioned_key("key", 2))
+
+
+class Plain(str):
+    pass
+
+
+if __name__ == "__main__":
+    unittest.main()
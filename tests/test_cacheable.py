@@ -0,0 +1,62 @@
+import unittest
+from app import cache
+from app.decorators import cacheable
+from tests.helpers import Clock, MemoryStore
+
+__author__ = 'fernando'
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+        self.store.install()
+        self.clock = Clock()
+        self.time = cache.time
+        cache.time = self.clock
+        self.calls = []
+
+        @cacheable.cacheable(consider_only=["campus"], soft_ttl=60, hard_ttl=600)
+        def get_campi(filters):
+            self.calls.append(filters)
+            return ["campus %d" % len(self.calls)]
+
+        self.get = get_campi
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def test_result_is_cached(self):
+        self.assertEqual(["campus 1"], self.get({"campus": "FLO", "other": 1}))
+        self.assertEqual(["campus 1"], self.get({"campus": "FLO", "other": 2}))
+        self.assertEqual(["campus 2"], self.get({"campus": "JOI"}))
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual([], self.store.refreshed)
+
+    def test_stale_result_is_returned_while_it_is_refreshed(self):
+        self.get({"campus": "FLO"})
+        self.clock.now += 61
+        self.assertEqual(["campus 1"], self.get({"campus": "FLO"}))
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(1, len(self.store.refreshed))
+        # The refresh (made by the task) saves the new result in the next generation
+        self.assertEqual(["campus 2"], self.get({"campus": "FLO"}, overwrite=True))
+        self.assertEqual(["campus 2"], self.get({"campus": "FLO"}))
+        self.assertEqual(1, len(self.store.refreshed))
+
+    def test_expired_result_is_not_returned(self):
+        self.get({"campus": "FLO"})
+        self.clock.now += 601
+        self.assertEqual(["campus 2"], self.get({"campus": "FLO"}))
+        self.assertEqual([], self.store.refreshed)
+
+    def test_result_without_soft_ttl_is_not_refreshed(self):
+        get_campi = cacheable.cacheable()(lambda filters: self.calls.append(filters) or ["campus"])
+        get_campi({})
+        self.clock.now += 86400
+        self.assertEqual(["campus"], get_campi({}))
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual([], self.store.refreshed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import unittest
+from StringIO import StringIO
+from app.support import index_file
+from app.support.index_file import IndexFile, dump_index, load_index_file
+from app.support.Trie import Trie
+
+__author__ = 'fernando'
+
+
+class IndexFileTest(unittest.TestCase):
+    def setUp(self):
+        self.index = Trie()
+        lists = {u"calculo": [0, 2], u"calcio": [1], u"cal": [2, 3], u"ção": [3], u"fisica": [0]}
+        for word, ids in lists.iteritems():
+            self.index[word].extend(ids)
+        self.index.compact()
+        self.items = [{"id": str(position), "name": u"Item %d ção" % position} for position in xrange(4)]
+        self.features = [" item%d" % position for position in xrange(4)]
+        self.index_file = IndexFile(dump_index(self.index, self.items, self.features, 1000.0))
+
+    def test_index_file_finds_the_same_lists_of_the_index(self):
+        for prefix in [u"c", u"ca", u"cal", u"calc", u"calculo", u"ç", u"çã", u"f", u"z", u""]:
+            self.assertEqual(self.index.get_list(prefix), self.index_file.get_list(prefix))
+        self.assertEqual([0, 2], self.index_file[u"calculo"].tolist())
+        self.assertEqual([], self.index_file[u"calc"])
+        self.assertIn(u"ção", self.index_file)
+        self.assertEqual(5, len(self.index_file))
+        self.assertEqual(sorted(self.index.get_words(), key=lambda word: word.encode("utf-8")),
+                         self.index_file.get_words())
+
+    def test_items_and_features_are_decoded_when_accessed(self):
+        self.assertEqual(self.items, list(self.index_file.items))
+        self.assertEqual(self.items[-1], self.index_file.items[-1])
+        self.assertEqual(self.features, list(self.index_file.features))
+        self.assertRaises(IndexError, lambda: self.index_file.items[4])
+
+    def test_features_are_optional(self):
+        index = IndexFile(dump_index(self.index, self.items))
+        self.assertIsNone(index.features)
+        self.assertEqual(self.items, list(index.items))
+        self.assertFalse(index.needs_refresh())
+
+    def test_refresh_time_is_saved(self):
+        self.assertEqual(1000.0, self.index_file.refresh_on)
+        self.assertTrue(self.index_file.needs_refresh())
+
+    def test_other_formats_are_not_loaded(self):
+        blob = dump_index(self.index, self.items)
+        self.assertRaises(ValueError, IndexFile, "XXXX" + blob[4:])
+        self.assertRaises(ValueError, IndexFile, blob[:4] + "\x02\x00" + blob[6:])
+
+    def test_index_file_is_loaded_from_a_file_or_from_memory(self):
+        blob = dump_index(self.index, self.items, self.features)
+        mmap = index_file.mmap
+        for module in ([mmap] if mmap is not None else []) + [None]:
+            index_file.mmap = module
+            try:
+                index = load_index_file(StringIO(blob), "index")
+            finally:
+                index_file.mmap = mmap
+            self.assertEqual(self.index.get_list(u"cal"), index.get_list(u"cal"))
+            self.assertEqual(self.items, list(index.items))
+
+
+if __name__ == "__main__":
+    unittest.main()
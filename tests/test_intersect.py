@@ -0,0 +1,68 @@
+import random
+import unittest
+from array import array
+from app.support import intersect
+from app.support.intersect import gallop, intersect_all
+
+__author__ = 'fernando'
+
+
+class GallopTest(unittest.TestCase):
+    def test_position_of_the_first_value_not_smaller_than_the_target(self):
+        values = [1, 3, 5, 7, 9, 11]
+        self.assertEqual(0, gallop(values, 0))
+        self.assertEqual(2, gallop(values, 5))
+        self.assertEqual(3, gallop(values, 6))
+        self.assertEqual(4, gallop(values, 9, 3))
+        self.assertEqual(6, gallop(values, 12))
+        self.assertEqual(0, gallop([], 1))
+
+
+class IntersectAllTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(7)
+
+    def create_list(self, size, maximum):
+        return sorted(self.random.sample(xrange(maximum), size))
+
+    def check(self, lists, limit=None):
+        expected = sorted(set(lists[0]).intersection(*lists[1:]))[:limit]
+        self.assertEqual(expected, intersect_all(lists, limit))
+
+    def test_lists_with_similar_lengths(self):
+        self.check([self.create_list(500, 1000), self.create_list(400, 1000), self.create_list(600, 1000)])
+
+    def test_short_list_with_long_lists(self):
+        # The long lists are searched with gallop
+        short = self.create_list(10, 100000)
+        long_lists = [sorted(set(self.create_list(50000, 100000)).union(short[:5])) for _ in xrange(2)]
+        self.check([long_lists[0], short, long_lists[1]])
+        self.check([array("I", long_lists[0]), short])
+
+    def test_limit(self):
+        lists = [range(0, 10000, 2), range(0, 200, 4)]
+        self.check(lists, 10)
+        self.assertEqual(range(0, 40, 4), intersect_all(lists, 10))
+        self.assertEqual(range(0, 200, 4), intersect_all(lists))
+        self.check([range(0, 200, 4), range(0, 200, 2)], 10)
+
+    def test_same_results_without_gallop(self):
+        lists = [self.create_list(30, 5000), self.create_list(4000, 5000), self.create_list(3000, 5000)]
+        original = intersect.GALLOP_MIN_RATIO
+        intersect.GALLOP_MIN_RATIO = 10 ** 9
+        try:
+            expected = intersect_all(lists)
+        finally:
+            intersect.GALLOP_MIN_RATIO = original
+        self.assertEqual(expected, intersect_all(lists))
+
+    def test_empty_lists(self):
+        self.assertEqual([], intersect_all([]))
+        self.assertEqual([], intersect_all([[1, 2], []]))
+        self.assertEqual([], intersect_all([[1, 2], [3, 4]]))
+        self.assertEqual([1, 2], intersect_all([[1, 2]]))
+        self.assertEqual([2], intersect_all([iter([1, 2]), [2, 3]]))
+
+
+if __name__ == "__main__":
+    unittest.main()
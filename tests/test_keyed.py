@@ -0,0 +1,120 @@
+import hashlib
+import unittest
+from app.decorators import keyed, searchable
+from tests.helpers import MemoryStore
+
+__author__ = 'fernando'
+
+PREFIX = "matrufsc2-team-"
+CAMPUS = "JOI"
+
+
+class KeyedTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+        self.store.install()
+        self.records = [{"id": PREFIX + str(record_id), "code": "%02d" % record_id} for record_id in xrange(250)]
+
+        @keyed.keyed(prefix=PREFIX, consider_only=["campus"])
+        def get_all_teams(filters):
+            return [dict(record) for record in self.records]
+
+        self.get = get_all_teams
+        self.get({"campus": CAMPUS}, overwrite=True, index=True)
+        self.written = []
+        set_many_into_cache = self.store.set_many_into_cache
+
+        def counting_set(values, *args, **kwargs):
+            self.written.extend(values)
+            return set_many_into_cache(values, *args, **kwargs)
+
+        keyed.set_many_into_cache = counting_set
+
+    def find(self, *ids):
+        return [record["code"] for record in self.get({"campus": CAMPUS, "q": " ".join(ids)})["results"]]
+
+    def list(self, limit):
+        filters = {"campus": CAMPUS, "limit": limit}
+        listed = []
+        while True:
+            result = self.get(dict(filters))
+            listed.extend(record["code"] for record in result["results"])
+            if not result["next_cursor"]:
+                return listed
+            filters["cursor"] = result["next_cursor"]
+
+    def get_buckets_keys(self):
+        return [key for key in self.store.values if "/bucket/" in key]
+
+    def test_records_are_found_by_id(self):
+        self.assertEqual(["07", "200", "13"], self.find("7", "200", PREFIX + "13"))
+        self.assertEqual(["07"], self.find("7", "unknown"))
+
+    def test_records_are_listed_by_pages(self):
+        listed = self.list(40)
+        self.assertEqual(sorted(record["code"] for record in self.records), sorted(listed))
+
+    def test_update_saves_only_the_changed_buckets(self):
+        self.get({"campus": CAMPUS}, overwrite=True, index=True, update_with=[{"id": PREFIX + "7", "code": "changed"}],
+                 exclude=[PREFIX + "13"])
+        self.assertEqual(["changed"], self.find("7"))
+        self.assertEqual([], self.find("13"))
+        buckets = set(key.rsplit("/v", 1)[0] for key in self.written if "/bucket/" in key)
+        self.assertEqual(set([keyed.get_bucket("7", 3), keyed.get_bucket("13", 3)]),
+                         set(int(key.rsplit("/", 1)[-1]) for key in buckets))
+        self.assertEqual(249, len(self.list(100)))
+
+    def test_update_with_a_missing_bucket_builds_the_store_again(self):
+        bucket = keyed.get_bucket("7", 3)
+        for key in self.get_buckets_keys():
+            if key.rsplit("/v", 1)[0].endswith("/bucket/%d" % bucket):
+                del self.store.values[key]
+        self.records[7] = {"id": PREFIX + "7", "code": "changed"}
+        self.get({"campus": CAMPUS}, overwrite=True, index=True, update_with=[self.records[7]])
+        self.assertEqual(["changed"], self.find("7"))
+        self.assertEqual(250, len(self.list(100)))
+
+
+class KeyedFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+        self.store.install()
+        # The ids of the teams are hashes, as the indexes saved before the stores only have the words with 40 letters
+        records = [{"id": PREFIX + get_id(record_id), "code": "%02d" % record_id} for record_id in xrange(30)]
+
+        def get_all_teams(filters):
+            return [dict(record) for record in records]
+
+        fallback = searchable.searchable(lambda item: item["id"], prefix=PREFIX, consider_only=["campus"],
+                                         min_word_length=40)
+        # The records are saved as they were before the store existed
+        fallback(get_all_teams)({"campus": CAMPUS, "q": get_id(0)}, overwrite=True, index=True)
+        self.get = keyed.keyed(prefix=PREFIX, consider_only=["campus"], fallback=fallback)(get_all_teams)
+
+    def test_records_are_read_with_the_fallback_while_the_store_is_not_built(self):
+        result = self.get({"campus": CAMPUS, "q": " ".join([get_id(7), get_id(13)])})
+        self.assertEqual(["07", "13"], [record["code"] for record in result["results"]])
+        self.assertEqual(1, len(self.store.refreshed))
+        result = self.get({"campus": CAMPUS, "limit": 10})
+        self.assertEqual(10, len(result["results"]))
+        self.assertTrue(result["next_cursor"])
+
+    def test_store_is_not_built_when_the_fallback_finds_nothing(self):
+        result = self.get({"campus": "unknown", "q": get_id(7)})
+        self.assertEqual([], result["results"])
+        self.assertEqual([], self.store.refreshed)
+
+    def test_store_is_read_when_it_is_built(self):
+        self.get({"campus": CAMPUS}, overwrite=True, index=True)
+        self.store.refreshed = []
+        result = self.get({"campus": CAMPUS, "q": get_id(7)})
+        self.assertEqual(["07"], [record["code"] for record in result["results"]])
+        self.assertEqual([], self.store.refreshed)
+
+
+def get_id(record_id):
+    return hashlib.sha1(str(record_id)).hexdigest()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from app import cache, metrics
+from tests.helpers import MemoryMemcache
+
+__author__ = 'fernando'
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.memcache = MemoryMemcache()
+        self.memcache_api = metrics.memcache
+        metrics.memcache = self.memcache
+        self.registry = metrics.MetricsRegistry("test")
+
+    def tearDown(self):
+        metrics.memcache = self.memcache_api
+
+    def test_hits_misses_and_latencies_are_recorded_per_tier_and_namespace(self):
+        self.registry.record_hit("lru", "index", 0.0005, 10)
+        self.registry.record_hit("lru", "index", 0.003, 20)
+        self.registry.record_miss("lru", "index", 0.5)
+        self.registry.record_miss("gcs", "items")
+        self.registry.record_write("gcs", "items", 30)
+        self.registry.record_eviction("lru", "index")
+        snapshot = self.registry.snapshot()
+        index = snapshot["lru"]["index"]
+        self.assertEqual((2, 1, 30, 1), (index["hits"], index["misses"], index["bytes_read"], index["evictions"]))
+        self.assertEqual(3, index["latency_count"])
+        # The latencies are in milliseconds, in the buckets of up to 1 ms, of up to 5 ms and of up to 500 ms
+        self.assertEqual([1, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0], index["latency_buckets"])
+        items = snapshot["gcs"]["items"]
+        self.assertEqual((0, 1, 30), (items["hits"], items["misses"], items["bytes_written"]))
+        self.assertEqual(0, items["latency_count"])
+
+    def test_summary_has_the_totals_and_the_hit_rates(self):
+        self.registry.record_hit("lru", "index", 0.002)
+        self.registry.record_hit("lru", "items", 0.004)
+        self.registry.record_miss("lru", "items", 0.006)
+        self.registry.record_write("gcs", "items", 30)
+        summary = metrics.summarize(self.registry.snapshot())
+        self.assertEqual(1.0, summary["lru"]["index"]["hit_rate"])
+        self.assertEqual(0.5, summary["lru"]["items"]["hit_rate"])
+        self.assertEqual(3, summary["lru"]["*"]["hits"] + summary["lru"]["*"]["misses"])
+        self.assertAlmostEqual(4.0, summary["lru"]["*"]["latency_mean"])
+        self.assertIsNone(summary["gcs"]["*"]["hit_rate"])
+        self.assertIsNone(summary["gcs"]["*"]["latency_mean"])
+
+    def test_metrics_of_all_the_instances_are_aggregated(self):
+        other = metrics.MetricsRegistry("test")
+        other.instance_id = "other"
+        self.registry.record_hit("lru", "index", 0.002, 10)
+        other.record_hit("lru", "index", 0.002, 20)
+        other.record_miss("gcs", "items")
+        other.flush()
+        aggregated = self.registry.get_aggregated()
+        self.assertEqual(2, aggregated["instances"])
+        self.assertEqual(2, aggregated["metrics"]["lru"]["index"]["hits"])
+        self.assertEqual(30, aggregated["metrics"]["lru"]["index"]["bytes_read"])
+        self.assertEqual(1, aggregated["metrics"]["gcs"]["items"]["misses"])
+
+    def test_metrics_are_flushed_periodically(self):
+        self.registry.flushed_on -= metrics.FLUSH_INTERVAL
+        self.registry.record_hit("lru", "index")
+        self.assertIn(metrics.METRICS_KEY % ("test", self.registry.instance_id), self.memcache.values)
+
+
+class CacheMetricsTest(unittest.TestCase):
+    def test_namespaces_ignore_hashes_versions_and_chunks(self):
+        key = "cache/searchIndex/%s/index/v3" % ("a" * 40)
+        self.assertEqual("cache/searchIndex/index", cache.get_metrics_namespace(key))
+        self.assertEqual("cache/keyedStore/bucket", cache.get_metrics_namespace(
+            "cache/keyedStore/%s/bucket/12/v2/chunk/%s/0" % ("b" * 40, "c" * 32)))
+        self.assertEqual("memcache-friendly-*", cache.get_metrics_namespace("memcache-friendly-%s" % ("d" * 40)))
+        self.assertEqual("other", cache.get_metrics_namespace(("tuple", "key")))
+
+    def test_lookups_of_the_lru_cache_are_recorded(self):
+        lru = cache.LRUCache()
+        before = cache.cache_metrics.snapshot().get("lru", {}).get("metrics-test", {"hits": 0, "misses": 0})
+        lru.get("metrics-test")
+        lru.set("metrics-test", 1)
+        lru.get("metrics-test")
+        after = cache.cache_metrics.snapshot()["lru"]["metrics-test"]
+        self.assertEqual(before["hits"] + 1, after["hits"])
+        self.assertEqual(before["misses"] + 1, after["misses"])
+
+
+if __name__ == "__main__":
+    unittest.main()
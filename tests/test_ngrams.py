@@ -0,0 +1,35 @@
+import unittest
+from app.support.ngrams import build_ngrams_index, get_candidates, get_ngrams
+
+__author__ = 'fernando'
+
+
+class NgramsTest(unittest.TestCase):
+    def setUp(self):
+        self.words = sorted(["calculo", "calcio", "fisica", "quantica", "quantia", "circuitos"])
+        self.index = build_ngrams_index(self.words)
+
+    def get_candidates(self, word, *args):
+        return [self.words[position] for position in get_candidates(self.index, self.words, word, *args)]
+
+    def test_ngrams_are_padded(self):
+        self.assertEqual(set(["$c", "ca", "al", "l$"]), get_ngrams("cal"))
+        self.assertEqual(set(["$a", "a$"]), get_ngrams("a"))
+
+    def test_index_has_the_positions_of_the_words_of_each_ngram(self):
+        self.assertEqual([self.words.index("quantia"), self.words.index("quantica")], self.index.get_list("qu"))
+        self.assertEqual([self.words.index("fisica")], self.index.get_list("$f"))
+        self.assertTrue(self.index.is_compact())
+
+    def test_candidates_are_sorted_by_the_ngrams_shared(self):
+        self.assertEqual(["calculo", "calcio", "circuitos"], self.get_candidates("calclo")[:3])
+        self.assertEqual(["quantica", "quantia"], self.get_candidates("quantca")[:2])
+        self.assertEqual([], self.get_candidates("xyz"))
+
+    def test_candidates_are_filtered_by_length_and_limited(self):
+        self.assertEqual(["calcio", "fisica"], self.get_candidates("calclo", 5, 6))
+        self.assertEqual(["calculo"], self.get_candidates("calclo", 0, None, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import unittest
+from app.support.ranking import get_features, get_score, rank
+
+__author__ = 'fernando'
+
+
+class RankingTest(unittest.TestCase):
+    def setUp(self):
+        self.features = map(get_features, [
+            u"INE5401 - Introdução à Computação",
+            u"INE5402 - Programação Orientada a Objetos",
+            u"MTM5161 - Cálculo A",
+            u"INE5404 - Computação Científica",
+            u"EEL5105 - Circuitos e Técnicas Digitais"
+        ])
+
+    def test_features_are_the_normalized_words(self):
+        self.assertEqual(" ine5401 introducao a computacao", self.features[0])
+        self.assertEqual(" mtm5161 calculo a", self.features[2])
+
+    def test_score_of_each_kind_of_match(self):
+        features = self.features[0]
+        self.assertEqual(0, get_score(features, ["ine5401"]))
+        self.assertEqual(1, get_score(features, ["ine"]))
+        self.assertEqual(2, get_score(features, ["intro"]))
+        self.assertEqual(3, get_score(features, ["putacao"]))
+        self.assertEqual(4, get_score(features, ["calculo"]))
+
+    def test_consecutive_words_have_a_bonus(self):
+        self.assertEqual(3.5, get_score(self.features[3], ["computacao", "cientifica"]))
+        self.assertEqual(4, get_score(self.features[3], ["cientifica", "computacao"]))
+
+    def test_positions_are_sorted_by_relevance_and_by_position(self):
+        self.assertEqual([3, 0, 1], rank([0, 1, 3], self.features, ["computacao", "ci"]))
+        self.assertEqual([0, 1, 3], rank([3, 1, 0], self.features, ["ine"]))
+        self.assertEqual([3, 0, 1, 2, 4], rank(range(5), self.features, ["ine5404"]))
+
+    def test_only_the_most_relevant_positions_are_returned_with_a_limit(self):
+        query = ["computacao"]
+        self.assertEqual(rank(range(5), self.features, query)[:2], rank(range(5), self.features, query, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from app import cache
+from app.decorators import searchable
+from app.support import index_file
+from benchmarks.search import PREFIX, generate_disciplines
+from tests.helpers import Clock, MemoryStore
+
+__author__ = 'fernando'
+
+CAMPUS = "JOI"
+
+
+class CountingStore(MemoryStore):
+    """
+    Store in memory that counts the values (and the files) written, and the values written by each write
+    """
+
+    def __init__(self, cold=False):
+        super(CountingStore, self).__init__(cold)
+        self.written = []
+        self.batches = []
+
+    def set_many_into_cache(self, values, persistent=True, memcache=True, log=True, codec=None, compressor=None):
+        self.written.extend(values)
+        self.batches.append(len(values))
+        return super(CountingStore, self).set_many_into_cache(values, persistent, memcache, log, codec, compressor)
+
+    def write_to_gcs(self, filename, blob):
+        self.written.append(filename)
+        super(CountingStore, self).write_to_gcs(filename, blob)
+
+
+class ReadingStore(MemoryStore):
+    """
+    Store in memory that records the keys read
+    """
+
+    def __init__(self, cold=False):
+        super(ReadingStore, self).__init__(cold)
+        self.read = []
+
+    def get_many_from_cache(self, keys, persistent=True, memcache=True, log=True):
+        self.read.extend(keys)
+        return super(ReadingStore, self).get_many_from_cache(keys, persistent, memcache, log)
+
+
+class ShardedItemsTest(unittest.TestCase):
+    def setUp(self):
+        self.store = ReadingStore()
+        self.store.install()
+        self.items = [{"id": str(position)} for position in xrange(250)]
+        self.manifest = searchable.ItemsManifest(len(self.items), 100)
+        for shard in xrange(self.manifest.get_shards_count()):
+            self.store.values["items/%d" % shard] = self.items[shard * 100:(shard + 1) * 100]
+        self.sharded = searchable.ShardedItems(self.manifest, lambda shard: "items/%d" % shard)
+
+    def test_only_the_shards_of_the_positions_are_loaded_at_once(self):
+        self.assertEqual([self.items[5], self.items[150], self.items[7]], self.sharded.get_many([5, 150, 7]))
+        self.assertEqual(["items/0", "items/1"], self.store.read)
+        self.assertEqual(self.items[99], self.sharded[99])
+        self.assertEqual(self.items[249], self.sharded[249])
+        self.assertEqual(["items/0", "items/1", "items/2"], self.store.read)
+        self.assertEqual(self.items, self.sharded.tolist())
+        self.assertEqual(250, len(self.sharded))
+
+    def test_items_out_of_the_range_are_not_found(self):
+        self.assertRaises(IndexError, lambda: self.sharded[250])
+        self.assertRaises(IndexError, lambda: self.sharded[-1])
+        self.assertEqual([], self.store.read)
+
+    def test_items_of_missing_shards_are_ignored(self):
+        del self.store.values["items/1"]
+        self.assertEqual([self.items[5]], self.sharded.get_many([5, 150]))
+        self.assertRaises(IndexError, lambda: self.sharded[150])
+
+    def test_page_of_a_search_loads_only_the_shards_of_its_results(self):
+        disciplines = generate_disciplines(CAMPUS)
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"]
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in disciplines]
+
+        get_disciplines({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        self.store.read = []
+        position = len(disciplines) - 1
+        results = get_disciplines({"campus": CAMPUS, "q": disciplines[position]["code"]})["results"]
+        self.assertEqual([remove(disciplines[position]["id"])], [item["id"] for item in results])
+        shard = position // searchable.ITEMS_SHARD_SIZE
+        shards_read = [key.rsplit("/v", 1)[0].split("/", 4)[-1] for key in self.store.read if "/items/" in key]
+        self.assertEqual(["items/%d" % shard], shards_read)
+
+
+class IncrementalUpdateTest(unittest.TestCase):
+    backend = None
+
+    def setUp(self):
+        self.store = CountingStore()
+        self.store.install()
+        self.disciplines = generate_disciplines(CAMPUS)
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"],
+            index_backend=self.backend
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in self.disciplines]
+
+        self.search = get_disciplines
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        self.store.written = []
+
+    def update(self, update_with=None, exclude=None):
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True, update_with=update_with or [],
+                    exclude=exclude or [])
+
+    def find(self, query):
+        searchable.query_cache.clear()
+        results = self.search({"campus": CAMPUS, "q": query, "limit": len(self.disciplines)})["results"]
+        return sorted(result["id"] for result in results)
+
+    def get_written_kinds(self):
+        return sorted(key.rsplit("/v", 1)[0].split("/", 4)[-1] for key in self.store.written)
+
+    def test_build_writes_in_batches(self):
+        original = searchable.SAVE_BATCH_SIZE
+        searchable.SAVE_BATCH_SIZE = 3
+        self.store.batches = []
+        try:
+            self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        finally:
+            searchable.SAVE_BATCH_SIZE = original
+        shards = (len(self.disciplines) + searchable.ITEMS_SHARD_SIZE - 1) // searchable.ITEMS_SHARD_SIZE
+        # The shards of the items and of the features, the index, the words, the n-grams and the manifest
+        self.assertEqual(shards * 2 + 4, sum(self.store.batches))
+        self.assertEqual(3, max(self.store.batches))
+        self.assertEqual(1, self.store.batches[-1])
+
+    def test_update_of_one_item_writes_its_shard(self):
+        position = len(self.disciplines) // 2
+        shard = position // searchable.ITEMS_SHARD_SIZE
+        self.disciplines[position] = dict(self.disciplines[position], name=u"Xilografia Avancada")
+        self.update([self.disciplines[position]])
+        self.assertEqual(["features/%d" % shard, "items", "items/%d" % shard], self.get_written_kinds())
+        self.assertEqual([remove(self.disciplines[position]["id"])], self.find("xilografia"))
+        self.assertEqual([remove(self.disciplines[position]["id"])], self.find("xilo avanc"))
+
+    def test_exclusion_of_one_item_writes_its_shard_and_the_last_one(self):
+        excluded = self.disciplines.pop(0)
+        self.update(exclude=[excluded["id"]])
+        last = len(self.disciplines) // searchable.ITEMS_SHARD_SIZE
+        self.assertEqual(["features/0", "features/%d" % last, "items", "items/0", "items/%d" % last],
+                         self.get_written_kinds())
+        self.assertEqual([], self.find(excluded["code"]))
+        moved = self.disciplines[-1]
+        self.assertEqual([remove(moved["id"])], self.find(moved["code"]))
+
+    def test_updates_find_the_same_results_of_a_full_build(self):
+        self.disciplines.append({"id": PREFIX + "new", "code": u"NEW0001", "name": u"Xilografia"})
+        self.disciplines[1] = dict(self.disciplines[1], name=u"Xilogravura")
+        excluded = self.disciplines.pop(2)
+        self.update([self.disciplines[1], self.disciplines[-1]], [excluded["id"]])
+        queries = [u"xilo", u"new0001", excluded["code"], self.disciplines[3]["code"], u"a", u"ca"]
+        updated = [self.find(query) for query in queries]
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        self.assertEqual([self.find(query) for query in queries], updated)
+
+    def test_words_added_by_the_updates_are_suggested(self):
+        self.disciplines.append({"id": PREFIX + "new", "code": u"NEW0001", "name": u"Xilografia"})
+        self.update([self.disciplines[-1]])
+        searchable.query_cache.clear()
+        result = self.search({"campus": CAMPUS, "q": u"xilogrfia"})
+        self.assertEqual([], result["results"])
+        self.assertIn(u"xilografia", result["suggestions"])
+
+    def test_listing_after_an_update_pages_through_all_the_items(self):
+        position = len(self.disciplines) // 2
+        self.disciplines[position] = dict(self.disciplines[position], name=u"Xilografia Avancada")
+        self.update([self.disciplines[position]])
+        filters = {"campus": CAMPUS, "limit": searchable.ITEMS_SHARD_SIZE // 2}
+        listed = []
+        while True:
+            result = self.search(dict(filters))
+            listed.extend(result["results"])
+            if not result["next_cursor"]:
+                break
+            filters["cursor"] = result["next_cursor"]
+        self.assertEqual([remove(discipline["id"]) for discipline in self.disciplines],
+                         [item["id"] for item in listed])
+        self.assertEqual(u"Xilografia Avancada", listed[position]["name"])
+
+    def test_index_is_built_again_with_too_many_changes(self):
+        original = searchable.INDEX_DELTA_MAX_POSTINGS
+        searchable.INDEX_DELTA_MAX_POSTINGS = 0
+        try:
+            self.disciplines[0] = dict(self.disciplines[0], name=u"Xilografia")
+            self.update([self.disciplines[0]])
+        finally:
+            searchable.INDEX_DELTA_MAX_POSTINGS = original
+        self.assertIn("index", self.get_written_kinds())
+        self.assertEqual([remove(self.disciplines[0]["id"])], self.find("xilografia"))
+
+
+class IncrementalUpdateFileTest(IncrementalUpdateTest):
+    backend = searchable.INDEX_BACKEND_FILE
+
+
+class IndexFileLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+        self.store.install()
+        disciplines = generate_disciplines(CAMPUS)
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"],
+            index_backend=searchable.INDEX_BACKEND_FILE
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in disciplines]
+
+        get_disciplines({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        self.key = [key for key in self.store.files if "/file/" in key][0]
+        cache.lru_cache.clear_prefix(searchable.CACHE_INDEX_PREFIX)
+        self.opened = []
+        self.open = self.store.open
+
+    def slow_open(self, filename, mode="r", **kwargs):
+        self.opened.append(filename)
+        time.sleep(0.1)
+        return self.open(filename, mode, **kwargs)
+
+    def test_index_file_is_loaded_once_by_concurrent_threads(self):
+        self.store.open = self.slow_open
+        loaded = []
+        threads = [
+            threading.Thread(target=lambda: loaded.append(searchable.get_index_file(self.key))) for _ in xrange(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([self.key], self.opened)
+        self.assertEqual(4, len(loaded))
+        self.assertTrue(all(index_file is loaded[0] for index_file in loaded))
+
+    def test_index_file_is_kept_on_the_lru_cache_with_its_size(self):
+        size = cache.lru_cache.get_size()
+        index_file = searchable.get_index_file(self.key)
+        self.assertEqual(size + len(self.store.files[self.key]), cache.lru_cache.get_size())
+        self.store.open = self.slow_open
+        self.assertIs(index_file, searchable.get_index_file(self.key))
+        self.assertEqual([], self.opened)
+
+    def test_missing_index_file_is_none(self):
+        self.assertIsNone(searchable.get_index_file(self.key + "/missing"))
+
+
+class StaleIndexTest(unittest.TestCase):
+    backend = None
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.store.install()
+        self.clock = Clock()
+        self.modules = [cache, searchable, index_file]
+        self.times = [module.time for module in self.modules]
+        for module in self.modules:
+            module.time = self.clock
+        disciplines = generate_disciplines(CAMPUS)
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"],
+            soft_ttl=60,
+            index_backend=self.backend
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in disciplines]
+
+        self.search = get_disciplines
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        self.code = disciplines[0]["code"]
+
+    def tearDown(self):
+        for module, module_time in zip(self.modules, self.times):
+            module.time = module_time
+
+    def find(self):
+        searchable.query_cache.clear()
+        return self.search({"campus": CAMPUS, "q": self.code})["results"]
+
+    def test_stale_index_is_used_while_it_is_rebuilt(self):
+        self.assertEqual(1, len(self.find()))
+        self.assertEqual([], self.store.refreshed)
+        self.clock.now += 61
+        self.assertEqual(1, len(self.find()))
+        self.assertEqual(1, len(self.store.refreshed))
+
+
+class StaleIndexFileTest(StaleIndexTest):
+    backend = searchable.INDEX_BACKEND_FILE
+
+
+class RankingTest(unittest.TestCase):
+    disciplines = [
+        {"id": PREFIX + "1", "code": u"MTM1001", "name": u"Calculo Numerico"},
+        {"id": PREFIX + "2", "code": u"FSC1002", "name": u"Fisica e Calculo"},
+        {"id": PREFIX + "3", "code": u"CAL1003", "name": u"Fisica Quantica"},
+        {"id": PREFIX + "4", "code": u"MTM1004", "name": u"Numerico Calculo"}
+    ]
+
+    def setUp(self):
+        MemoryStore().install()
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"]
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in self.disciplines]
+
+        self.search = get_disciplines
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+
+    def find(self, query):
+        searchable.query_cache.clear()
+        return [result["id"] for result in self.search({"campus": CAMPUS, "q": query, "limit": 10})["results"]]
+
+    def test_results_are_sorted_by_relevance(self):
+        # The code before the other words, and the consecutive words before the other ones
+        self.assertEqual(["3", "1", "2", "4"], self.find(u"cal"))
+        self.assertEqual(["4", "1"], self.find(u"numerico calculo"))
+
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+        self.store.install()
+        self.disciplines = [
+            {"id": PREFIX + "1", "code": u"MTM1001", "name": u"Calculo Numerico"},
+            {"id": PREFIX + "2", "code": u"FSC1002", "name": u"Fisica Quantica"}
+        ]
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"]
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in self.disciplines]
+
+        self.search = get_disciplines
+        self.build("FLO")
+        self.build("JOI")
+
+    def build(self, campus, **kwargs):
+        self.search({"campus": campus, "q": "x"}, overwrite=True, index=True, **kwargs)
+
+    def find(self, query, campus="FLO"):
+        return [result["id"] for result in self.search({"campus": campus, "q": query})["results"]]
+
+    def test_normalized_queries_share_the_cached_results(self):
+        self.assertEqual(["1"], self.find(u"Cálculo  NUMÉRICO"))
+        self.assertEqual(1, len(searchable.query_cache))
+        # The results come from the cache, even if the index is not found anymore
+        for key in [key for key in self.store.values if "/index" in key]:
+            del self.store.values[key]
+        cache.lru_cache.clear_prefix(searchable.CACHE_INDEX_PREFIX)
+        self.assertEqual(["1"], self.find(u"calculo, numerico!"))
+        self.assertEqual(1, len(searchable.query_cache))
+
+    def test_results_of_other_filters_are_not_shared(self):
+        self.disciplines.pop(0)
+        self.build("JOI")
+        self.assertEqual(["1"], self.find(u"calculo"))
+        self.assertEqual([], self.find(u"calculo", "JOI"))
+
+    def test_results_are_not_used_after_the_index_changes(self):
+        self.assertEqual([], self.find(u"xilografia"))
+        self.disciplines.append({"id": PREFIX + "3", "code": u"EGR1003", "name": u"Xilografia"})
+        self.build("FLO", update_with=[self.disciplines[-1]])
+        self.assertEqual(["3"], self.find(u"xilografia"))
+
+
+class CursorTest(unittest.TestCase):
+    def setUp(self):
+        MemoryStore().install()
+        disciplines = generate_disciplines(CAMPUS)
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"]
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in disciplines]
+
+        self.search = get_disciplines
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+
+    def get_page(self, query, **filters):
+        result = self.search(dict(filters, campus=CAMPUS, q=query, limit=10))
+        return [item["id"] for item in result["results"]], result["next_cursor"]
+
+    def test_pages_of_the_cursors_are_the_pages_of_the_numbers(self):
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = self.get_page(u"a", cursor=cursor)
+            pages.append(page)
+            if not cursor:
+                break
+        self.assertGreater(len(pages), 2)
+        self.assertEqual([self.get_page(u"a", page=number)[0] for number in xrange(1, len(pages) + 1)], pages)
+        ids = sum(pages, [])
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_cursor_of_another_query_is_ignored(self):
+        first_page, cursor = self.get_page(u"a")
+        self.assertEqual(self.get_page(u"c")[0], self.get_page(u"c", cursor=cursor)[0])
+        self.assertEqual(first_page, self.get_page(u"a", cursor="invalid")[0])
+        self.assertEqual(self.get_page(u"a", cursor=cursor)[0], self.get_page(u"A", cursor=cursor)[0])
+
+    def test_cursors_are_decoded_only_with_their_fingerprints(self):
+        cursor = searchable.encode_cursor("fingerprint", 20)
+        self.assertEqual(20, searchable.decode_cursor(cursor, "fingerprint"))
+        self.assertIsNone(searchable.decode_cursor(cursor, "other"))
+        self.assertIsNone(searchable.decode_cursor("invalid", "fingerprint"))
+        self.assertIsNone(searchable.decode_cursor(searchable.encode_cursor("fingerprint", -1), "fingerprint"))
+
+
+class SteppingClock(object):
+    """
+    Clock that advances a step each time it is read
+    """
+
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def time(self):
+        self.now += self.step
+        return self.now
+
+
+class SuggestionsBudgetTest(unittest.TestCase):
+    disciplines = [
+        {"id": PREFIX + "1", "code": u"MTM1001", "name": u"Calculo Numerico"},
+        {"id": PREFIX + "2", "code": u"FSC1002", "name": u"Fisica Quantica"},
+        {"id": PREFIX + "3", "code": u"QMC1003", "name": u"Calcio Organico"},
+        {"id": PREFIX + "4", "code": u"CNM1004", "name": u"Quantia Financeira"}
+    ]
+
+    def setUp(self):
+        MemoryStore().install()
+
+        @searchable.searchable(
+            lambda item: " - ".join([item["code"], item["name"]]),
+            prefix=PREFIX,
+            consider_only=["campus"]
+        )
+        def get_disciplines(filters):
+            return [dict(discipline) for discipline in self.disciplines]
+
+        self.search = get_disciplines
+        self.search({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+        self.time = searchable.time
+
+    def tearDown(self):
+        searchable.time = self.time
+
+    def test_combinations_with_less_words_are_tried_when_the_budget_is_exhausted(self):
+        # Each read of the clock takes 40% of the budget of each number of words, so the budget of the combinations of
+        # two words (that find nothing, as each word is in another discipline) is exhausted before all of them are tried
+        searchable.time = SteppingClock(searchable.SUGGESTION_TIME_BUDGET / 5.0)
+        result = self.search({"campus": CAMPUS, "q": u"calclo quantca"})
+        self.assertEqual([], result["results"])
+        self.assertEqual(1, len(result["suggestions"]))
+        self.assertIn(result["suggestions"][0], [u"calculo", u"calcio", u"quantica", u"quantia"])
+
+
+def remove(item_id):
+    return searchable.remove_prefix(item_id, PREFIX)
+
+
+if __name__ == "__main__":
+    unittest.main()
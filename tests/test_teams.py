@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import unittest
+from google.appengine.ext import ndb
+from app.api import teams
+from app.decorators import searchable
+from app.robot.cache_helper import CacheHelper
+from tests.helpers import MemoryStore
+
+__author__ = 'fernando'
+
+CAMPUS = "matrufsc2-campus-FLO"
+
+
+def create_team(team_id, code, teachers, rooms):
+    return {
+        "id": team_id,
+        "code": code,
+        "teachers": [{"id": name, "name": name} for name in teachers],
+        "schedules": [{"room": room} for room in rooms]
+    }
+
+
+class TeamModel(object):
+    def __init__(self, team_id):
+        self.key = ndb.Key("Team", team_id)
+
+
+class Helper(CacheHelper):
+    def generate_campus_key(self, campus, semester):
+        return CAMPUS
+
+
+class SearchTeamsTest(unittest.TestCase):
+    def setUp(self):
+        MemoryStore().install()
+        self.teams = dict((team["id"], team) for team in [
+            create_team("t1", u"01208A", [u"João Conceição", u"Ana Maria"], [u"CTC-102"]),
+            create_team("t2", u"01208B", [u"Maria Silva"], [u"CTC-103", u"CTC-102"]),
+            create_team("t3", u"02200A", [u"Ana Souza", u"Joana Lima"], [u"CFH-154"])
+        ])
+        self.disciplines = [
+            {"id": "d1", "teams": ["matrufsc2-team-t1", "matrufsc2-team-t2"]},
+            {"id": "d2", "teams": ["matrufsc2-team-t3"]}
+        ]
+        self.patched = {"get_all_teams": teams.get_all_teams, "get_disciplines_teams": teams.get_disciplines_teams}
+        teams.get_all_teams = self.get_all_teams
+        teams.get_disciplines_teams = self.get_disciplines_teams
+        self.build()
+
+    def tearDown(self):
+        for name, value in self.patched.iteritems():
+            setattr(teams, name, value)
+
+    def get_all_teams(self, filters):
+        # In the order of the ids, so the positions of the teams in the index are known
+        return {"results": [self.teams[team_id] for team_id in sorted(filters["q"].split()) if team_id in self.teams]}
+
+    def get_disciplines_teams(self, filters):
+        return {"results": [dict(discipline) for discipline in self.disciplines], "next_cursor": None}
+
+    def build(self):
+        teams.search_teams({"campus": CAMPUS, "q": "x"}, overwrite=True, index=True)
+
+    def search(self, query):
+        searchable.query_cache.clear()
+        results = teams.search_teams({"campus": CAMPUS, "q": query, "limit": 10})["results"]
+        return [(result["id"], result["discipline"]) for result in results]
+
+    def test_teams_are_found_by_teachers_rooms_and_codes(self):
+        self.assertEqual([("t1", "matrufsc2-discipline-d1")], self.search(u"joão"))
+        self.assertEqual([("t1", "matrufsc2-discipline-d1")], self.search(u"joao conc"))
+        self.assertEqual(["t1", "t2"], sorted(team_id for team_id, _ in self.search(u"ctc-102")))
+        self.assertEqual([("t3", "matrufsc2-discipline-d2")], self.search(u"lima"))
+        self.assertEqual([("t2", "matrufsc2-discipline-d1")], self.search(u"01208b"))
+
+    def test_teachers_are_not_ranked_as_codes(self):
+        # The first teacher of t2 is not its code, so it is not more relevant than the second teacher of t1
+        self.assertEqual(["t1", "t2"], [team_id for team_id, _ in self.search(u"maria")])
+
+    def test_modified_teams_are_indexed_with_their_disciplines(self):
+        self.teams["t3"] = create_team("t3", u"02200A", [u"Zuleica Quintanilha"], [u"CFH-154"])
+        modified_teams = [{"model": TeamModel("matrufsc2-team-t3"), "discipline": "matrufsc2-discipline-d2"}]
+        Helper().update_teams_search(modified_teams, ["t1"], None, None)
+        self.assertEqual([("t3", "matrufsc2-discipline-d2")], self.search(u"zuleica"))
+        self.assertEqual([], self.search(u"joao"))
+
+    def test_modified_teams_without_disciplines_are_indexed(self):
+        # Saved by the tasks enqueued before the modified teams had the keys of their disciplines
+        self.teams["t2"] = create_team("t2", u"01208B", [u"Wenceslau Quixabeira"], [u"CTC-103"])
+        Helper().update_teams_search([TeamModel("matrufsc2-team-t2")], [], None, None)
+        self.assertEqual([("t2", "matrufsc2-discipline-d1")], self.search(u"wenceslau"))
+
+
+if __name__ == "__main__":
+    unittest.main()
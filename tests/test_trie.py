@@ -0,0 +1,126 @@
+import pickle
+import unittest
+from app.support.Trie import Trie
+
+__author__ = 'fernando'
+
+
+def create_index(lists):
+    index = Trie()
+    for word, ids in lists.iteritems():
+        index[word].extend(ids)
+    return index
+
+
+class TriePrefixTest(unittest.TestCase):
+    def setUp(self):
+        self.index = create_index({
+            "calculo": [1, 5],
+            "calcio": [2],
+            "cal": [5, 7],
+            "fisica": [3],
+            "quantica": [3, 4]
+        })
+
+    def test_lists_of_the_words_of_a_prefix_are_merged(self):
+        self.assertEqual([1, 2, 5, 7], self.index.get_list("c"))
+        self.assertEqual([1, 2, 5, 7], self.index.get_list("cal"))
+        self.assertEqual([1, 2, 5], self.index.get_list("calc"))
+        self.assertEqual([1, 5], self.index.get_list("calculo"))
+        self.assertEqual([], self.index.get_list("calculos"))
+        self.assertEqual([], self.index.get_list("z"))
+
+    def test_words_of_a_prefix_are_sorted(self):
+        self.assertEqual(["cal", "calcio", "calculo"], self.index.get_prefix_words("cal"))
+        self.assertEqual(2, self.index.find("calculo"))
+        self.assertIsNone(self.index.find("calc"))
+
+    def test_changes_are_seen_by_the_next_lookups(self):
+        self.assertEqual([1, 2, 5, 7], self.index.get_list("ca"))
+        self.index["cama"] = [9]
+        self.assertEqual([1, 2, 5, 7, 9], self.index.get_list("ca"))
+        del self.index["cal"]
+        self.assertEqual([1, 2, 5, 9], self.index.get_list("ca"))
+        self.assertEqual(["calcio", "calculo", "cama"], self.index.get_prefix_words("ca"))
+
+    def test_lists_returned_do_not_change_the_index(self):
+        self.index.editable = False
+        self.index.get_list("c").append(100)
+        self.index.get_list("calculo").append(100)
+        self.assertEqual([1, 2, 5, 7], self.index.get_list("c"))
+        self.assertEqual([1, 5], self.index.get_list("calculo"))
+
+    def test_missing_words_are_not_added_to_read_only_indexes(self):
+        self.index.editable = False
+        self.assertEqual([], self.index["missing"])
+        self.assertNotIn("missing", self.index)
+
+    def test_index_saved_before_the_words_were_saved_is_loaded(self):
+        index = pickle.loads(pickle.dumps(self.index, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(self.index.get_words(), index.get_words())
+        # The state of the indexes saved before the sorted array of words existed has only the data
+        state = {"data": dict((word, list(self.index[word])) for word in self.index.get_words())}
+        index = Trie()
+        index.__setstate__(state)
+        self.assertEqual([1, 2, 5, 7], index.get_list("cal"))
+        self.assertEqual(self.index.get_words(), index.get_words())
+
+
+class TrieCompactTest(unittest.TestCase):
+    def setUp(self):
+        self.lists = {
+            "calculo": [1, 5],
+            "calcio": [2],
+            "cal": [5, 7],
+            "fisica": [3],
+            "quantica": [3, 4]
+        }
+        self.index = create_index(self.lists)
+        self.index.compact()
+
+    def test_lists_are_concatenated_in_the_order_of_the_words(self):
+        self.assertTrue(self.index.is_compact())
+        self.assertEqual([5, 7, 2, 1, 5, 3, 3, 4], self.index.postings.tolist())
+        self.assertEqual([0, 2, 3, 5, 6, 8], self.index.offsets.tolist())
+        self.assertEqual([2, 1, 5], self.index.get_postings(1, 3).tolist())
+
+    def test_compact_index_finds_the_same_lists(self):
+        for word, ids in self.lists.iteritems():
+            self.assertEqual(ids, self.index[word].tolist())
+        self.assertEqual([1, 2, 5, 7], self.index.get_list("cal"))
+        self.assertEqual([1, 5], self.index.get_list("calculo"))
+        self.assertEqual([3, 4], self.index.get_list("quant"))
+        self.assertEqual([], self.index.get_list("z"))
+        self.assertEqual([], self.index["missing"])
+        self.assertNotIn("missing", self.index)
+        self.assertEqual(1, self.index.find("calcio"))
+
+    def test_compact_index_is_saved_without_the_lists(self):
+        blob = pickle.dumps(self.index, pickle.HIGHEST_PROTOCOL)
+        self.assertEqual(["offsets", "postings", "words"], sorted(self.index.__getstate__()))
+        index = pickle.loads(blob)
+        self.assertTrue(index.is_compact())
+        self.assertEqual(self.index.postings, index.postings)
+        self.assertEqual([1, 2, 5, 7], index.get_list("cal"))
+        self.assertEqual([3, 4], index["quantica"].tolist())
+
+    def test_compact_index_is_expanded_when_changed(self):
+        self.index["cama"] = [9]
+        self.assertFalse(self.index.is_compact())
+        self.assertEqual([1, 5], self.index["calculo"])
+        self.assertEqual([1, 2, 5, 7, 9], self.index.get_list("ca"))
+        self.index.compact()
+        self.assertEqual([1, 2, 5, 7, 9], self.index.get_list("ca"))
+
+    def test_index_saved_before_the_compaction_is_loaded(self):
+        index = create_index(self.lists)
+        index.editable = False
+        index = pickle.loads(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+        self.assertFalse(index.is_compact())
+        self.assertEqual([1, 2, 5, 7], index.get_list("cal"))
+        index.compact()
+        self.assertEqual(self.index.postings, index.postings)
+
+
+if __name__ == "__main__":
+    unittest.main()